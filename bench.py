@@ -0,0 +1,329 @@
+# bench.py
+
+# Runs each of the spiders against a local server, and measures how they do.
+# For each run we record:
+#
+#   * the wall time, and the number of pages per second
+#   * the latency of each request (from the spider printing "requesting" to it
+#     printing "got response for"), as percentiles
+#   * the CPU time used, the peak resident set size (RSS), and the number of
+#     context switches, from the rusage that the kernel hands back when the
+#     spider exits
+#   * with --strace, the number of system calls made (from a separate run under
+#     strace, since tracing slows the spider down too much to time it)
+#
+# The results are written as JSON, so that they can be kept and compared
+# between versions.
+#
+# By default the site is served by a threaded HTTP server inside this process.
+# --server slow uses slowserver.py instead (which needs Twisted), so that the
+# spiders have to cope with responses that trickle in.
+
+import SimpleHTTPServer
+import SocketServer
+import argparse
+import ast
+import datetime
+import distutils.spawn
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# The directory that the spiders live in
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# For each spider: (script, the option that sets how many requests it makes at
+# once, or None if it only makes one at a time, whether it needs Python 3)
+ENGINES = {
+    'spider1': ('spider1.py', None, False),
+    'spider2': ('spider2.py', '--threads', False),
+    'spider3': ('spider3.py', '--max-active', False),
+    'spider4': ('spider4.py', '--max-active', False),
+    'shard': ('shard.py', '--workers', False),
+    'spider5': ('spider5.py', '--max-active', True),
+}
+
+# The port that slowserver.py listens on
+SLOWSERVER_PORT = 8080
+
+class SiteHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # Serves files from root, rather than from the current directory
+    root = None
+
+    def translate_path(self, path):
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self,
+                                                                        path)
+        return os.path.join(self.root, os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, format, *args):
+        pass
+
+class SiteServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    # The spiders open a lot of connections at once
+    request_queue_size = 128
+
+def start_builtin_server(site):
+    # Serve site on a free port in a background thread, and return the port
+    class Handler(SiteHandler):
+        root = os.path.abspath(site)
+
+    server = SiteServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1]
+
+def start_slowserver(site):
+    # Start slowserver.py, and return the process once it's accepting
+    # connections.  (If something is already listening on its port, we'd
+    # never know whether we were talking to it or to slowserver.py.)
+    try:
+        socket.create_connection(('127.0.0.1', SLOWSERVER_PORT)).close()
+    except socket.error:
+        pass
+    else:
+        raise RuntimeError('port %d is already in use' % SLOWSERVER_PORT)
+
+    process = subprocess.Popen([sys.executable, 'slowserver.py', site],
+                               cwd=HERE)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', SLOWSERVER_PORT)).close()
+            return process
+        except socket.error:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError('slowserver.py did not start')
+            time.sleep(0.1)
+
+def percentile(values, p):
+    # The nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+def engine_command(engine, root_url, concurrency, python3):
+    script, option, needs_python3 = ENGINES[engine]
+
+    # Don't let the spider buffer its output, so that we see each line when
+    # it's printed
+    python = python3 if needs_python3 else sys.executable
+    command = [python, '-u', script, root_url]
+    if option is not None and concurrency is not None:
+        command += [option, str(concurrency)]
+    return command
+
+def run_engine(command):
+    # Run a spider, and return a dict of measurements
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    process = subprocess.Popen(command, cwd=HERE, stdout=subprocess.PIPE,
+                               stderr=devnull)
+
+    # Maps urls to the time they were requested
+    requested = {}
+    latencies = []
+    responses = 0
+    errors = 0
+    results = None
+    for line in iter(process.stdout.readline, ''):
+        now = time.time()
+        if line.startswith('requesting '):
+            requested[line.split(None, 1)[1].strip()] = now
+        elif line.startswith('got response for '):
+            responses += 1
+            url = line.split(None, 3)[3].strip()
+            if url in requested:
+                latencies.append(now - requested.pop(url))
+        elif line.startswith('error:'):
+            errors += 1
+        elif line.startswith('{'):
+            results = line
+
+    # The number of pages is best taken from the results that the spider
+    # prints at the end.  (The threads and processes of spider2.py and
+    # shard.py share stdout, but each line is written whole -- see Progress in
+    # sinks.py -- so they don't garble each other's, and every response gives
+    # us a latency.)
+    pages = count_pages(results)
+    if pages is None:
+        pages = responses
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.time() - start
+    process.returncode = status
+    devnull.close()
+
+    latencies.sort()
+    return {
+        'exit_status': status,
+        'wall_time': wall_time,
+        'pages': pages,
+        'errors': errors,
+        'pages_per_sec': pages / wall_time if wall_time else None,
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+            'samples': len(latencies),
+        },
+        'cpu_user': rusage.ru_utime,
+        'cpu_system': rusage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux (but bytes on macOS)
+        'max_rss_kb': rusage.ru_maxrss,
+        'voluntary_switches': rusage.ru_nvcsw,
+        'involuntary_switches': rusage.ru_nivcsw,
+    }
+
+def count_pages(line):
+    # Return the number of responses in the results printed by a spider, or
+    # None if we can't make sense of them.  These are either a dict mapping
+    # urls to status codes, or (with --seen) a dict mapping status codes to
+    # the number of responses with that status code.
+    try:
+        results = ast.literal_eval(line)
+    except (SyntaxError, ValueError):
+        return None
+    if not isinstance(results, dict):
+        return None
+
+    pages = 0
+    for key, value in results.items():
+        if isinstance(value, int):
+            pages += value
+        elif value not in (None, 'timeout'):
+            pages += 1
+    return pages
+
+def count_syscalls(command):
+    # Run a spider under strace, and return a dict mapping each system call
+    # it made (including in its threads and child processes) to the number of
+    # times it was made
+    fd, path = tempfile.mkstemp(suffix='.strace')
+    os.close(fd)
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.call(['strace', '-f', '-c', '-o', path] + command,
+                        cwd=HERE, stdout=devnull, stderr=devnull)
+        with open(path) as f:
+            return parse_strace_summary(f)
+    finally:
+        devnull.close()
+        os.remove(path)
+
+def parse_strace_summary(lines):
+    # The summary is a table of:
+    #   % time, seconds, usecs/call, calls, [errors,] syscall
+    counts = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 5 or not fields[3].isdigit() or \
+                fields[-1] == 'total':
+            continue
+        counts[fields[-1]] = int(fields[3])
+    return counts
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES),
+                            default=['spider1', 'spider2', 'spider3',
+                                     'spider4'],
+                            help='the spiders to run')
+    arg_parser.add_argument('--concurrency', type=int, nargs='+',
+                            default=[10],
+                            help='the numbers of requests to let each spider '
+                                 'make at once (ignored by spider1)')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='the number of times to run each spider at '
+                                 'each concurrency')
+    arg_parser.add_argument('--server', choices=['builtin', 'slow'],
+                            default='builtin',
+                            help='serve the site from this process, or with '
+                                 'slowserver.py')
+    arg_parser.add_argument('--site', default=os.path.join(HERE, 'lorem'),
+                            help='the directory to serve')
+    arg_parser.add_argument('--root', default='index.html',
+                            help='the page in the site to start crawling from')
+    arg_parser.add_argument('--strace', action='store_true',
+                            help='also count system calls, using strace')
+    arg_parser.add_argument('--python3', default='python3',
+                            help='the Python 3 interpreter to run spider5 with')
+    arg_parser.add_argument('--output',
+                            help='write the results to this file, rather than '
+                                 'to stdout')
+    args = arg_parser.parse_args()
+    if args.strace and distutils.spawn.find_executable('strace') is None:
+        arg_parser.error('--strace needs strace to be installed')
+
+    slowserver = None
+    if args.server == 'slow':
+        slowserver = start_slowserver(args.site)
+        port = SLOWSERVER_PORT
+    else:
+        port = start_builtin_server(args.site)
+    root_url = 'http://localhost:%d/%s' % (port, args.root)
+
+    runs = []
+    try:
+        for engine in args.engines:
+            if ENGINES[engine][1] is None:
+                concurrencies = [None]
+            else:
+                concurrencies = args.concurrency
+            for concurrency in concurrencies:
+                command = engine_command(engine, root_url, concurrency,
+                                         args.python3)
+                for repeat in range(args.repeat):
+                    print >> sys.stderr, 'running', engine, \
+                        'concurrency', concurrency, 'run', repeat + 1
+                    run = {'engine': engine, 'concurrency': concurrency,
+                           'run': repeat + 1}
+                    run.update(run_engine(command))
+                    runs.append(run)
+
+                if args.strace:
+                    print >> sys.stderr, 'counting system calls for', engine
+                    syscalls = count_syscalls(command)
+                    for run in runs[-args.repeat:]:
+                        run['syscalls'] = sum(syscalls.values())
+                        run['syscall_counts'] = syscalls
+    finally:
+        if slowserver is not None:
+            slowserver.terminate()
+            slowserver.wait()
+
+    report = {
+        'date': datetime.datetime.utcnow().isoformat() + 'Z',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'server': args.server,
+        'root_url': root_url,
+        'runs': runs,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
@@ -0,0 +1,90 @@
+# cache.py
+
+# Each run of a spider downloads every page again, even though most pages
+# won't have changed since the last run.  HTTP lets us ask for a page only if
+# it has changed ("conditional requests"): if the server gave us an ETag or a
+# Last-Modified header with the page, we can send them back to it as
+# If-None-Match or If-Modified-Since, and if the page is the same, the server
+# replies with "304 Not Modified" and no body.
+#
+# The spiders only want pages for their links, so a ResponseCache keeps, for
+# each page that we've found links in, its ETag and Last-Modified headers and
+# the links themselves.  On a 304, the spider follows the cached links
+# (handle_304), without downloading or parsing the page.
+#
+# The cache is kept in an SQLite database, so that it lasts from one run to the
+# next.  It may be shared between threads.
+
+import json
+import sqlite3
+import threading
+
+# The number of pages to add to the cache between commits
+COMMIT_EVERY = 100
+
+class ResponseCache(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        # The number of pages added since the last commit
+        self.uncommitted = 0
+
+        with self.lock:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,
+                    links TEXT)
+            ''')
+            self.db.commit()
+
+    def get(self, url):
+        # Return a tuple: (etag, last_modified, list of links) for url, or
+        # None if it's not in the cache
+        with self.lock:
+            row = self.db.execute(
+                'SELECT etag, last_modified, links FROM pages WHERE url = ?',
+                (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, links = row
+        return etag, last_modified, json.loads(links)
+
+    def put(self, url, headers, links):
+        # Remember the links found in the page at url, along with the headers
+        # needed to check whether it has changed.  If there aren't any, there's
+        # no point keeping the links, since we'll have to download the page
+        # again anyway.
+        etag = headers.get('Etag')
+        last_modified = headers.get('Last-Modified')
+        with self.lock:
+            if etag is None and last_modified is None:
+                self.db.execute('DELETE FROM pages WHERE url = ?', (url,))
+                return
+
+            self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                            (url, etag, last_modified, json.dumps(links)))
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_EVERY:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def request_headers(self, url):
+        # Return the header lines to add to a request for url, so that the
+        # server only sends the page if it has changed
+        entry = self.get(url)
+        if entry is None:
+            return ''
+
+        etag, last_modified, _ = entry
+        lines = []
+        if etag is not None:
+            lines.append('If-None-Match: %s\r\n' % etag)
+        if last_modified is not None:
+            lines.append('If-Modified-Since: %s\r\n' % last_modified)
+        return ''.join(lines).encode('utf-8')
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -1,9 +1,11 @@
 # echoserver.py
 
+import argparse
 import sys
 from twisted.internet import reactor
 from twisted.internet.protocol import Protocol, Factory
-from twisted.internet.endpoints import TCP4ServerEndpoint
+
+import workers
 
 
 class Echo(Protocol):
@@ -11,9 +13,15 @@ class Echo(Protocol):
         self.transport.write(data)
 
 if __name__ == '__main__':
-    port = int(sys.argv[1])
-    endpoint = TCP4ServerEndpoint(reactor, port)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('port', type=int)
+    workers.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    if args.workers > 1:
+        sys.exit(workers.run_workers(args.workers, args.port))
+
     factory = Factory()
     factory.protocol = Echo
-    endpoint.listen(factory)
+    workers.listen(reactor, args.port, factory, args)
     reactor.run()
@@ -0,0 +1,259 @@
+# frontier.py
+
+# The frontier is the set of urls that a spider has found but not yet
+# requested, and the order it takes them out in decides the shape of the crawl.
+# spider1.py used to keep them in a list and pop() from the end, so it went as
+# deep as it could down the first chain of links before looking at anything
+# else (depth-first, and by accident).  spider2.py used a FIFO queue
+# (breadth-first).
+#
+# All the frontiers here have the same interface:
+#
+#   push(url, depth)  -- add url, which was found depth links away from the
+#                        root, returning False if it's beyond max_depth
+#   pop()             -- remove and return the next (url, depth) tuple
+#   len(frontier)     -- the number of urls waiting
+#   iter(frontier)    -- the (url, depth) tuples waiting, in no particular
+#                        order
+#
+# and make_frontier() builds one by name:
+#
+#   bfs    -- breadth-first: urls come out in the order they went in
+#   dfs    -- depth-first: the most recently found url comes out first
+#   depth  -- the shallowest url comes out first
+#   score  -- the url that looks most valuable (see url_score) comes out first
+#   host   -- urls on hosts that we've taken the fewest urls from come out
+#             first, so that a big site doesn't crowd out the others (for
+#             spiders with a single frontier; see HOST_ORDERS)
+#
+# Given a CrawlStore (see store.py), make_frontier() wraps the frontier in a
+# SpillingFrontier, which keeps no more than WINDOW urls in memory.
+#
+# Frontiers don't lock anything; FrontierQueue wraps one for use by threads.
+
+import Queue
+import collections
+import heapq
+import urlparse
+
+# The number of urls that a SpillingFrontier keeps in memory
+WINDOW = 10000
+
+class Frontier(object):
+    def __init__(self, max_depth=None):
+        # Urls found further than this from the root are ignored
+        self.max_depth = max_depth
+
+    def accepts(self, depth):
+        return self.max_depth is None or depth <= self.max_depth
+
+    def push(self, url, depth=0):
+        if not self.accepts(depth):
+            return False
+        self.add(url, depth)
+        return True
+
+    def add(self, url, depth):
+        raise NotImplementedError
+
+    def pop(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        raise NotImplementedError
+
+class FIFOFrontier(Frontier):
+    def __init__(self, max_depth=None):
+        Frontier.__init__(self, max_depth)
+        self.urls = collections.deque()
+
+    def add(self, url, depth):
+        self.urls.append((url, depth))
+
+    def pop(self):
+        return self.urls.popleft()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self):
+        return iter(self.urls)
+
+class LIFOFrontier(Frontier):
+    def __init__(self, max_depth=None):
+        Frontier.__init__(self, max_depth)
+        self.urls = []
+
+    def add(self, url, depth):
+        self.urls.append((url, depth))
+
+    def pop(self):
+        return self.urls.pop()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self):
+        return iter(self.urls)
+
+class PriorityFrontier(Frontier):
+    # Urls come out in order of key(url, depth), lowest first.  Urls with the
+    # same key come out in the order they went in.
+
+    def __init__(self, key, max_depth=None):
+        Frontier.__init__(self, max_depth)
+        self.key = key
+
+        # A heap of tuples: (key, sequence number, url, depth)
+        self.heap = []
+        self.seq = 0
+
+    def add(self, url, depth):
+        self.seq += 1
+        heapq.heappush(self.heap, (self.key(url, depth), self.seq, url, depth))
+
+    def pop(self):
+        _, _, url, depth = heapq.heappop(self.heap)
+        return url, depth
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        for _, _, url, depth in self.heap:
+            yield url, depth
+
+def by_depth(url, depth):
+    return depth
+
+def url_score(url, depth):
+    # Guess how valuable a page is from its url, lower being better.  Pages
+    # near the top of a site's hierarchy tend to matter more than those deep
+    # inside it, and pages with query strings are often just different views
+    # of the same thing.
+    parsed_url = urlparse.urlsplit(url)
+    segments = parsed_url.path.strip('/').count('/')
+    if parsed_url.query:
+        segments += 2
+    return segments, depth
+
+class HostFairness(object):
+    # A key that puts each host's first url ahead of every host's second url,
+    # and so on.  (It has to remember how many urls it has seen for each host,
+    # so each frontier needs its own.)
+
+    def __init__(self):
+        self.counts = {}
+
+    def __call__(self, url, depth):
+        netloc = urlparse.urlsplit(url).netloc
+        count = self.counts.get(netloc, 0)
+        self.counts[netloc] = count + 1
+        return count, depth
+
+class SpillingFrontier(Frontier):
+    # Wraps another frontier, which holds at most window urls.  Any more are
+    # written to the store, and read back (oldest first) once the frontier in
+    # memory has emptied.  So the wrapped frontier's order is kept for the
+    # urls in memory, but only roughly for the crawl as a whole.
+
+    def __init__(self, inner, store, window=WINDOW):
+        Frontier.__init__(self, inner.max_depth)
+        self.inner = inner
+        self.store = store
+        self.window = window
+
+        # The number of urls we've written to the store, and not read back
+        self.spilled = 0
+
+        self.queue = store.new_queue()
+        store.frontiers.add(self)
+
+    def add(self, url, depth):
+        if self.spilled or len(self.inner) >= self.window:
+            # Don't let urls jump ahead of those already spilled
+            self.store.spill(self.queue, url, depth)
+            self.spilled += 1
+        else:
+            self.inner.push(url, depth)
+
+    def pop(self):
+        if not self.inner and self.spilled:
+            for url, depth in self.store.unspill(self.queue, self.window):
+                self.inner.push(url, depth)
+                self.spilled -= 1
+        return self.inner.pop()
+
+    def __len__(self):
+        return len(self.inner) + self.spilled
+
+    def __iter__(self):
+        # Only the urls in memory; the rest are already in the store
+        return iter(self.inner)
+
+ORDERS = ['bfs', 'dfs', 'depth', 'score', 'host']
+
+# The orders that mean something for a frontier holding a single host's urls,
+# as each of the Scheduler's do (see scheduler.py).  'host' isn't one, but the
+# Scheduler already takes the hosts in turn.
+HOST_ORDERS = [order for order in ORDERS if order != 'host']
+
+def make_frontier(order='bfs', max_depth=None, store=None):
+    if order == 'bfs':
+        frontier = FIFOFrontier(max_depth)
+    elif order == 'dfs':
+        frontier = LIFOFrontier(max_depth)
+    elif order == 'depth':
+        frontier = PriorityFrontier(by_depth, max_depth)
+    elif order == 'score':
+        frontier = PriorityFrontier(url_score, max_depth)
+    elif order == 'host':
+        frontier = PriorityFrontier(HostFairness(), max_depth)
+    else:
+        raise ValueError('unknown order: %r' % order)
+
+    if store is not None:
+        frontier = SpillingFrontier(frontier, store)
+    return frontier
+
+class FrontierQueue(Queue.Queue):
+    # A frontier that can be shared between threads, with the same interface
+    # as Queue.Queue (including task_done() and join()).  Items are put as
+    # (url, depth) tuples, and come out in the frontier's order.  None may also
+    # be put, to tell a thread to stop; it comes out once the frontier is
+    # empty.
+
+    def __init__(self, frontier):
+        self.frontier = frontier
+        Queue.Queue.__init__(self)
+
+    def put(self, item, block=True, timeout=None):
+        # Urls that are too deep are dropped here, rather than in _put(), so
+        # that they're never counted as tasks to be done
+        if item is not None and not self.frontier.accepts(item[1]):
+            return
+        Queue.Queue.put(self, item, block, timeout)
+
+    # These are called by Queue.Queue with its lock held
+
+    def _init(self, maxsize):
+        # The number of Nones waiting to come out
+        self.stops = 0
+
+    def _qsize(self, len=len):
+        return len(self.frontier) + self.stops
+
+    def _put(self, item):
+        if item is None:
+            self.stops += 1
+        else:
+            self.frontier.push(*item)
+
+    def _get(self):
+        if self.frontier:
+            return self.frontier.pop()
+        self.stops -= 1
+        return None
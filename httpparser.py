@@ -0,0 +1,312 @@
+# httpparser.py
+
+# This is an incremental parser for HTTP responses.  Rather than waiting for
+# the server to close the connection and then parsing everything that was
+# received (which is how HTTP/1.0 works), we feed the parser data as it
+# arrives, and it tells us when it has seen a complete response.  It works out
+# where the response ends from the headers:
+#
+#   * a Content-Length header gives the length of the body
+#   * "Transfer-Encoding: chunked" means that the body is sent in pieces, each
+#     preceded by its length, and ending with a piece of length zero
+#   * otherwise, the body runs until the server closes the connection
+#
+# Knowing where a response ends means that we can send another request on the
+# same connection (keep-alive), instead of opening a new one for every url.
+#
+# Data is kept in growable bytearrays, rather than by adding strings together,
+# which would copy everything received so far each time a piece arrives.  This
+# keeps the cost of parsing a response proportional to its size.
+#
+# The status and headers are parsed as soon as they have arrived, and the
+# parser can call back into the code using it at that point (on_headers), so
+# that it can decide whether it's interested in the body.  If it's not, it can
+# call skip_body(), to have the body read but thrown away, or abort(), to stop
+# parsing altogether (after which the connection can't be reused).  The body
+# can also be passed on piece by piece as it arrives (on_body), instead of
+# being collected.
+
+import re
+
+class ParseError(ValueError):
+    # Raised (and caught, and kept in ResponseParser.error) when a response
+    # isn't valid HTTP.  Anything else that the callbacks raise is left for
+    # the caller to deal with.
+    pass
+
+def parse_int(text, what, base=10):
+    try:
+        return int(text, base)
+    except ValueError:
+        raise ParseError('bad %s: %r' % (what, text[:80]))
+
+class ResponseParser(object):
+    def __init__(self, method='GET', on_headers=None, on_body=None,
+                 on_start=None):
+        # Responses to HEAD requests never have a body
+        self.method = method
+
+        # Called with the parser when the first of the response arrives
+        self.on_start = on_start
+
+        # Called with the parser once the status and headers are known
+        self.on_headers = on_headers
+
+        # If given, called with each piece of the body as it arrives, and the
+        # body is not collected
+        self.on_body = on_body
+
+        # Data that we've received, and the position in it up to which we've
+        # parsed
+        self.buf = bytearray()
+        self.pos = 0
+
+        # The number of bytes of the response that we've been fed
+        self.received = 0
+
+        # Where to start looking for the end of the headers, so that we don't
+        # search the same data again each time more arrives
+        self.scan_from = 0
+
+        # What we're expecting to see next; one of:
+        #   'headers', 'body', 'chunk-size', 'chunk-data', 'chunk-end',
+        #   'trailer', 'until-close', 'done'
+        self.state = 'headers'
+
+        self.version = None
+        self.status_code = None
+        self.headers = None
+        self.content_length = None
+
+        # The body received so far
+        self.body_buf = bytearray()
+
+        # Whether to throw the body away
+        self.skipping = False
+
+        # The number of bytes of the body (or of the current chunk) that we're
+        # still waiting for
+        self.remaining = None
+
+        self.complete = False
+        self.aborted = False
+        self.eof = False
+
+        # If the response can't be parsed, this says why
+        self.error = None
+
+        # Any data received after the end of the response
+        self.unconsumed = ''
+
+    @property
+    def started(self):
+        # Whether we've received any of the response at all
+        return self.state != 'headers' or len(self.buf) > 0
+
+    @property
+    def done(self):
+        # Whether the parser has finished with the response, either because
+        # it's complete, or because it was aborted, or because it's not valid
+        return self.complete or self.aborted or self.error is not None
+
+    @property
+    def body(self):
+        return str(self.body_buf)
+
+    @property
+    def body_view(self):
+        # The body, without copying it
+        return memoryview(self.body_buf)
+
+    @property
+    def keep_alive(self):
+        # Whether the connection can be used for another request once this
+        # response is complete
+        if self.state == 'until-close' or self.eof or self.aborted:
+            return False
+        connection = self.get_header('Connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        else:
+            return connection == 'keep-alive'
+
+    def get_header(self, name, default=None):
+        return self.headers.get(name.title(), default)
+
+    def skip_body(self):
+        # Read the body, but don't keep it
+        self.skipping = True
+
+    def abort(self):
+        # Stop parsing; the caller should close the connection
+        self.aborted = True
+
+    def feed(self, data):
+        # Parse data, and return whether the parser is now done
+        if self.done:
+            self.unconsumed += data
+            return True
+
+        if not self.received and data and self.on_start is not None:
+            self.on_start(self)
+        self.received += len(data)
+        self.buf += data
+
+        try:
+            while not self.done and self.step():
+                pass
+        except ParseError as e:
+            self.error = e
+            return True
+
+        if self.complete:
+            # Anything left over belongs to whatever comes next
+            self.unconsumed = str(self.buf[self.pos:])
+            self.buf = bytearray()
+        else:
+            # Throw away what we've parsed
+            del self.buf[:self.pos]
+            self.scan_from -= self.pos
+        self.pos = 0
+
+        return self.done
+
+    def feed_eof(self):
+        # Tell the parser that the connection has been closed, and return
+        # whether the response is complete.  If it's not, the connection was
+        # closed early.
+        self.eof = True
+        if self.state == 'until-close':
+            self.finish()
+        return self.complete
+
+    def step(self):
+        # Try to parse the next part of the response from self.buf, returning
+        # whether any progress was made
+        return getattr(self, 'parse_' + self.state.replace('-', '_'))()
+
+    def parse_headers(self):
+        end = self.buf.find('\r\n\r\n', max(self.scan_from, self.pos))
+        if end == -1:
+            # The end might be split between this data and the next
+            self.scan_from = max(len(self.buf) - 3, 0)
+            return False
+
+        status_plus_headers = str(self.buf[self.pos:end])
+        self.pos = end + 4
+        lines = status_plus_headers.split('\r\n')
+
+        match = re.match('(HTTP/1.[01]) (\d{3})', lines[0])
+        if match is None:
+            raise ParseError('bad status line: %r' % lines[0][:80])
+        self.version, self.status_code = match.groups()
+
+        self.headers = {}
+
+        for line in lines[1:]:
+            if ':' not in line:
+                raise ParseError('bad header line: %r' % line[:80])
+            # Header names are case-insensitive, so we store them in a
+            # standard form (eg Content-Type, not content-type)
+            key, val = line.split(':', 1)
+            self.headers[key.strip().title()] = val.strip()
+
+        if self.get_header('Content-Length') is not None:
+            self.content_length = parse_int(self.get_header('Content-Length'),
+                                            'Content-Length')
+
+        if self.method == 'HEAD' or self.status_code[0] == '1' or \
+                self.status_code in ('204', '304'):
+            self.finish()
+        elif self.get_header('Transfer-Encoding', '').lower() == 'chunked':
+            self.state = 'chunk-size'
+        elif self.content_length is not None:
+            self.remaining = self.content_length
+            self.state = 'body'
+            if self.remaining == 0:
+                self.finish()
+        else:
+            self.state = 'until-close'
+
+        if self.on_headers is not None:
+            self.on_headers(self)
+        return True
+
+    def parse_body(self):
+        if not self.read_remaining():
+            return False
+        if self.remaining == 0:
+            self.finish()
+        return True
+
+    def parse_chunk_size(self):
+        end = self.buf.find('\r\n', self.pos)
+        if end == -1:
+            return False
+
+        # The size may be followed by extensions, which we ignore
+        line = str(self.buf[self.pos:end])
+        self.pos = end + 2
+        self.remaining = parse_int(line.split(';', 1)[0], 'chunk size', 16)
+        if self.remaining == 0:
+            self.state = 'trailer'
+        else:
+            self.state = 'chunk-data'
+        return True
+
+    def parse_chunk_data(self):
+        if not self.read_remaining():
+            return False
+        if self.remaining == 0:
+            self.state = 'chunk-end'
+        return True
+
+    def parse_chunk_end(self):
+        # Each chunk is followed by a CRLF
+        if len(self.buf) - self.pos < 2:
+            return False
+        self.pos += 2
+        self.state = 'chunk-size'
+        return True
+
+    def parse_trailer(self):
+        # After the last chunk there may be some more headers, and then a
+        # blank line.  We don't care about the headers.
+        end = self.buf.find('\r\n', self.pos)
+        if end == -1:
+            return False
+        blank = end == self.pos
+        self.pos = end + 2
+        if blank:
+            self.finish()
+        return True
+
+    def parse_until_close(self):
+        if self.pos == len(self.buf):
+            return False
+        self.add_to_body(len(self.buf))
+        return True
+
+    def parse_done(self):
+        return False
+
+    def read_remaining(self):
+        # Move up to self.remaining bytes from self.buf to the body
+        if self.pos == len(self.buf):
+            return False
+        end = min(self.pos + self.remaining, len(self.buf))
+        self.remaining -= end - self.pos
+        self.add_to_body(end)
+        return True
+
+    def add_to_body(self, end):
+        # Move the data in self.buf up to end to the body
+        if self.on_body is not None:
+            self.on_body(str(self.buf[self.pos:end]))
+        elif not self.skipping:
+            self.body_buf += memoryview(self.buf)[self.pos:end]
+        self.pos = end
+
+    def finish(self):
+        self.state = 'done'
+        self.complete = True
@@ -0,0 +1,130 @@
+# links.py
+
+# This module finds the links in a web page.  Building a complete
+# BeautifulSoup tree for each page, just to pull out the <a> tags, is by far
+# the most expensive thing that the spiders do, and it means waiting until the
+# whole page has arrived.
+#
+# LinkExtractor instead scans the page with regular expressions, and can be fed
+# the page a piece at a time as it arrives.  It calls a callback with each link
+# as soon as it finds it, so that a spider can start requesting the links at
+# the top of a page before the bottom of the page has arrived.
+#
+# BeautifulSoup is more thorough (it understands the whole of HTML, where we
+# only understand enough to find <a> tags), so it's still available, via
+# soup_links(), for comparison.
+
+import htmlentitydefs
+import re
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+# Matches either an <a> tag, or the start of a comment
+TAG_RE = re.compile(r'<!--|<a\s[^>]*>', re.IGNORECASE)
+
+# Matches the href attribute of a tag, which may be in double quotes, single
+# quotes, or no quotes
+HREF_RE = re.compile(r'''\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''',
+                     re.IGNORECASE)
+
+# Matches a character reference, like &amp; or &#39; or &#x27;
+ENTITY_RE = re.compile(r'&(#x[0-9a-f]+|#[0-9]+|[a-z]+);', re.IGNORECASE)
+
+# The longest tag that we'll wait for the end of, when a piece of a page ends
+# part way through a tag
+MAX_TAG = 8192
+
+class LinkExtractor(object):
+    def __init__(self, callback, encoding='utf-8'):
+        # Called with each link that is found
+        self.callback = callback
+
+        # Used to turn the bytes of the page into unicode
+        self.encoding = encoding
+
+        # The end of the previous piece of the page, if it might be the start
+        # of a tag
+        self.buf = ''
+
+        # Whether we're part way through a comment, in which case any tags are
+        # ignored
+        self.in_comment = False
+
+    def feed(self, data):
+        buf = self.buf + data
+        pos = 0
+
+        while True:
+            if self.in_comment:
+                end = buf.find('-->', pos)
+                if end == -1:
+                    # Keep enough of the page to spot a --> that is split
+                    # between this piece and the next
+                    self.buf = buf[-2:]
+                    return
+                pos = end + 3
+                self.in_comment = False
+
+            match = TAG_RE.search(buf, pos)
+            if match is None:
+                break
+            pos = match.end()
+
+            if match.group() == '<!--':
+                self.in_comment = True
+                continue
+
+            href = HREF_RE.search(match.group())
+            if href is not None:
+                link = href.group(1) or href.group(2) or href.group(3) or ''
+                self.callback(unescape(link.decode(self.encoding, 'replace')))
+
+        # Keep anything that might be the start of a tag that hasn't finished
+        # arriving
+        start = buf.rfind('<', pos)
+        if start != -1 and len(buf) - start < MAX_TAG:
+            self.buf = buf[start:]
+        else:
+            self.buf = ''
+
+def extract_links(html, callback):
+    # Find all the links in a page that has arrived in full
+    LinkExtractor(callback).feed(html)
+
+def find_links(html, use_soup=False):
+    # Return a list of all the links in a page
+    if use_soup:
+        return soup_links(html)
+    links = []
+    extract_links(html, links.append)
+    return links
+
+def soup_links(html):
+    # Find all the links in a page with BeautifulSoup
+    if BeautifulSoup is None:
+        raise RuntimeError('BeautifulSoup is not installed')
+
+    soup = BeautifulSoup(html)
+    return [link.get('href') for link in soup.find_all('a')]
+
+def unescape(text):
+    # Replace character references with the characters they stand for
+    if '&' not in text:
+        return text
+    return ENTITY_RE.sub(replace_entity, text)
+
+def replace_entity(match):
+    name = match.group(1)
+    try:
+        if name[:2].lower() == '#x':
+            return unichr(int(name[2:], 16))
+        elif name[0] == '#':
+            return unichr(int(name[1:]))
+        else:
+            return unichr(htmlentitydefs.name2codepoint[name])
+    except (KeyError, ValueError):
+        # Not a reference that we know about, so leave it alone
+        return match.group()
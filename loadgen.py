@@ -0,0 +1,313 @@
+# loadgen.py
+
+# socketdemo.py sends one message to an echo server.  This does the same over
+# many connections at once, for a while, and measures how long each message
+# takes to come back (its round-trip time) and how many get through.  Point it
+# at echoserver.py (perhaps with --workers).
+#
+# Each connection sends a message, waits for all of it to be echoed back, and
+# then sends the next one: either straight away, or (with --rate) when its turn
+# comes round, so that all the connections together send rate messages a
+# second.  When there's a rate, round-trip times are measured from when a
+# message should have been sent, rather than when it was, so that a client
+# that falls behind can't hide the delay ("coordinated omission").
+#
+# There are two engines, so that the cost of the event loop can be measured on
+# its own, without HTTP or HTML getting in the way:
+#
+#   threads  -- a thread per connection, with blocking sockets
+#   event    -- spider4.py's Event loop, in a single thread
+
+import argparse
+import errno
+import json
+import math
+import resource
+import socket
+import sys
+import threading
+import time
+
+from spider4 import RECV_SIZE, Event
+from timing import Histogram, format_time
+
+class Stats(object):
+    # What one connection (or, once merged, all of them) measured
+    def __init__(self):
+        self.latencies = Histogram()
+        self.errors = 0
+
+    def merge(self, other):
+        self.latencies.merge(other.latencies)
+        self.errors += other.errors
+
+def run_threads(address, n_connections, message, interval, duration):
+    # A thread per connection, each with a blocking socket
+    start = time.time()
+    deadline = start + duration
+    all_stats = [Stats() for _ in range(n_connections)]
+
+    def work(stats, first_send):
+        try:
+            sock = socket.create_connection(address)
+        except socket.error as e:
+            print 'error:', e
+            stats.errors += 1
+            return
+
+        next_send = first_send
+        try:
+            while True:
+                now = time.time()
+                if interval is None:
+                    next_send = now
+                elif next_send > now:
+                    time.sleep(next_send - now)
+                if next_send >= deadline:
+                    break
+
+                sock.sendall(message)
+                remaining = len(message)
+                while remaining:
+                    data = sock.recv(min(remaining, RECV_SIZE))
+                    if not data:
+                        raise socket.error('connection closed by server')
+                    remaining -= len(data)
+                stats.latencies.add(time.time() - next_send)
+
+                if interval is not None:
+                    next_send += interval
+        except socket.error as e:
+            print 'error:', e
+            stats.errors += 1
+        finally:
+            sock.close()
+
+    threads = [threading.Thread(target=work,
+                                args=(stats, start + offset(i, n_connections,
+                                                            interval)))
+               for i, stats in enumerate(all_stats)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return all_stats
+
+class EventClient(object):
+    # One connection, driven by an Event loop.  The socket is always
+    # registered for reading; it's only registered for writing while part of a
+    # message is waiting to be sent.
+
+    def __init__(self, loop, sock, message, interval, deadline, first_send):
+        self.loop = loop
+        self.sock = sock
+        self.message = message
+        self.interval = interval
+        self.deadline = deadline
+        self.stats = Stats()
+
+        # When the message in flight was (or should have been) sent, what's
+        # left of it to send, and how much of its echo we're still waiting
+        # for.  With an interval, next_send is when the next message is due.
+        self.sent_at = None
+        self.next_send = first_send
+        self.out = ''
+        self.remaining = 0
+        self.writing = False
+
+        loop.add_reader(sock, self.read)
+        loop.call_at(first_send, self.send)
+
+    def send(self):
+        if self.interval is None:
+            self.sent_at = self.loop.clock()
+        else:
+            self.sent_at = self.next_send
+            self.next_send += self.interval
+        if self.sent_at >= self.deadline:
+            self.close()
+            return
+
+        self.out = self.message
+        self.remaining = len(self.message)
+        self.write()
+
+    def write(self):
+        try:
+            sent = self.sock.send(self.out)
+        except socket.error as e:
+            if e.args[0] == errno.EWOULDBLOCK:
+                sent = 0
+            else:
+                self.failed(e)
+                return
+
+        self.out = self.out[sent:]
+        if self.out and not self.writing:
+            self.writing = True
+            self.loop.add_socket_for_writing(self.sock, self.write)
+        elif not self.out and self.writing:
+            self.writing = False
+            self.loop.remove_socket_for_writing(self.sock)
+
+    def read(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] != errno.EWOULDBLOCK:
+                self.failed(e)
+            return
+        if not data:
+            self.failed(socket.error('connection closed by server'))
+            return
+
+        self.remaining -= len(data)
+        if self.remaining > 0:
+            return
+
+        now = self.loop.clock()
+        self.stats.latencies.add(now - self.sent_at)
+        if self.interval is None:
+            self.send()
+        else:
+            # Wait for our next turn, unless we're already late for it
+            self.loop.call_at(max(now, self.next_send), self.send)
+
+    def failed(self, error):
+        print 'error:', error
+        self.stats.errors += 1
+        self.close()
+
+    def close(self):
+        if self.writing:
+            self.writing = False
+            self.loop.remove_socket_for_writing(self.sock)
+        self.loop.remove_reader(self.sock)
+        self.sock.close()
+
+def run_event(address, n_connections, message, interval, duration):
+    # All the connections in one thread, on an Event loop
+    loop = Event()
+    start = loop.clock()
+    deadline = start + duration
+    all_stats = []
+    for i in range(n_connections):
+        # Connecting isn't what we're measuring, so it's done up front, and
+        # blocks
+        try:
+            sock = socket.create_connection(address)
+        except socket.error as e:
+            print 'error:', e
+            stats = Stats()
+            stats.errors += 1
+            all_stats.append(stats)
+            continue
+        sock.setblocking(0)
+        client = EventClient(loop, sock, message, interval, deadline,
+                             start + offset(i, n_connections, interval))
+        all_stats.append(client.stats)
+
+    loop.run()
+    return all_stats
+
+def offset(i, n_connections, interval):
+    # Spread the connections' first messages out over the first interval, so
+    # that they don't all send at once
+    if interval is None:
+        return 0
+    return interval * i / n_connections
+
+ENGINES = {
+    'threads': run_threads,
+    'event': run_event,
+}
+
+def report(args, stats, wall_time, cpu_time):
+    latencies = stats.latencies
+    messages = latencies.count
+    result = {
+        'engine': args.engine,
+        'connections': args.connections,
+        'size': args.size,
+        'rate': args.rate,
+        'duration': wall_time,
+        'messages': messages,
+        'errors': stats.errors,
+        'messages_per_sec': messages / wall_time,
+        'bytes_per_sec': messages * args.size / wall_time,
+        'cpu_time': cpu_time,
+        'cpu_per_message': cpu_time / messages if messages else None,
+        'latency': {
+            'mean': latencies.mean(),
+            'p50': latencies.percentile(50),
+            'p90': latencies.percentile(90),
+            'p99': latencies.percentile(99),
+            'p999': latencies.percentile(99.9),
+            'max': latencies.max if messages else None,
+        },
+        'histogram': latencies.rows(),
+    }
+    if args.json:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print
+        return
+
+    print 'engine %s, %d connections, %d byte messages' % (
+        args.engine, args.connections, args.size)
+    print '%d messages in %.2fs: %.0f messages/s, %.2f MB/s each way' % (
+        messages, wall_time, result['messages_per_sec'],
+        result['bytes_per_sec'] / 1e6)
+    print '%.2fs of CPU, %s per message, %d errors' % (
+        cpu_time, format_time(result['cpu_per_message']), stats.errors)
+    print 'round trip: mean %s, p50 %s, p90 %s, p99 %s, p99.9 %s, max %s' % \
+        tuple(format_time(result['latency'][key])
+              for key in ('mean', 'p50', 'p90', 'p99', 'p999', 'max'))
+
+    rows = result['histogram']
+    widest = max([count for _, count in rows] or [1])
+    for upper_bound, count in rows:
+        bar = '#' * int(math.ceil(50.0 * count / widest))
+        print '  <= %9s %9d %s' % (format_time(upper_bound), count, bar)
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('port', type=int, nargs='?', default=1234)
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--engine', choices=sorted(ENGINES),
+                            default='event',
+                            help='make the connections with a thread each, or '
+                                 'all on one Event loop')
+    arg_parser.add_argument('--connections', type=int, default=10,
+                            help='the number of connections to make')
+    arg_parser.add_argument('--size', type=int, default=64,
+                            help='the size of each message, in bytes')
+    arg_parser.add_argument('--rate', type=float,
+                            help='the number of messages per second to send, '
+                                 'across all connections (default: as many '
+                                 'as possible)')
+    arg_parser.add_argument('--duration', type=float, default=5,
+                            help='the number of seconds to send messages for')
+    arg_parser.add_argument('--json', action='store_true',
+                            help='report the results as JSON')
+    args = arg_parser.parse_args()
+
+    if args.rate is not None:
+        interval = args.connections / args.rate
+    else:
+        interval = None
+    message = 'x' * args.size
+
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    all_stats = ENGINES[args.engine]((args.host, args.port), args.connections,
+                                     message, interval, args.duration)
+    wall_time = time.time() - start
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = (cpu_after.ru_utime - cpu_before.ru_utime +
+                cpu_after.ru_stime - cpu_before.ru_stime)
+
+    stats = Stats()
+    for connection_stats in all_stats:
+        stats.merge(connection_stats)
+    report(args, stats, wall_time, cpu_time)
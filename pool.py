@@ -0,0 +1,113 @@
+# pool.py
+
+# A pool of keep-alive connections, grouped by netloc.  Opening a connection
+# costs a round trip (and more, for the DNS lookup), so once a response has
+# been read from an HTTP/1.1 connection, we put the connection back into the
+# pool, and the next request to the same netloc can use it.
+#
+# The pool also limits the number of connections that are in use at once for
+# each netloc (max_active), and the number of idle connections it holds on to
+# (max_idle).  Idle connections that have been unused for longer than
+# idle_timeout are closed, since the server has probably given up on them.
+#
+# Every successful call to checkout() must be matched by exactly one call to
+# checkin() or discard().
+#
+# The pool works with both threads and an event loop: threads call checkout(),
+# which blocks until a connection is available, while code running in an event
+# loop calls checkout(block=False), which raises PoolFull instead of waiting.
+# It's then up to the caller to keep hold of its request, and try again once a
+# connection to that netloc is checked in or discarded (as spider4.py does).
+
+import threading
+import time
+
+class PoolFull(Exception):
+    pass
+
+class ConnectionPool(object):
+    def __init__(self, max_active=4, max_idle=4, idle_timeout=30,
+                 clock=time.time):
+        # max_active may be None, meaning that there's no limit
+        self.max_active = max_active
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+
+        self.condition = threading.Condition()
+
+        # Maps netlocs to a list of tuples: (time returned to pool, socket)
+        self.idle = {}
+
+        # Maps netlocs to the number of connections checked out
+        self.active = {}
+
+    def checkout(self, netloc, block=True):
+        # Returns an idle connection to netloc, if there is one.  Otherwise,
+        # returns None, meaning that the caller may open a new connection.  If
+        # max_active connections to netloc are already in use, waits for one
+        # to be returned, or raises PoolFull if block is False.
+        with self.condition:
+            while not self.can_checkout(netloc):
+                if not block:
+                    raise PoolFull(netloc)
+                self.condition.wait()
+
+            self.active[netloc] = self.active.get(netloc, 0) + 1
+            return self.take_idle(netloc)
+
+    def checkin(self, netloc, sock):
+        # Return a connection that can be reused
+        with self.condition:
+            self.active[netloc] -= 1
+            idle = self.idle.setdefault(netloc, [])
+            if len(idle) < self.max_idle:
+                idle.append((self.clock(), sock))
+                sock = None
+            self.condition.notify()
+
+        if sock is not None:
+            # There's no room for it in the pool
+            sock.close()
+
+    def discard(self, netloc, sock=None):
+        # Give up a connection that can't be reused (or that could not be
+        # opened)
+        if sock is not None:
+            sock.close()
+
+        with self.condition:
+            self.active[netloc] -= 1
+            self.condition.notify()
+
+    def close(self):
+        # Close all idle connections
+        with self.condition:
+            for idle in self.idle.values():
+                for _, sock in idle:
+                    sock.close()
+            self.idle = {}
+
+    def can_checkout(self, netloc):
+        if self.max_active is None:
+            return True
+        return self.active.get(netloc, 0) < self.max_active
+
+    def take_idle(self, netloc):
+        # Return the most recently used idle connection, closing any that have
+        # been idle for too long
+        idle = self.idle.get(netloc, [])
+        if not idle:
+            return None
+
+        returned, sock = idle.pop()
+        if returned >= self.clock() - self.idle_timeout:
+            return sock
+
+        # Connections are returned to the list in order, so if the most recent
+        # one is stale, they all are
+        sock.close()
+        for _, sock in idle:
+            sock.close()
+        del idle[:]
+        return None
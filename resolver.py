@@ -0,0 +1,226 @@
+# resolver.py
+
+# This module provides DNS resolution for the spiders.  Looking up a hostname
+# with socket.gethostbyname() blocks until the answer comes back, and all the
+# spiders make one lookup per url, even though most urls are on the same host.
+#
+# There are three pieces:
+#
+#   Cache              -- remembers answers (and failures) for a while
+#   Resolver           -- blocking resolution through a cache, for the blocking
+#                         and threaded spiders (spider1.py - spider3.py)
+#   ThreadPoolResolver -- resolution in background threads, with the answers
+#                         delivered as callbacks on an Event loop (spider4.py)
+#
+# Where an answer comes from is pluggable: a source is any function that takes
+# a hostname and returns an IP address, or raises socket.error.  By default
+# that's socket.gethostbyname(), but a HostsFile, or a stub function, can be
+# used instead -- which is handy for testing.
+
+import Queue
+import socket
+import threading
+import time
+
+def lookup(source, hostname):
+    # Look hostname up with source, turning anything that goes wrong into a
+    # socket.error.  (A hostname that isn't ASCII makes gethostbyname() raise
+    # UnicodeError, for one.)
+    try:
+        return source(hostname)
+    except socket.error:
+        raise
+    except Exception as e:
+        raise socket.error('can\'t look up %r: %s' % (hostname, e))
+
+class Cache(object):
+    def __init__(self, ttl=300, negative_ttl=30, clock=time.time):
+        # gethostbyname() doesn't tell us the TTL of the records it returns,
+        # so we hold on to every successful answer for the same length of time
+        self.ttl = ttl
+
+        # Failed lookups are cached too, but for less long, so that a typo'd
+        # hostname in a page doesn't cost us a lookup for every link to it
+        self.negative_ttl = negative_ttl
+
+        self.clock = clock
+
+        # Maps hostnames to a tuple: (expiry time, address, error)
+        self.entries = {}
+
+    def get(self, hostname):
+        # Returns the address for hostname, raises the cached error if the last
+        # lookup failed, or returns None if we don't know the answer
+        try:
+            expires, address, error = self.entries[hostname]
+        except KeyError:
+            return None
+
+        if expires < self.clock():
+            # The entry is stale
+            self.entries.pop(hostname, None)
+            return None
+
+        if error is not None:
+            raise error
+        return address
+
+    def put(self, hostname, address):
+        self.entries[hostname] = self.clock() + self.ttl, address, None
+
+    def put_error(self, hostname, error):
+        self.entries[hostname] = self.clock() + self.negative_ttl, None, error
+
+# A cache shared by every resolver in the process, unless they're given their
+# own
+shared_cache = Cache()
+
+class HostsFile(object):
+    # A source that answers from a file in the same format as /etc/hosts, and
+    # never touches the network
+
+    def __init__(self, path='/etc/hosts'):
+        # Maps hostnames to addresses
+        self.hosts = {}
+
+        with open(path) as f:
+            for line in f:
+                fields = line.split('#', 1)[0].split()
+                if len(fields) < 2 or ':' in fields[0]:
+                    # Blank line, or an IPv6 address, which the spiders don't
+                    # know how to connect to
+                    continue
+                for name in fields[1:]:
+                    self.hosts.setdefault(name.lower(), fields[0])
+
+    def __call__(self, hostname):
+        try:
+            return self.hosts[hostname.lower()]
+        except KeyError:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+class Resolver(object):
+    # Blocking resolution through a cache.  This is safe to share between
+    # threads: if several threads ask for the same hostname at once, only the
+    # first makes a lookup, and the others wait for its answer.
+
+    def __init__(self, source=socket.gethostbyname, cache=None):
+        self.source = source
+        self.cache = cache or shared_cache
+        self.lock = threading.Lock()
+
+        # Maps hostnames to a threading.Event that is set once the lookup in
+        # progress for that hostname has finished
+        self.in_flight = {}
+
+    def resolve(self, hostname):
+        while True:
+            with self.lock:
+                address = self.cache.get(hostname)
+                if address is not None:
+                    return address
+
+                done = self.in_flight.get(hostname)
+                if done is None:
+                    # Nobody else is looking this hostname up, so we will
+                    done = self.in_flight[hostname] = threading.Event()
+                    break
+
+            # Another thread is looking this hostname up; wait for it to finish
+            # and then check the cache again
+            done.wait()
+
+        try:
+            address = lookup(self.source, hostname)
+        except socket.error as e:
+            self.cache.put_error(hostname, e)
+            raise
+        else:
+            self.cache.put(hostname, address)
+            return address
+        finally:
+            with self.lock:
+                del self.in_flight[hostname]
+            done.set()
+
+class ThreadPoolResolver(object):
+    # Non-blocking resolution for an Event loop.  Lookups are made by a pool
+    # of worker threads, and each answer is handed back to the loop, which
+    # calls the callbacks waiting for it.
+
+    def __init__(self, loop, n_threads=4, source=socket.gethostbyname,
+                 cache=None):
+        self.loop = loop
+        self.source = source
+        self.cache = cache or shared_cache
+
+        # Maps hostnames that are being looked up to a list of callbacks to
+        # call with the answer.  This is only touched from the loop's thread.
+        self.waiting = {}
+
+        # Hostnames for the worker threads to look up
+        self.queue = Queue.Queue()
+
+        self.threads = [self.build_thread() for _ in range(n_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def build_thread(self):
+        thread = threading.Thread(target=self.work)
+        thread.daemon = True
+        return thread
+
+    def resolve(self, hostname, callback):
+        # Look up hostname, and call callback with (address, error) when the
+        # answer is known.  Exactly one of address and error will be None.
+        try:
+            address = self.cache.get(hostname)
+        except socket.error as e:
+            callback(None, e)
+            return
+
+        if address is not None:
+            callback(address, None)
+            return
+
+        if hostname in self.waiting:
+            # There's already a lookup in progress, so join the queue for it
+            self.waiting[hostname].append(callback)
+            return
+
+        self.waiting[hostname] = [callback]
+        self.loop.expect_callback()
+        self.queue.put(hostname)
+
+    def work(self):
+        # Runs in each worker thread
+        while True:
+            hostname = self.queue.get()
+            if hostname is None:
+                break
+
+            # Whatever happens, the loop must hear back about every lookup
+            # (see Event.expect_callback), or it will wait forever
+            try:
+                address, error = lookup(self.source, hostname), None
+            except socket.error as e:
+                address, error = None, e
+
+            self.loop.call_from_thread(self.finish, hostname, address, error)
+
+    def finish(self, hostname, address, error):
+        # Runs in the loop's thread once a lookup is complete
+        if error is None:
+            self.cache.put(hostname, address)
+        else:
+            self.cache.put_error(hostname, error)
+
+        for callback in self.waiting.pop(hostname):
+            callback(address, error)
+
+    def close(self):
+        # Tell the worker threads to exit, and wait for them to do so
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
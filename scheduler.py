@@ -0,0 +1,174 @@
+# scheduler.py
+
+# The non-blocking spiders would otherwise start a request for every link as
+# soon as they find it.  A big page can have hundreds of links, which means
+# hundreds of sockets opened at once: enough to upset the server (which is
+# likely to be the same one for most of them), and, on a big crawl, to run out
+# of file descriptors.
+#
+# A Scheduler sits between finding a link and requesting it.  Work is parked in
+# a queue for its host, and only let out when:
+#
+#   * fewer than max_active requests are in progress altogether
+#   * fewer than max_per_host requests to that host are in progress
+#   * the host's TokenBucket allows another request, if there's a rate limit
+#
+# Hosts take turns, so that one host with a long queue doesn't hold up the
+# others.  Each host's queue is a frontier (see frontier.py), which decides
+# the order that the host's urls are let out in.
+#
+# The scheduler doesn't know anything about sockets or loops: whoever uses it
+# calls ready() to find out what to start, done() whenever a request finishes,
+# and next_time() to find out when to check again if the only thing holding
+# work back is a rate limit.
+
+import collections
+import time
+
+from frontier import FIFOFrontier
+
+class TokenBucket(object):
+    # Allows rate requests per second on average, with bursts of up to burst
+    # requests at once.  Tokens drip into the bucket at a steady rate, up to
+    # burst of them, and each request takes one.
+
+    def __init__(self, rate, burst=1, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+
+        # The bucket starts full
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        # Take a token, returning whether there was one to take
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def next_time(self):
+        # The time at which there'll next be a token to take
+        self.refill()
+        if self.tokens >= 1:
+            return self.updated
+        return self.updated + (1 - self.tokens) / self.rate
+
+class Scheduler(object):
+    def __init__(self, max_active=None, max_per_host=None, rate=None,
+                 burst=1, frontier=FIFOFrontier, clock=time.time):
+        # Any of the limits may be None, meaning that there's no limit
+        self.max_active = max_active
+        self.max_per_host = max_per_host
+
+        # The number of requests per second allowed to each host
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+
+        # Called with no arguments to build the frontier for a new host
+        self.frontier = frontier
+
+        # Maps netlocs to the frontier of items waiting to be started
+        self.waiting = {}
+
+        # The netlocs with items waiting, in the order they'll next get a turn
+        self.hosts = collections.deque()
+
+        # Maps netlocs to the number of items in progress, and the total
+        self.active = {}
+        self.n_active = 0
+
+        # Maps netlocs to their TokenBucket, if there's a rate limit
+        self.buckets = {}
+
+    def __len__(self):
+        # The number of items waiting to be started
+        return sum(len(waiting) for waiting in self.waiting.values())
+
+    def add(self, netloc, item, depth=0):
+        # Park item until it can be started, returning False if the host's
+        # frontier won't take it (because it's too deep)
+        waiting = self.waiting.get(netloc)
+        if waiting is None:
+            waiting = self.frontier()
+        if not waiting.push(item, depth):
+            return False
+
+        if netloc not in self.waiting:
+            self.waiting[netloc] = waiting
+            self.hosts.append(netloc)
+        return True
+
+    def ready(self):
+        # Return a list of the items that can be started now, taking one from
+        # each host in turn.  They're counted as in progress until done() is
+        # called for them.
+        started = []
+        progress = True
+        while progress and self.hosts and self.below(self.n_active,
+                                                     self.max_active):
+            progress = False
+            for _ in range(len(self.hosts)):
+                netloc = self.hosts.popleft()
+                waiting = self.waiting[netloc]
+                if self.can_start(netloc):
+                    item, _ = waiting.pop()
+                    started.append(item)
+                    self.active[netloc] = self.active.get(netloc, 0) + 1
+                    self.n_active += 1
+                    progress = True
+
+                if waiting:
+                    self.hosts.append(netloc)
+                else:
+                    del self.waiting[netloc]
+
+                if not self.below(self.n_active, self.max_active):
+                    break
+        return started
+
+    def done(self, netloc):
+        # Call this when an item that ready() returned has finished
+        self.active[netloc] -= 1
+        self.n_active -= 1
+        if not self.active[netloc]:
+            del self.active[netloc]
+
+    def next_time(self):
+        # If there are items waiting only because of a rate limit, return the
+        # time at which one of them can be started.  Otherwise return None:
+        # either there's nothing waiting, or we're waiting for a call to
+        # done().
+        if not self.below(self.n_active, self.max_active):
+            return None
+
+        times = [self.buckets[netloc].next_time() for netloc in self.hosts
+                 if netloc in self.buckets and
+                 self.below(self.active.get(netloc, 0), self.max_per_host)]
+        return min(times) if times else None
+
+    def can_start(self, netloc):
+        # Whether another item for netloc may start now; if so, and there's a
+        # rate limit, this uses up one of the host's tokens
+        if not self.below(self.active.get(netloc, 0), self.max_per_host):
+            return False
+        if self.rate is None:
+            return True
+
+        bucket = self.buckets.get(netloc)
+        if bucket is None:
+            bucket = self.buckets[netloc] = TokenBucket(self.rate, self.burst,
+                                                        self.clock)
+        return bucket.take()
+
+    def below(self, count, limit):
+        return limit is None or count < limit
@@ -0,0 +1,205 @@
+# seen.py
+
+# Each spider's results dict does two jobs: it's the record of which urls
+# we've already requested (so that we don't request them again), and it's the
+# output of the crawl.  Holding every url as a string, along with a string for
+# its status code, costs a few hundred bytes per url, which adds up to gigabytes
+# on a crawl of tens of millions of urls.
+#
+# CompactResults does the same two jobs in much less space:
+#
+#   * To tell whether we've seen a url, we only need to remember a fingerprint
+#     of it: 64 bits of its md5 hash.  (Two urls will share a fingerprint
+#     once in about 2**32 urls.)  FingerprintSet keeps these in an array, with
+#     open addressing, rather than as Python objects, so each url costs 8-16
+#     bytes.
+#   * A BloomFilter can be used instead.  It takes a fixed amount of memory,
+#     chosen from the number of urls expected and the false-positive rate that
+#     we're prepared to put up with (a false positive being a url that we
+#     wrongly think we've seen, and so never request).  At a 1% rate that's
+#     about 1.2 bytes per url.
+#   * Status codes aren't kept per url at all: we count how many of each we've
+#     had, and if given a sink (see sinks.py), write each url and its status
+#     code to it as the results come in.
+
+import array
+import hashlib
+import math
+import struct
+import threading
+
+# The array typecode that we keep fingerprints in, and how many bits that
+# leaves us.  (A C long is 64 bits on most 64-bit platforms, but not all.)
+TYPECODE = 'L'
+FINGERPRINT_MASK = (1 << (8 * array.array(TYPECODE).itemsize)) - 1
+
+def fingerprint(url):
+    # Return a 64-bit fingerprint of url, which is never zero
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    fp, = struct.unpack('<Q', hashlib.md5(url).digest()[:8])
+    return fp or 1
+
+class FingerprintSet(object):
+    # A set of fingerprints, kept in an array.  A fingerprint lives in the slot
+    # given by its low bits, or if that's taken, the next free slot after it
+    # ("linear probing").  Empty slots hold zero.  The array is doubled in size
+    # whenever it gets half full, so that the runs of taken slots stay short.
+
+    def __init__(self, capacity=1024):
+        size = 1
+        while size < 2 * capacity:
+            size *= 2
+        self.table = array.array(TYPECODE, [0]) * size
+        self.mask = size - 1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, fp):
+        fp &= FINGERPRINT_MASK
+        return self.table[self.find(fp or 1)] != 0
+
+    def add(self, fp):
+        # Add fp, returning True if it wasn't already in the set
+        fp = fp & FINGERPRINT_MASK or 1
+        slot = self.find(fp)
+        if self.table[slot]:
+            return False
+
+        self.table[slot] = fp
+        self.count += 1
+        if 2 * self.count > len(self.table):
+            self.grow()
+        return True
+
+    def find(self, fp):
+        # Return the slot that holds fp, or the empty slot where it would go
+        table = self.table
+        mask = self.mask
+        slot = fp & mask
+        while table[slot] and table[slot] != fp:
+            slot = (slot + 1) & mask
+        return slot
+
+    def grow(self):
+        old = self.table
+        self.table = array.array(TYPECODE, [0]) * (2 * len(old))
+        self.mask = len(self.table) - 1
+        for fp in old:
+            if fp:
+                self.table[self.find(fp)] = fp
+
+class BloomFilter(object):
+    # A fixed-size array of bits.  Adding a fingerprint sets k of the bits,
+    # chosen by hashing it; a fingerprint is taken to be in the filter if all
+    # of its bits are set.  So there are no false negatives, but there are
+    # false positives, at a rate that grows as the filter fills up.  With
+    # capacity fingerprints added, the rate is error_rate.
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.n_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                    math.log(2) ** 2))
+        self.n_hashes = max(1, int(round(float(self.n_bits) / capacity *
+                                         math.log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, fp):
+        bits = self.bits
+        for bit in self.positions(fp):
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def add(self, fp):
+        # Add fp, returning True if it wasn't (as far as we can tell) already
+        # in the filter
+        bits = self.bits
+        new = False
+        for bit in self.positions(fp):
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def positions(self, fp):
+        # Derive the k bit positions from the two halves of the fingerprint
+        # ("double hashing"), rather than hashing k times
+        h1 = fp & 0xffffffff
+        h2 = (fp >> 32) | 1
+        for i in xrange(self.n_hashes):
+            yield (h1 + i * h2) % self.n_bits
+
+class CompactResults(object):
+    # A stand-in for a spider's results dict, supporting the parts of the dict
+    # interface that the spiders use: "url in results", "results[url] =
+    # status" (with None meaning that the url has been claimed, but we don't
+    # have a response yet), len() and update().  Like spider2's Results, it
+    # also has claim(), and it's safe to share between threads.
+
+    def __init__(self, seen=None, sink=None):
+        # A FingerprintSet or BloomFilter
+        self.seen = seen if seen is not None else FingerprintSet()
+
+        # If given, each url and its status code are written to this
+        self.sink = sink
+
+        # Maps status codes to the number of responses we've had with that
+        # status code
+        self.counts = {}
+
+        self.lock = threading.Lock()
+
+    def __contains__(self, url):
+        return fingerprint(url) in self.seen
+
+    def __setitem__(self, url, status):
+        fp = fingerprint(url)
+        with self.lock:
+            self.seen.add(fp)
+            if status is None:
+                return
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if self.sink is not None:
+                self.sink.write(url, status)
+
+    def __len__(self):
+        return len(self.seen)
+
+    def __repr__(self):
+        return repr(self.counts)
+
+    def claim(self, url):
+        # Record that url is being requested, and return True, unless it has
+        # already been claimed, in which case return False
+        fp = fingerprint(url)
+        with self.lock:
+            return self.seen.add(fp)
+
+    def update(self, results):
+        for url, status in results.items():
+            self[url] = status
+
+SEEN_KINDS = ['dict', 'exact', 'bloom']
+
+def make_results(kind='dict', capacity=1000000, error_rate=0.001,
+                 sink=None):
+    # Return a CompactResults for the given kind of seen-set, or None for the
+    # spider's usual dict.  There's no point keeping every url's status code in
+    # a dict when they're going to a sink, so with a sink, 'dict' means
+    # 'exact'.
+    if kind == 'dict' and sink is None:
+        return None
+    elif kind in ('dict', 'exact'):
+        return CompactResults(FingerprintSet(), sink)
+    elif kind == 'bloom':
+        return CompactResults(BloomFilter(capacity, error_rate), sink)
+    raise ValueError('unknown seen-set: %r' % kind)
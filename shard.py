@@ -0,0 +1,218 @@
+# shard.py
+
+# spider4.py runs in a single process, so it can only use one core.  This
+# module runs a crawl across several processes, each with its own Event loop
+# and Spider.
+#
+# The space of urls is split into shards, one per worker process, by hashing
+# either the whole url or just its netloc.  (Hashing the netloc keeps all the
+# requests to a host in one process, so that they share its connection pool,
+# but then a crawl of a single host can't be spread out.)  Each worker only
+# requests urls in its own shard.  When it finds a link to a url in another
+# shard, it sends it to the coordinator (the parent process), which passes it
+# on to the right worker.  Links are sent in batches, to keep down the number
+# of messages, as (url, depth) tuples, so that the worker knows how far from
+# the root each url was found.  Neither end waits for the other to read what
+# it has sent: each worker reads from its pipe as part of its Event loop, and
+# the coordinator holds on to links until a worker's pipe has room for them.
+#
+# The crawl is over when every worker has run out of things to do, and has
+# handled every batch of links that the coordinator has sent it.  Each worker
+# then sends its results to the coordinator, which merges them.
+
+import argparse
+import collections
+import hashlib
+import multiprocessing
+import select
+
+from frontier import HOST_ORDERS
+from spider4 import Event, Spider
+
+# The number of links to collect for a shard before sending them on
+BATCH_SIZE = 100
+
+def shard_for(url, n_shards, by='url'):
+    # Return the number of the shard that url belongs to.  We use md5 rather
+    # than hash(), so that every process agrees on the answer.
+    if by == 'netloc':
+        key = url.split('/')[2]
+    else:
+        key = url
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % n_shards
+
+class ShardSpider(Spider):
+    def __init__(self, root_url, shard, n_shards, conn, by='url', **kwargs):
+        Spider.__init__(self, root_url, **kwargs)
+        self.shard = shard
+        self.n_shards = n_shards
+        self.by = by
+
+        # The end of the pipe to the coordinator
+        self.conn = conn
+
+        # Maps shard numbers to lists of (url, depth) tuples waiting to be sent
+        # to them
+        self.outgoing = {}
+
+        # The urls in other shards that we've already sent on, so that we
+        # don't send them again
+        self.forwarded = set()
+
+        # The number of batches of links that the coordinator has sent us
+        self.batches_received = 0
+
+    def work(self):
+        # Runs in the worker process
+        self.start(Event())
+
+        # Listen to the coordinator while we crawl, so that it's never stuck
+        # waiting for us to take the links it's passing on (while we might be
+        # waiting for it to take ours).  The loop still finishes when there's
+        # nothing else to do.
+        self.stopping = False
+        self.loop.add_reader(self.conn, self.receive, background=True)
+
+        while True:
+            # Crawl until there's nothing left to do, then pass on any links
+            # for other shards, and tell the coordinator that we're idle
+            self.loop.run()
+            self.flush()
+            self.conn.send(('idle', self.batches_received))
+
+            # Wait for more links, or to be told to stop
+            self.receive()
+            if self.stopping:
+                break
+
+        self.loop.remove_reader(self.conn)
+        self.stop()
+        self.conn.send(('results', self.results))
+
+    def receive(self):
+        # Handle a message from the coordinator
+        message = self.conn.recv()
+        if message[0] == 'links':
+            self.batches_received += 1
+            for url, depth in message[1]:
+                self.maybe_make_request(url, depth)
+        elif message[0] == 'stop':
+            self.stopping = True
+
+    def maybe_make_request(self, url, depth=0):
+        url = self.normalise(url)
+        if url is None:
+            return
+
+        shard = shard_for(url, self.n_shards, self.by)
+        if shard == self.shard:
+            Spider.maybe_make_request(self, url, depth)
+        elif url not in self.forwarded:
+            self.forwarded.add(url)
+            outgoing = self.outgoing.setdefault(shard, [])
+            outgoing.append((url, depth))
+            if len(outgoing) >= BATCH_SIZE:
+                self.flush()
+
+    def flush(self):
+        # Send the links that we've collected for other shards
+        if self.outgoing:
+            self.conn.send(('links', self.outgoing))
+            self.outgoing = {}
+
+def work(root_url, shard, n_shards, conn, by, kwargs):
+    spider = ShardSpider(root_url, shard, n_shards, conn, by, **kwargs)
+    spider.work()
+
+def crawl(root_url, n_workers, by='url', **kwargs):
+    # Crawl from root_url with n_workers processes, and return the merged
+    # results.  Any other arguments are passed on to each worker's Spider.
+    conns = []
+    workers = []
+    for shard in range(n_workers):
+        conn, worker_conn = multiprocessing.Pipe()
+        worker = multiprocessing.Process(
+            target=work,
+            args=(root_url, shard, n_workers, worker_conn, by, kwargs))
+        worker.start()
+        conns.append(conn)
+        workers.append(worker)
+
+    # The number of batches of links we've sent (or are going to send) to each
+    # worker, and whether each worker has told us that it's idle since we last
+    # sent it anything
+    sent = [0] * n_workers
+    idle = [True] * n_workers
+
+    # The batches waiting to be sent to each worker.  We only send to a worker
+    # when its pipe has room, since if we blocked, a worker blocked sending
+    # links to us would never be read from, and the crawl would stop.
+    outgoing = [collections.deque() for shard in range(n_workers)]
+
+    def send_links(shard, urls):
+        outgoing[shard].append(('links', urls))
+        sent[shard] += 1
+        idle[shard] = False
+
+    root_url = Spider(root_url).normalise(root_url)
+    send_links(shard_for(root_url, n_workers, by), [(root_url, 0)])
+
+    while not all(idle):
+        waiting = [conns[shard] for shard in range(n_workers)
+                   if outgoing[shard]]
+        readable, writable, _ = select.select(conns, waiting, [])
+
+        for conn in writable:
+            conn.send(outgoing[conns.index(conn)].popleft())
+
+        for conn in readable:
+            shard = conns.index(conn)
+            message = conn.recv()
+            if message[0] == 'links':
+                for other_shard, urls in message[1].items():
+                    send_links(other_shard, urls)
+            elif message[0] == 'idle':
+                # The worker is only really idle if it has seen everything
+                # we've sent it
+                idle[shard] = message[1] == sent[shard]
+
+    results = {}
+    for conn in conns:
+        conn.send(('stop',))
+    for conn in conns:
+        message = conn.recv()
+        results.update(message[1])
+    for worker in workers:
+        worker.join()
+
+    return results
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('root_url')
+    arg_parser.add_argument('--workers', type=int,
+                            default=multiprocessing.cpu_count(),
+                            help='the number of processes to crawl with')
+    arg_parser.add_argument('--by', choices=['url', 'netloc'], default='url',
+                            help='split urls between processes by hashing '
+                                 'the whole url, or just the netloc')
+    arg_parser.add_argument('--http11', action='store_true',
+                            help='use HTTP/1.1 with keep-alive connections')
+    arg_parser.add_argument('--pipeline', type=int, default=1,
+                            help='with --http11, the number of requests to '
+                                 'send down a connection at once')
+    arg_parser.add_argument('--soup', action='store_true',
+                            help='find links with BeautifulSoup')
+    arg_parser.add_argument('--order', choices=HOST_ORDERS, default='bfs',
+                            help='the order to request each host\'s urls in')
+    arg_parser.add_argument('--max-depth', type=int,
+                            help='the most links to follow away from the root '
+                                 'url')
+    args = arg_parser.parse_args()
+
+    results = crawl(args.root_url, args.workers, by=args.by,
+                    http11=args.http11, pipeline_depth=args.pipeline,
+                    use_soup=args.soup, order=args.order,
+                    max_depth=args.max_depth)
+    print results
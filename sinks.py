@@ -0,0 +1,247 @@
+# sinks.py
+
+# A spider's results used to come out all at once, as the repr of its results
+# dict, when the crawl finished -- which means holding them all in memory until
+# then, and losing them all if the crawl dies.  A sink writes each url's status
+# code to a file (or a pipe) as soon as it's known, so that the results dict
+# only needs to remember which urls we've seen (see CompactResults in seen.py).
+#
+# Writing each record as it comes would mean a system call per url, so a sink
+# collects records in a buffer, and writes them out together once the buffer
+# is big enough, or the oldest record has waited flush_interval seconds, or
+# the sink is closed.  The records mustn't wait longer just because the crawl
+# has stalled, so the waiting is timed by a thread of the sink's own, which is
+# started with the first record.  (Not before, since spider4.py mustn't have
+# threads running when it forks its parse workers.)
+#
+# The formats are:
+#
+#   text    -- "url status" lines, as --results-file has always written
+#   jsonl   -- a JSON object per line, with url and status keys
+#   csv     -- a header line, then url,status lines
+#   binary  -- for each url, its length and the status code's length (as a
+#              little-endian unsigned short and unsigned byte), then the url
+#              and status code themselves; read it back with read_binary()
+#
+# Progress is the other output a crawl makes: the "requesting" and "got
+# response for" lines.  Printing those for every url costs more than the
+# crawling does on a fast network, so it can instead print a summary every so
+# often.
+
+import csv
+import json
+import struct
+import sys
+import threading
+import time
+
+class Sink(object):
+    # Subclasses say how to encode a record, with encode()
+
+    # Write the buffer out once it holds this many bytes
+    BUFFER_SIZE = 65536
+
+    def __init__(self, stream, flush_interval=1.0, clock=time.time):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.clock = clock
+
+        # Encoded records waiting to be written, their total size, and when
+        # the first of them arrived
+        self.buffer = []
+        self.buffered = 0
+        self.first_buffered = None
+
+        # Held while the buffer is touched, since the flushing thread touches
+        # it too
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.closed = threading.Event()
+
+        self.start()
+
+    def start(self):
+        # Called before any records are written, to write a header
+        pass
+
+    def write(self, url, status):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        with self.lock:
+            self.add(self.encode(url, status))
+
+        if self.flusher is None and self.flush_interval:
+            self.flusher = threading.Thread(target=self.flush_when_due)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def add(self, record):
+        # Add an encoded record to the buffer.  Call with the lock held (or
+        # from start()).
+        if not self.buffer:
+            self.first_buffered = self.clock()
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered >= self.BUFFER_SIZE or self.flush_interval == 0:
+            self.write_buffer()
+
+    def flush_when_due(self):
+        # Runs in the flushing thread, until the sink is closed
+        while not self.closed.wait(self.flush_interval / 4.0):
+            with self.lock:
+                if self.buffer and self.clock() - self.first_buffered >= \
+                        self.flush_interval:
+                    self.write_buffer()
+
+    def flush(self):
+        with self.lock:
+            self.write_buffer()
+
+    def write_buffer(self):
+        # Call with the lock held
+        if self.buffer:
+            self.stream.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        self.stream.flush()
+
+    def close(self):
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+        self.stream.close()
+
+class TextSink(Sink):
+    def encode(self, url, status):
+        return '%s %s\n' % (url, status)
+
+class JsonLinesSink(Sink):
+    def encode(self, url, status):
+        return json.dumps({'url': url, 'status': status}) + '\n'
+
+class CsvSink(Sink):
+    def start(self):
+        self.line = LineCatcher()
+        self.writer = csv.writer(self.line, lineterminator='\n')
+        self.add(self.encode('url', 'status'))
+
+    def encode(self, url, status):
+        self.writer.writerow([url, status])
+        return self.line.pop()
+
+class LineCatcher(object):
+    # The csv module only writes to file-like objects, so CsvSink has it write
+    # to one of these, and takes each line back out
+
+    def __init__(self):
+        self.line = None
+
+    def write(self, line):
+        self.line = line
+
+    def pop(self):
+        line, self.line = self.line, None
+        return line
+
+class BinarySink(Sink):
+    HEADER = struct.Struct('<HB')
+
+    def encode(self, url, status):
+        return self.HEADER.pack(len(url), len(status)) + url + status
+
+def read_binary(stream):
+    # Yield (url, status) tuples from a file written by a BinarySink
+    header = BinarySink.HEADER
+    while True:
+        data = stream.read(header.size)
+        if len(data) < header.size:
+            return
+        url_length, status_length = header.unpack(data)
+        yield stream.read(url_length), stream.read(status_length)
+
+SINK_FORMATS = {
+    'text': TextSink,
+    'jsonl': JsonLinesSink,
+    'csv': CsvSink,
+    'binary': BinarySink,
+}
+
+def make_sink(format, path, flush_interval=1.0):
+    # Return a sink writing the given format to the file (or pipe) at path
+    return SINK_FORMATS[format](open(path, 'wb'), flush_interval)
+
+class Progress(object):
+    # Reports how a crawl is going.  With no interval, every request, response
+    # and error gets a line, as the spiders have always printed; otherwise we
+    # just count them, and print a line at most once every interval seconds.
+    # It's safe to share between threads (as spider2.py's do).
+
+    def __init__(self, interval=None, clock=time.time):
+        self.interval = interval
+        self.clock = clock
+        self.requested = 0
+        self.responses = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+        # When we last printed a line, and how many responses we'd had then
+        self.last_report = clock()
+        self.last_responses = 0
+
+    def requesting(self, url):
+        if self.interval is None:
+            self.print_line('requesting %s' % url)
+            return
+        with self.lock:
+            self.requested += 1
+            self.maybe_report()
+
+    def got_response(self, url):
+        if self.interval is None:
+            self.print_line('got response for %s' % url)
+            return
+        with self.lock:
+            self.responses += 1
+            self.maybe_report()
+
+    def error(self, error):
+        if self.interval is None:
+            self.print_line('error: %s' % (error,))
+            return
+        with self.lock:
+            self.errors += 1
+            self.maybe_report()
+
+    def maybe_report(self):
+        # Call with the lock held
+        if self.clock() - self.last_report >= self.interval:
+            self.print_report()
+
+    def report(self):
+        # Print a line now (unless we print a line for everything anyway)
+        if self.interval is None:
+            return
+        with self.lock:
+            self.print_report()
+
+    def print_report(self):
+        now = self.clock()
+        elapsed = now - self.last_report
+        rate = (self.responses - self.last_responses) / elapsed \
+            if elapsed > 0 else 0.0
+        self.print_line('progress: %d requested, %d responses, %d errors, '
+                        '%.1f responses/s' % (self.requested, self.responses,
+                                              self.errors, rate))
+        sys.stdout.flush()
+        self.last_report = now
+        self.last_responses = self.responses
+
+    def print_line(self, line):
+        # Write the line in one go.  print writes each of its arguments (and
+        # the spaces between them) separately, so the lines of threads (or
+        # processes sharing a pipe) printing at once would get mixed up.
+        # (Unlike print, write() doesn't encode unicode for the terminal.)
+        if isinstance(line, unicode):
+            line = line.encode(sys.stdout.encoding or 'utf-8')
+        sys.stdout.write(line + '\n')
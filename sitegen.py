@@ -0,0 +1,143 @@
+# sitegen.py
+
+# lorem/ has ten pages, which is nowhere near enough to see how the spiders
+# behave on a big site.  A SyntheticSite is a site of any size that exists only
+# as a function from paths to responses: nothing is kept on disk, or in memory,
+# and each page is made when it's asked for.  Everything about a page is
+# derived from the site's seed and the page's number, so the same seed always
+# gives the same site.
+#
+# The pages are numbered from 0 (which is also served as /index.html), and
+# page n lives at /page/n.html.  They're arranged in a tree: page n links to
+# its fanout children, pages n * fanout + 1 to n * fanout + fanout, down to
+# depth levels below the root.  Any pages that don't fit in the tree can only
+# be reached through cross_links, which each page has to pages chosen at
+# random, and which also mean that the spiders find most pages more than once.
+#
+# Not every page is a web page.  Some fraction of them are redirects (half 301,
+# half 302) to another page, are missing (404), or aren't HTML (so the spiders
+# shouldn't look for links in them).  The root is always a web page.
+
+import random
+
+# Words to fill pages out with
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+# The content types given to pages that aren't HTML
+OTHER_TYPES = ['text/plain', 'image/png', 'application/pdf']
+
+class SyntheticSite(object):
+    def __init__(self, pages=1000, fanout=10, depth=None, cross_links=2,
+                 page_size=4096, redirect_rate=0.05, missing_rate=0.02,
+                 other_rate=0.05, seed=0):
+        self.pages = pages
+        self.fanout = fanout
+        self.cross_links = cross_links
+        self.page_size = page_size
+        self.redirect_rate = redirect_rate
+        self.missing_rate = missing_rate
+        self.other_rate = other_rate
+        self.seed = seed
+
+        # The number of pages in the tree; the rest are only reached through
+        # cross links.  With no depth given, the tree holds every page.
+        if depth is None:
+            self.tree_size = pages
+        else:
+            self.tree_size = min(pages, sum(fanout ** level
+                                            for level in range(depth + 1)))
+
+    def get(self, path):
+        # Return a tuple: (status code, dict of headers, body), as strings
+        n = self.page_number(path)
+        if n is None:
+            return self.missing()
+
+        rng = self.page_random(n)
+        kind = self.page_kind(n, rng)
+        if kind == 'redirect':
+            status = '301' if rng.random() < 0.5 else '302'
+            target = rng.randrange(self.pages)
+            return status, {'Location': page_path(target),
+                            'Content-Type': 'text/html'}, ''
+        elif kind == 'missing':
+            return self.missing()
+        elif kind == 'other':
+            content_type = rng.choice(OTHER_TYPES)
+            return '200', {'Content-Type': content_type,
+                           'ETag': self.etag(n)}, self.filler(rng, 0)
+
+        body = self.page(n, rng)
+        return '200', {'Content-Type': 'text/html', 'ETag': self.etag(n)}, body
+
+    def page_number(self, path):
+        # Return the number of the page at path, or None if there isn't one
+        if path in ('/', '/index.html'):
+            return 0
+        if not (path.startswith('/page/') and path.endswith('.html')):
+            return None
+        number = path[len('/page/'):-len('.html')]
+        if not number.isdigit() or str(int(number)) != number:
+            return None
+        n = int(number)
+        return n if n < self.pages else None
+
+    def page_random(self, n):
+        # A random number generator for page n, which always gives the same
+        # numbers for the same seed
+        return random.Random('%s:%d' % (self.seed, n))
+
+    def page_kind(self, n, rng):
+        if n == 0:
+            return 'html'
+        x = rng.random()
+        if x < self.redirect_rate:
+            return 'redirect'
+        x -= self.redirect_rate
+        if x < self.missing_rate:
+            return 'missing'
+        x -= self.missing_rate
+        if x < self.other_rate:
+            return 'other'
+        return 'html'
+
+    def links(self, n, rng):
+        # Return the numbers of the pages that page n links to
+        links = []
+        if n < self.tree_size:
+            first = n * self.fanout + 1
+            links.extend(range(first, min(first + self.fanout,
+                                          self.tree_size)))
+        for _ in range(self.cross_links):
+            links.append(rng.randrange(self.pages))
+        return links
+
+    def page(self, n, rng):
+        parts = ['<html><head><title>Page %d</title></head><body>\n' % n]
+        for link in self.links(n, rng):
+            parts.append('<p><a href="%s">Page %d</a></p>\n' %
+                         (page_path(link), link))
+        size = sum(len(part) for part in parts)
+        parts.append(self.filler(rng, size))
+        parts.append('</body></html>\n')
+        return ''.join(parts)
+
+    def filler(self, rng, size):
+        # Return enough words to bring a page of size bytes up to page_size
+        words = []
+        while size < self.page_size:
+            word = rng.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return ' '.join(words)
+
+    def missing(self):
+        return '404', {'Content-Type': 'text/html'}, \
+            '<html><body>Not found</body></html>\n'
+
+    def etag(self, n):
+        return '"%s-%d"' % (self.seed, n)
+
+def page_path(n):
+    return '/page/%d.html' % n
@@ -1,69 +1,317 @@
 # slowserver.py
 
+import argparse
+import collections
+import random
 import sys
 from twisted.internet import reactor
-from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.task import LoopingCall
 from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+from twisted.web import http
+from twisted.web.resource import Resource
 from twisted.web.static import File
 from twisted.web.server import Site
 
+import workers
+from sitegen import SyntheticSite
+
+# Each connection's data is held back, and sent a little at a time, so that the
+# spiders have to cope with responses that trickle in.  Rather than each
+# connection keeping its own timer, a single Throttle serves all of them, a
+# tick at a time: on each tick, every connection with data waiting may send up
+# to its share of the bytes allowed for the tick.  There can be a limit per
+# connection, and one for the server as a whole, which is shared fairly between
+# the connections that have something to send.
+#
+# Each connection queues the pieces of data written to it as they are, and only
+# copies the part of a piece that's sent on a tick, so a big response doesn't
+# get copied over and over as it drains.
+#
+# A response can also be made to wait before its first byte is sent, for a time
+# drawn from a latency distribution (see parse_latency).
+
+class Throttle(object):
+    def __init__(self, tick=0.1, perConnection=None, total=None, latency=None,
+                 clock=reactor):
+        self.tick = tick
+        self.clock = clock
+
+        # The most bytes that a connection, and all connections together, may
+        # send on a tick (or None for no limit)
+        self.perConnection = self.perTick(perConnection)
+        self.total = self.perTick(total)
+
+        # If given, called with no arguments to get the number of seconds to
+        # wait before the first byte of a response
+        self.latency = latency
+
+        # The connections with data waiting to be sent, in the order that
+        # they'll be served.  The order is rotated on each tick, so that no
+        # connection is always first in line for the total allowance.
+        self.waiting = collections.deque()
+
+        self.loop = LoopingCall(self.serve)
+        self.loop.clock = clock
+
+    def perTick(self, rate):
+        if rate is None:
+            return None
+        return max(1, int(rate * self.tick))
+
+    @property
+    def limited(self):
+        return self.perConnection is not None or self.total is not None or \
+            self.latency is not None
+
+    def add(self, protocol):
+        # Called when protocol has data waiting, and wasn't already waiting
+        self.waiting.append(protocol)
+        if not self.loop.running:
+            self.loop.start(self.tick, now=False)
+
+    def remove(self, protocol):
+        try:
+            self.waiting.remove(protocol)
+        except ValueError:
+            pass
+
+    def serve(self):
+        now = self.clock.seconds()
+        ready = [protocol for protocol in self.waiting
+                 if protocol.readyAt <= now]
+        budget = self.total
+
+        for i, protocol in enumerate(ready):
+            allowance = protocol.queued
+            if self.perConnection is not None:
+                allowance = min(allowance, self.perConnection)
+            if budget is not None:
+                if budget <= 0:
+                    break
+                # An equal share of what's left, so that anything that the
+                # connections before this one didn't need goes to the rest
+                allowance = min(allowance, max(1, budget // (len(ready) - i)))
+            sent = protocol.sendUpTo(allowance)
+            if budget is not None:
+                budget -= sent
+
+        self.waiting = collections.deque(protocol for protocol in self.waiting
+                                         if protocol.queued)
+        self.waiting.rotate(-1)
+        for protocol in ready:
+            if not protocol.queued:
+                protocol.drained()
+
+        if not self.waiting:
+            self.loop.stop()
+
 class SlowProtocol(ProtocolWrapper):
     def __init__(self, *args, **kwargs):
         ProtocolWrapper.__init__(self, *args, **kwargs)
-        self.writesOutstanding = False
+        self.throttle = None
         self.loseConnectionWhenReady = False
-        self.writeLimit = None
-        self.buf = ''
 
-    def setWriteLimit(self, limit):
-        self.writeLimit = limit
+        # The pieces of data waiting to be sent, how far into the first piece
+        # we've sent, and the number of bytes still to send
+        self.chunks = collections.deque()
+        self.offset = 0
+        self.queued = 0
+
+        # The time before which we mustn't send anything, and the time we last
+        # sent something
+        self.readyAt = 0
+        self.lastSent = None
+
+    def setThrottle(self, throttle):
+        self.throttle = throttle
 
     def write(self, data):
-        self.buf += data
-        if not self.writesOutstanding:
-            self.actuallyWrite()
-
-    def actuallyWrite(self):
-        if self.writeLimit is None:
-            data = self.buf
-            self.buf = ''
-        else:
-            data = self.buf[:self.writeLimit]
-            self.buf = self.buf[self.writeLimit:]
-
-        ProtocolWrapper.write(self, data)
-
-        if data != '':
-            self.writesOutstanding = True
-            reactor.callLater(1, self.actuallyWrite)
-        else:
-            self.writesOutstanding = False
-            if self.loseConnectionWhenReady:
-                self.actuallyLoseConnection()
+        if not data:
+            return
+        if not self.throttle.limited:
+            ProtocolWrapper.write(self, data)
+            return
+
+        if not self.queued:
+            now = self.throttle.clock.seconds()
+            if self.throttle.latency is not None and (
+                    self.lastSent is None or
+                    now - self.lastSent > self.throttle.tick):
+                # This is the start of a response, rather than more of one
+                # that we've already been sending
+                self.readyAt = now + self.throttle.latency()
+            self.throttle.add(self)
+
+        self.chunks.append(data)
+        self.queued += len(data)
+
+    def writeSequence(self, data):
+        for piece in data:
+            self.write(piece)
+
+    def sendUpTo(self, limit):
+        # Send up to limit bytes of the data waiting, and return the number
+        # sent
+        pieces = []
+        sent = 0
+        while self.chunks and sent < limit:
+            chunk = self.chunks[0]
+            n = min(len(chunk) - self.offset, limit - sent)
+            if self.offset == 0 and n == len(chunk):
+                pieces.append(chunk)
+            else:
+                pieces.append(chunk[self.offset:self.offset + n])
+            self.offset += n
+            if self.offset == len(chunk):
+                self.chunks.popleft()
+                self.offset = 0
+            sent += n
+
+        if pieces:
+            ProtocolWrapper.writeSequence(self, pieces)
+            self.queued -= sent
+            self.lastSent = self.throttle.clock.seconds()
+        return sent
+
+    def drained(self):
+        # Called by the throttle once everything queued has been sent
+        if self.loseConnectionWhenReady:
+            self.actuallyLoseConnection()
 
     def loseConnection(self):
         self.loseConnectionWhenReady = True
-        if not self.writesOutstanding:
+        if not self.queued:
             self.actuallyLoseConnection()
 
     def actuallyLoseConnection(self):
         ProtocolWrapper.loseConnection(self)
 
+    def connectionLost(self, reason):
+        self.throttle.remove(self)
+        ProtocolWrapper.connectionLost(self, reason)
+
 class SlowFactory(WrappingFactory):
     protocol = SlowProtocol
 
-    def __init__(self, wrappedFactory, writeLimit):
+    def __init__(self, wrappedFactory, throttle):
         WrappingFactory.__init__(self, wrappedFactory)
-        self.writeLimit = writeLimit
+        self.throttle = throttle
 
     def buildProtocol(self, addr):
         protocol = WrappingFactory.buildProtocol(self, addr)
-        protocol.setWriteLimit(self.writeLimit)
+        protocol.setThrottle(self.throttle)
         return protocol
 
+def parse_latency(spec):
+    # Turn a latency distribution, given as one of
+    #   fixed:SECONDS
+    #   uniform:MIN,MAX
+    #   exp:MEAN
+    #   normal:MEAN,STDDEV
+    # into a function that returns a number of seconds drawn from it
+    kind, _, params = spec.partition(':')
+    try:
+        params = [float(param) for param in params.split(',')]
+        if kind == 'fixed' and len(params) == 1:
+            return lambda: params[0]
+        elif kind == 'uniform' and len(params) == 2:
+            return lambda: random.uniform(*params)
+        elif kind == 'exp' and len(params) == 1 and params[0] > 0:
+            return lambda: random.expovariate(1 / params[0])
+        elif kind == 'normal' and len(params) == 2:
+            return lambda: max(0, random.gauss(*params))
+    except ValueError:
+        pass
+    raise ValueError('invalid latency distribution: %r' % spec)
+
+class SyntheticResource(Resource):
+    # Serves a SyntheticSite (see sitegen.py), rather than files
+    isLeaf = True
+
+    def __init__(self, site):
+        Resource.__init__(self)
+        self.site = site
+
+    def render_GET(self, request):
+        status, headers, body = self.site.get(request.path)
+        request.setResponseCode(int(status))
+        for name, value in headers.items():
+            request.setHeader(name, value)
+        if status == '200' and \
+                request.setETag(headers['ETag']) == http.CACHED:
+            # The page hasn't changed since the client last saw it
+            return ''
+        return body
+
 if __name__ == '__main__':
-    resource = File(sys.argv[1])
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('root', nargs='?',
+                            help='the directory to serve (unless --pages is '
+                                 'given)')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--write-limit', type=int, default=2048,
+                            help='the most bytes to send on a connection each '
+                                 'second (0 for no limit)')
+    arg_parser.add_argument('--total-limit', type=int,
+                            help='the most bytes to send on all connections '
+                                 'together each second')
+    arg_parser.add_argument('--tick', type=float, default=0.1,
+                            help='how often, in seconds, to send data')
+    arg_parser.add_argument('--latency',
+                            help='how long to wait before sending the first '
+                                 'byte of each response, as fixed:SECONDS, '
+                                 'uniform:MIN,MAX, exp:MEAN or '
+                                 'normal:MEAN,STDDEV')
+    workers.add_arguments(arg_parser)
+    arg_parser.add_argument('--pages', type=int,
+                            help='serve a generated site with this many pages, '
+                                 'rather than a directory')
+    arg_parser.add_argument('--fanout', type=int, default=10,
+                            help='the number of pages below each page in the '
+                                 'generated site\'s tree')
+    arg_parser.add_argument('--depth', type=int,
+                            help='the most levels in the tree below the root '
+                                 '(pages that don\'t fit are only reached '
+                                 'through cross links)')
+    arg_parser.add_argument('--cross-links', type=int, default=2,
+                            help='the number of links from each page to pages '
+                                 'chosen at random')
+    arg_parser.add_argument('--page-size', type=int, default=4096,
+                            help='the size of each page, in bytes')
+    arg_parser.add_argument('--redirect-rate', type=float, default=0.05,
+                            help='the fraction of pages that are redirects')
+    arg_parser.add_argument('--missing-rate', type=float, default=0.02,
+                            help='the fraction of pages that are missing')
+    arg_parser.add_argument('--other-rate', type=float, default=0.05,
+                            help='the fraction of pages that aren\'t HTML')
+    arg_parser.add_argument('--seed', default='0',
+                            help='generated sites with the same seed are the '
+                                 'same')
+    args = arg_parser.parse_args()
+    if args.pages is None and args.root is None:
+        arg_parser.error('give a directory to serve, or --pages')
+    try:
+        latency = parse_latency(args.latency) if args.latency else None
+    except ValueError as e:
+        arg_parser.error(str(e))
+
+    if args.workers > 1:
+        sys.exit(workers.run_workers(args.workers, args.port))
+
+    if args.pages is not None:
+        site = SyntheticSite(
+            args.pages, fanout=args.fanout, depth=args.depth,
+            cross_links=args.cross_links, page_size=args.page_size,
+            redirect_rate=args.redirect_rate, missing_rate=args.missing_rate,
+            other_rate=args.other_rate, seed=args.seed)
+        resource = SyntheticResource(site)
+    else:
+        resource = File(args.root)
+
+    # With --workers, each worker has its own throttle, so --total-limit
+    # applies to each of them separately
     factory = Site(resource)
-    endpoint = TCP4ServerEndpoint(reactor, 8080)
-    endpoint.listen(SlowFactory(factory, 2048))
+    throttle = Throttle(args.tick, args.write_limit or None, args.total_limit,
+                        latency)
+    workers.listen(reactor, args.port, SlowFactory(factory, throttle), args)
     reactor.run()
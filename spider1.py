@@ -8,83 +8,183 @@
 # parallel with threads (spider2.py) and via asynchronous I/O (spider3.py,
 # spider4.py).
 
-import re
+import argparse
 import socket
-import sys
 import urlparse
 
-from bs4 import BeautifulSoup
+from cache import ResponseCache
+from frontier import ORDERS, make_frontier
+from httpparser import ResponseParser
+from links import LinkExtractor, soup_links
+from resolver import Resolver
+from seen import SEEN_KINDS, make_results
+from sinks import SINK_FORMATS, Progress, make_sink
+from store import CrawlStore
+
+# The most data to read from a socket at once
+RECV_SIZE = 65536
 
 class Spider(object):
-    def __init__(self, root_url):
+    def __init__(self, root_url, use_soup=False, order='bfs', max_depth=None,
+                 store=None, resume=False, results=None, cache=None,
+                 progress=None):
+        self.root_url = root_url
         netloc, path = parse_url(root_url)
         self.netloc = netloc
 
-        # Maps urls to the status code returned when requesting that url
-        self.results = {}
+        # Whether to find links with BeautifulSoup, rather than LinkExtractor
+        self.use_soup = use_soup
+
+        # Looks up hostnames, remembering the answers
+        self.resolver = Resolver()
+
+        # Maps urls to the status code returned when requesting that url.
+        # (Or, if results is given, something that looks enough like a dict
+        # for our purposes, but takes less memory -- see seen.py.)
+        self.results = results if results is not None else {}
+
+        # If given, the state of the crawl is kept in store, so that it can be
+        # resumed if we die (see store.py)
+        self.store = store
+
+        # The urls that we have seen but have not yet requested, with how
+        # many links away from root_url each was found (see frontier.py)
+        self.outstanding = make_frontier(order, max_depth, store)
+
+        if resume:
+            self.resume()
+        else:
+            if store is not None:
+                store.clear()
+            self.outstanding.push(root_url, 0)
+
+        # How many links away from root_url the page we're requesting is
+        self.depth = 0
 
-        # A list of urls that we have seen but have not yet requested
-        self.outstanding = [root_url]
+        # If given, a ResponseCache, which lets us skip downloading pages that
+        # haven't changed since the last crawl (see cache.py)
+        self.cache = cache
+
+        # The links found so far in the page we're requesting
+        self.links = []
+
+        # Tells us how the crawl is going; by default, with a line for every
+        # request (see sinks.py)
+        self.progress = progress if progress is not None else Progress()
 
     def run(self):
         while self.outstanding:
-            url = self.outstanding.pop()
-            self.maybe_make_request(url)
+            url, depth = self.outstanding.pop()
+            self.maybe_make_request(url, depth)
 
+        if self.store is not None:
+            self.store.checkpoint()
+        if self.cache is not None:
+            self.cache.close()
+
+        self.progress.report()
         print self.results
 
-    def maybe_make_request(self, url):
+    def resume(self):
+        # Carry on with the crawl saved in the store.  If the crawl died before
+        # its first checkpoint, nothing was saved, so start it again.
+        results, pending = self.store.load()
+        if not results and not pending:
+            pending = [(self.root_url, 0)]
+        self.results.update(results)
+        for url, depth in pending:
+            self.outstanding.push(url, depth)
+
+    def maybe_make_request(self, url, depth):
         url = self.normalise(url)
         if url is None or url in self.results:
             # Either the url was a fragment, or we've already requested it
             return
 
+        self.depth = depth
+        self.links = []
         self.make_request(url)
 
+    def found_link(self, link):
+        # Called with each link in the page we're requesting
+        self.links.append(link)
+        self.outstanding.push(link, self.depth + 1)
+
     def make_request(self, url):
-        print 'requesting', url
+        self.progress.requesting(url)
         self.results[url] = None
+        if self.store is not None:
+            self.store.claim(url, self.depth)
 
         try:
             netloc, path = parse_url(url)
             sock = self.make_connection(netloc)
-            self.send_request(sock, netloc, path)
-            response = self.get_response(sock)
+            if self.cache is not None:
+                headers = self.cache.request_headers(url)
+            else:
+                headers = ''
+            self.send_request(sock, netloc, path, headers)
+            response = self.get_response(url, sock)
             self.handle_response(url, response)
         except socket.error as e:
-            print 'error:', e
+            self.progress.error(e)
             return None
 
     def make_connection(self, netloc):
         hostname, port = parse_netloc(netloc)
-        host = socket.gethostbyname(hostname)
+        host = self.resolver.resolve(hostname)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((host, port))
         return sock
 
-    def send_request(self, sock, hostname, path):
+    def send_request(self, sock, hostname, path, headers=''):
+        # headers holds any extra header lines
         sock.send('GET %s HTTP/1.0\r\n' % path.encode('utf-8'))
         sock.send('Host: %s\r\n' % hostname)
+        sock.send(headers)
         sock.send('\r\n')
 
-    def get_response(self, sock):
-        response = ''
+    def get_response(self, url, sock):
+        # Feed data to a parser as it arrives.  As soon as the headers are in,
+        # the parser checks with us whether we want the rest of the response.
+        on_headers = lambda parser: self.check_headers(url, parser)
+        parser = ResponseParser(on_headers=on_headers)
 
         while True:
-            data = sock.recv(1024)
+            data = sock.recv(RECV_SIZE)
             if not data:
                 # Zero bytes received
-                sock.close()
+                parser.feed_eof()
                 break
-            else:
-                response += data
+            elif parser.feed(data):
+                break
+
+        sock.close()
+        return parser
 
-        return response
+    def check_headers(self, url, parser):
+        # If we're not going to look at the body of the response, there's no
+        # point downloading it
+        if not self.wants_body(url, parser):
+            parser.abort()
+        elif not self.use_soup:
+            # Find the links in the page as it arrives
+            parser.on_body = LinkExtractor(self.found_link).feed
+
+    def wants_body(self, url, parser):
+        # We only look at the body of web pages on the original host (see
+        # handle_200)
+        netloc, _ = parse_url(url)
+        return parser.status_code == '200' and netloc == self.netloc and \
+            parser.get_header('Content-Type') == 'text/html'
 
     def handle_response(self, url, response):
-        print 'got response for', url
+        self.progress.got_response(url)
         response = self.parse_response(response)
         self.results[url] = response['status_code']
+        if self.store is not None:
+            self.store.record(url, response['status_code'])
+            self.store.maybe_checkpoint()
         try:
             method = getattr(self, 'handle_%s' % response['status_code'])
         except AttributeError:
@@ -92,43 +192,55 @@ class Spider(object):
         else:
             method(url, response)
 
-    def parse_response(self, response):
-        status_plus_headers, text = response.split('\r\n\r\n', 1)
-        lines = status_plus_headers.split('\r\n')
+    def parse_response(self, parser):
+        # The parser has already done the hard work
+        if not parser.complete and not parser.aborted:
+            raise socket.error(parser.error or 'connection closed before '
+                                               'response was complete')
 
-        status_code = re.match('HTTP/1.[01] (\d{3})', lines[0]).groups()[0]
-
-        headers = {}
-
-        for line in lines[1:]:
-            key, val = line.split(':', 1)
-            headers[key.strip()] = val.strip()
-
-        return {'status_code': status_code,
-                'headers': headers,
-                'text': text}
+        return {'status_code': parser.status_code,
+                'headers': parser.headers,
+                'text': parser.body}
 
     def handle_200(self, url, response):
         netloc, _ = parse_url(url)
         if netloc == self.netloc and \
                 response['headers']['Content-Type'] == 'text/html':
             # This is a response to a request for a url on the same host as the
-            # original request, and the response is a web page
-            soup = BeautifulSoup(response['text'])
-            for link in soup.find_all('a'):
-                # Make requests for all urls linked to in page body
-                self.outstanding.append(link.get('href'))
+            # original request, and the response is a web page.  (Unless we're
+            # using BeautifulSoup, we'll have found the links in the page as it
+            # arrived -- see check_headers.)
+            if self.use_soup:
+                for link in soup_links(response['text']):
+                    # Make requests for all urls linked to in page body
+                    self.found_link(link)
+
+            if self.cache is not None:
+                self.cache.put(url, response['headers'], self.links)
+
+    def handle_304(self, url, response):
+        # The page hasn't changed since we last downloaded it, so follow the
+        # links that we found in it then
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None:
+            for link in entry[2]:
+                self.found_link(link)
 
     def handle_301(self, url, response):
-        # Make request for location of permanently-moved resource
-        self.outstanding.append(response['headers']['Location'])
+        # Make request for location of permanently-moved resource.  (This
+        # isn't a link to a new page, so it doesn't take us any deeper.)
+        self.outstanding.push(response['headers']['Location'], self.depth)
 
     def handle_302(self, url, response):
         # Make request for location of temporarily-moved resource
-        self.outstanding.append(response['headers']['Location'])
+        self.outstanding.push(response['headers']['Location'], self.depth)
 
     def normalise(self, url):
-        netloc, path = parse_url(url)
+        try:
+            netloc, path = parse_url(url)
+        except ValueError:
+            # url is malformed (eg its port isn't a number)
+            return None
         if not netloc and not path:
             # url was a fragment
             return None
@@ -154,5 +266,70 @@ def parse_netloc(netloc):
         return netloc, 80
 
 if __name__ == '__main__':
-    spider = Spider(sys.argv[1])
-    spider.run()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('root_url')
+    arg_parser.add_argument('--soup', action='store_true',
+                            help='find links with BeautifulSoup')
+    arg_parser.add_argument('--order', choices=ORDERS, default='bfs',
+                            help='the order to request urls in')
+    arg_parser.add_argument('--max-depth', type=int,
+                            help='the most links to follow away from the root '
+                                 'url')
+    arg_parser.add_argument('--seen', choices=SEEN_KINDS, default='dict',
+                            help='how to remember the urls we\'ve seen: a '
+                                 'dict of urls to status codes, or (to save '
+                                 'memory) a set of fingerprints or a Bloom '
+                                 'filter')
+    arg_parser.add_argument('--expected-urls', type=int, default=1000000,
+                            help='with --seen bloom, the number of urls to '
+                                 'size the filter for')
+    arg_parser.add_argument('--error-rate', type=float, default=0.001,
+                            help='with --seen bloom, the fraction of new urls '
+                                 'we can afford to wrongly skip')
+    arg_parser.add_argument('--results-file',
+                            help='write each url and its status code to this '
+                                 'file (or pipe) as they come in, rather than '
+                                 'printing them all at the end')
+    arg_parser.add_argument('--results-format', choices=sorted(SINK_FORMATS),
+                            default='text',
+                            help='the format to write the --results-file in')
+    arg_parser.add_argument('--flush-interval', type=float, default=1.0,
+                            help='the most seconds to hold results in memory '
+                                 'before writing them to the --results-file')
+    arg_parser.add_argument('--state',
+                            help='keep the state of the crawl in this file, '
+                                 'so that it can be resumed')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='carry on with the crawl saved in the '
+                                 '--state file')
+    arg_parser.add_argument('--cache',
+                            help='remember the links in each page in this '
+                                 'file, and on later runs, only download pages '
+                                 'that have changed')
+    arg_parser.add_argument('--progress', type=float, metavar='SECONDS',
+                            help='rather than a line for every request, print '
+                                 'how the crawl is going every this many '
+                                 'seconds')
+    args = arg_parser.parse_args()
+    if args.resume and not args.state:
+        arg_parser.error('--resume needs --state')
+
+    store = CrawlStore(args.state) if args.state else None
+    cache = ResponseCache(args.cache) if args.cache else None
+    if args.results_file:
+        sink = make_sink(args.results_format, args.results_file,
+                         args.flush_interval)
+    else:
+        sink = None
+    results = make_results(args.seen, args.expected_urls, args.error_rate,
+                           sink)
+
+    spider = Spider(args.root_url, use_soup=args.soup, order=args.order,
+                    max_depth=args.max_depth, store=store, resume=args.resume,
+                    results=results, cache=cache,
+                    progress=Progress(args.progress))
+    try:
+        spider.run()
+    finally:
+        if sink is not None:
+            sink.close()
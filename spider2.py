@@ -5,116 +5,335 @@
 # for urls one at a time.  The threads recieve work via a queue.
 
 # This approach, is much faster than spider1.py.  But threading has its own
-# problems -- can you spot the threading-related bug in this code? -- and we'll
-# see an alternative approach in spider3.py.
+# problems.  An earlier version of this code checked whether a url had already
+# been requested, and then recorded that it was being requested, as two
+# separate steps -- so two threads could both decide to request the same url.
+# (Now, see Results.claim().)  We'll see an alternative approach in spider3.py.
 
-import Queue
-import re
+import argparse
 import socket
-import sys
 import threading
 import urlparse
 
-from bs4 import BeautifulSoup
+from cache import ResponseCache
+from frontier import ORDERS, FrontierQueue, make_frontier
+from httpparser import ResponseParser
+from links import LinkExtractor, soup_links
+from pool import ConnectionPool
+from resolver import Resolver
+from seen import SEEN_KINDS, make_results
+from sinks import SINK_FORMATS, Progress, make_sink
+from store import CrawlStore
+
+# The most data to read from a socket at once
+RECV_SIZE = 65536
+
+# The largest unwanted response body that we'll read, rather than closing the
+# connection
+DRAIN_LIMIT = 16384
+
+# The number of locks that Results shares out urls between
+N_STRIPES = 64
+
+class Results(dict):
+    # Maps urls to the status code returned when requesting that url, and
+    # lets threads claim urls to request.
+    #
+    # Checking whether a url is in the dict and then adding it has to happen
+    # atomically, or two threads could both claim the same url.  Rather than
+    # having one lock that every thread contends for, each url is protected by
+    # one of several locks ("lock striping"), chosen by hashing the url.
+
+    def __init__(self):
+        dict.__init__(self)
+        self.locks = [threading.Lock() for _ in range(N_STRIPES)]
+
+    def claim(self, url):
+        # Record that url is being requested, and return True, unless it has
+        # already been claimed, in which case return False
+        with self.locks[hash(url) % N_STRIPES]:
+            if url in self:
+                return False
+            self[url] = None
+            return True
 
 class Spider(object):
-    def __init__(self, root_url, n_threads=5):
+    def __init__(self, root_url, n_threads=5, http11=False, use_soup=False,
+                 order='bfs', max_depth=None, store=None, resume=False,
+                 results=None, cache=None, progress=None):
+        self.root_url = root_url
         netloc, path = parse_url(root_url)
         self.netloc = netloc
 
-        # Maps urls to the status code returned when requesting that url
-        self.results = {}
+        # Whether to find links with BeautifulSoup, rather than LinkExtractor
+        self.use_soup = use_soup
 
-        # A queue containing urls that we have seen but have not yet requested
-        self.outstanding = Queue.Queue()
-        self.outstanding.put(root_url)
+        # With HTTP/1.1, the threads share a pool of keep-alive connections,
+        # which are reused for requests to the same host
+        if http11:
+            self.pool = ConnectionPool(max_active=n_threads, max_idle=n_threads,
+                                       idle_timeout=30)
+        else:
+            self.pool = None
+
+        # Maps urls to the status code returned when requesting that url.
+        # (Or, if results is given, something that looks enough like Results
+        # for our purposes, but takes less memory -- see seen.py.)
+        self.results = results if results is not None else Results()
+
+        # Looks up hostnames, sharing answers between threads
+        self.resolver = Resolver()
+
+        # If given, the state of the crawl is kept in store, so that it can be
+        # resumed if we die (see store.py)
+        self.store = store
+
+        # If given, a ResponseCache, which lets us skip downloading pages that
+        # haven't changed since the last crawl (see cache.py)
+        self.cache = cache
+
+        # A queue containing urls that we have seen but have not yet requested,
+        # with how many links away from root_url each was found, in the order
+        # given by a frontier (see frontier.py).  The queue also keeps count
+        # of the urls that have been put on it but not yet dealt with (see
+        # Queue.task_done()), which tells us when the crawl is finished.
+        self.outstanding = FrontierQueue(make_frontier(order, max_depth,
+                                                       store))
+
+        if resume:
+            self.resume()
+        else:
+            if store is not None:
+                store.clear()
+            self.outstanding.put((root_url, 0))
+
+        # Tells us how the crawl is going; by default, with a line for every
+        # request (see sinks.py)
+        self.progress = progress if progress is not None else Progress()
 
         # Threads that will do the work
         self.threads = [self.build_thread() for _ in range(n_threads)]
 
     def build_thread(self):
-        return SpiderThread(self.netloc, self.results, self.outstanding)
+        return SpiderThread(self.netloc, self.results, self.outstanding,
+                            self.resolver, self.pool, self.use_soup,
+                            self.store, self.cache, self.progress)
+
+    def resume(self):
+        # Carry on with the crawl saved in the store.  If the crawl died before
+        # its first checkpoint, nothing was saved, so start it again.
+        results, pending = self.store.load()
+        if not results and not pending:
+            pending = [(self.root_url, 0)]
+        self.results.update(results)
+        for url, depth in pending:
+            self.outstanding.put((url, depth))
 
     def run(self):
         # Start all the threads
         for thread in self.threads:
             thread.start()
 
-        # Wait for all the threads to finish
+        # Wait until every url put on the queue has been dealt with.  Since a
+        # thread puts the links it finds on the queue before it marks the page
+        # they were found on as done, this only happens when there's nothing
+        # left to crawl.
+        if self.store is None:
+            self.outstanding.join()
+        else:
+            self.join_with_checkpoints()
+
+        # Tell the threads to stop, and wait for them to finish
+        for thread in self.threads:
+            self.outstanding.put(None)
         for thread in self.threads:
             thread.join()
 
+        if self.pool is not None:
+            self.pool.close()
+        if self.store is not None:
+            self.store.checkpoint()
+        if self.cache is not None:
+            self.cache.close()
+
+        self.progress.report()
         print self.results
 
+    def join_with_checkpoints(self):
+        # Like self.outstanding.join(), but save the state of the crawl every
+        # so often while we wait.  This holds the queue's lock (which
+        # all_tasks_done uses) while saving, so that the threads can't change
+        # the frontier part way through.
+        with self.outstanding.all_tasks_done:
+            while self.outstanding.unfinished_tasks:
+                self.outstanding.all_tasks_done.wait(self.store.interval)
+                self.store.maybe_checkpoint()
+
 class SpiderThread(threading.Thread):
-    def __init__(self, netloc, results, outstanding):
+    def __init__(self, netloc, results, outstanding, resolver, pool,
+                 use_soup, store, cache, progress):
         self.netloc = netloc
+        self.use_soup = use_soup
         self.results = results
         self.outstanding = outstanding
+        self.resolver = resolver
+        self.pool = pool
+        self.store = store
+        self.cache = cache
+        self.progress = progress
         threading.Thread.__init__(self)
 
+        # How many links away from the root url the page this thread is
+        # requesting is, and the links found in it so far
+        self.depth = 0
+        self.links = []
+
     def run(self):
         while True:
-            try:
-                # Wait for up to 10 seconds to pull url off queue
-                url = self.outstanding.get(True, 10)
-            except Queue.Empty:
+            # Wait for a url to be put on the queue.  None means that the crawl
+            # is over.
+            item = self.outstanding.get()
+            if item is None:
                 break
 
-            self.maybe_make_request(url)
+            try:
+                self.maybe_make_request(*item)
+            finally:
+                self.outstanding.task_done()
 
-    def maybe_make_request(self, url):
+    def maybe_make_request(self, url, depth):
         url = self.normalise(url)
-        if url is None or url in self.results:
+        if url is None or not self.results.claim(url):
             # Either the url was a fragment, or we've already requested it
             return
 
+        if self.store is not None:
+            self.store.claim(url, depth)
+
+        self.depth = depth
+        self.links = []
         self.make_request(url)
 
+    def found_link(self, link):
+        # Called with each link in the page this thread is requesting
+        self.links.append(link)
+        self.outstanding.put((link, self.depth + 1))
+
     def make_request(self, url):
-        print 'requesting', url
-        self.results[url] = None
+        self.progress.requesting(url)
 
         try:
             netloc, path = parse_url(url)
-            sock = self.make_connection(netloc)
-            self.send_request(sock, netloc, path)
-            response = self.get_response(sock)
+            if self.cache is not None:
+                headers = self.cache.request_headers(url)
+            else:
+                headers = ''
+            if self.pool is None:
+                sock = self.make_connection(netloc)
+                self.send_request(sock, netloc, path, 'HTTP/1.0', headers)
+                parser = self.get_response(url, sock)
+                sock.close()
+            else:
+                parser = self.fetch(url, netloc, path, headers)
+            response = self.parse_response(parser)
             self.handle_response(url, response)
         except socket.error as e:
-            print 'error:', e
+            self.progress.error(e)
             return None
 
     def make_connection(self, netloc):
         hostname, port = parse_netloc(netloc)
-        host = socket.gethostbyname(hostname)
+        host = self.resolver.resolve(hostname)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((host, port))
         return sock
 
-    def send_request(self, sock, hostname, path):
-        sock.send('GET %s HTTP/1.0\r\n' % path.encode('utf-8'))
-        sock.send('Host: %s\r\n' % hostname)
-        sock.send('\r\n')
+    def fetch(self, url, netloc, path, headers=''):
+        # Make a request over a pooled HTTP/1.1 connection, and return the
+        # parser that read the response
+        while True:
+            sock = self.pool.checkout(netloc)
+            reused = sock is not None
 
-    def get_response(self, sock):
-        response = ''
+            try:
+                if not reused:
+                    sock = self.make_connection(netloc)
+                self.send_request(sock, netloc, path, 'HTTP/1.1', headers)
+                parser = self.get_response(url, sock)
+            except socket.error:
+                self.pool.discard(netloc, sock)
+                if reused:
+                    # The server probably closed the connection while it was
+                    # idle, so try again
+                    continue
+                raise
+
+            if not parser.done and reused and not parser.started:
+                self.pool.discard(netloc, sock)
+                continue
+
+            if parser.complete and parser.keep_alive:
+                self.pool.checkin(netloc, sock)
+            else:
+                self.pool.discard(netloc, sock)
+
+            return parser
+
+    def send_request(self, sock, hostname, path, version, headers=''):
+        # Send the whole request at once.  (Sent in pieces, on a keep-alive
+        # connection, each piece but the first waits for the server to
+        # acknowledge the one before -- Nagle's algorithm -- and the server
+        # holds back its acknowledgement in case it has something to send.)
+        # headers holds any extra header lines.
+        sock.sendall('GET %s %s\r\nHost: %s\r\n%s\r\n' % (
+            path.encode('utf-8'), version, hostname, headers))
+
+    def get_response(self, url, sock):
+        # Feed data to a parser as it arrives, until it's done with the
+        # response, or the server closes the connection.  As soon as the
+        # headers are in, the parser checks with us whether we want the rest of
+        # the response.
+        on_headers = lambda parser: self.check_headers(url, parser)
+        parser = ResponseParser(on_headers=on_headers)
 
         while True:
-            data = sock.recv(1024)
+            data = sock.recv(RECV_SIZE)
             if not data:
                 # Zero bytes received
-                sock.close()
-                break
-            else:
-                response += data
+                parser.feed_eof()
+                return parser
+            if parser.feed(data):
+                return parser
+
+    def check_headers(self, url, parser):
+        # If we're not going to look at the body of the response, there's no
+        # point keeping it.  And unless it's small enough that reading it is
+        # cheaper than opening a new connection, there's no point downloading
+        # it either.
+        if self.wants_body(url, parser):
+            if not self.use_soup:
+                # Find the links in the page as it arrives
+                parser.on_body = LinkExtractor(self.found_link).feed
+            return
+
+        if parser.keep_alive and parser.content_length is not None and \
+                parser.content_length <= DRAIN_LIMIT:
+            parser.skip_body()
+        else:
+            parser.abort()
 
-        return response
+    def wants_body(self, url, parser):
+        # We only look at the body of web pages on the original host (see
+        # handle_200)
+        netloc, _ = parse_url(url)
+        return parser.status_code == '200' and netloc == self.netloc and \
+            parser.get_header('Content-Type') == 'text/html'
 
     def handle_response(self, url, response):
-        print 'got response for', url
-        response = self.parse_response(response)
+        self.progress.got_response(url)
         self.results[url] = response['status_code']
+        if self.store is not None:
+            self.store.record(url, response['status_code'])
         try:
             method = getattr(self, 'handle_%s' % response['status_code'])
         except AttributeError:
@@ -122,43 +341,55 @@ class SpiderThread(threading.Thread):
         else:
             method(url, response)
 
-    def parse_response(self, response):
-        status_plus_headers, text = response.split('\r\n\r\n', 1)
-        lines = status_plus_headers.split('\r\n')
-
-        status_code = re.match('HTTP/1.[01] (\d{3})', lines[0]).groups()[0]
-
-        headers = {}
-
-        for line in lines[1:]:
-            key, val = line.split(':', 1)
-            headers[key.strip()] = val.strip()
+    def parse_response(self, parser):
+        # The parser has already done the hard work
+        if not parser.complete and not parser.aborted:
+            raise socket.error(parser.error or 'connection closed before '
+                                               'response was complete')
 
-        return {'status_code': status_code,
-                'headers': headers,
-                'text': text}
+        return {'status_code': parser.status_code,
+                'headers': parser.headers,
+                'text': parser.body}
 
     def handle_200(self, url, response):
         netloc, _ = parse_url(url)
         if netloc == self.netloc and \
                 response['headers']['Content-Type'] == 'text/html':
             # This is a response to a request for a url on the same host as the
-            # original request, and the response is a web page
-            soup = BeautifulSoup(response['text'])
-            for link in soup.find_all('a'):
-                # Make requests for all urls linked to in page body
-                self.outstanding.put(link.get('href'))
+            # original request, and the response is a web page.  (Unless we're
+            # using BeautifulSoup, we'll have found the links in the page as it
+            # arrived -- see check_headers.)
+            if self.use_soup:
+                for link in soup_links(response['text']):
+                    # Make requests for all urls linked to in page body
+                    self.found_link(link)
+
+            if self.cache is not None:
+                self.cache.put(url, response['headers'], self.links)
+
+    def handle_304(self, url, response):
+        # The page hasn't changed since we last downloaded it, so follow the
+        # links that we found in it then
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None:
+            for link in entry[2]:
+                self.found_link(link)
 
     def handle_301(self, url, response):
-        # Make request for location of permanently-moved resource
-        self.outstanding.put(response['headers']['Location'])
+        # Make request for location of permanently-moved resource.  (This
+        # isn't a link to a new page, so it doesn't take us any deeper.)
+        self.outstanding.put((response['headers']['Location'], self.depth))
 
     def handle_302(self, url, response):
         # Make request for location of temporarily-moved resource
-        self.outstanding.put(response['headers']['Location'])
+        self.outstanding.put((response['headers']['Location'], self.depth))
 
     def normalise(self, url):
-        netloc, path = parse_url(url)
+        try:
+            netloc, path = parse_url(url)
+        except ValueError:
+            # url is malformed (eg its port isn't a number)
+            return None
         if not netloc and not path:
             return None
         return 'http://' + (netloc or self.netloc) + path
@@ -183,5 +414,75 @@ def parse_netloc(netloc):
         return netloc, 80
 
 if __name__ == '__main__':
-    spider = Spider(sys.argv[1])
-    spider.run()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('root_url')
+    arg_parser.add_argument('--threads', type=int, default=5,
+                            help='the number of threads to make requests with')
+    arg_parser.add_argument('--http11', action='store_true',
+                            help='use HTTP/1.1 with keep-alive connections')
+    arg_parser.add_argument('--soup', action='store_true',
+                            help='find links with BeautifulSoup')
+    arg_parser.add_argument('--order', choices=ORDERS, default='bfs',
+                            help='the order to request urls in')
+    arg_parser.add_argument('--max-depth', type=int,
+                            help='the most links to follow away from the root '
+                                 'url')
+    arg_parser.add_argument('--seen', choices=SEEN_KINDS, default='dict',
+                            help='how to remember the urls we\'ve seen: a '
+                                 'dict of urls to status codes, or (to save '
+                                 'memory) a set of fingerprints or a Bloom '
+                                 'filter')
+    arg_parser.add_argument('--expected-urls', type=int, default=1000000,
+                            help='with --seen bloom, the number of urls to '
+                                 'size the filter for')
+    arg_parser.add_argument('--error-rate', type=float, default=0.001,
+                            help='with --seen bloom, the fraction of new urls '
+                                 'we can afford to wrongly skip')
+    arg_parser.add_argument('--results-file',
+                            help='write each url and its status code to this '
+                                 'file (or pipe) as they come in, rather than '
+                                 'printing them all at the end')
+    arg_parser.add_argument('--results-format', choices=sorted(SINK_FORMATS),
+                            default='text',
+                            help='the format to write the --results-file in')
+    arg_parser.add_argument('--flush-interval', type=float, default=1.0,
+                            help='the most seconds to hold results in memory '
+                                 'before writing them to the --results-file')
+    arg_parser.add_argument('--state',
+                            help='keep the state of the crawl in this file, '
+                                 'so that it can be resumed')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='carry on with the crawl saved in the '
+                                 '--state file')
+    arg_parser.add_argument('--cache',
+                            help='remember the links in each page in this '
+                                 'file, and on later runs, only download pages '
+                                 'that have changed')
+    arg_parser.add_argument('--progress', type=float, metavar='SECONDS',
+                            help='rather than a line for every request, print '
+                                 'how the crawl is going every this many '
+                                 'seconds')
+    args = arg_parser.parse_args()
+    if args.resume and not args.state:
+        arg_parser.error('--resume needs --state')
+
+    store = CrawlStore(args.state) if args.state else None
+    cache = ResponseCache(args.cache) if args.cache else None
+    if args.results_file:
+        sink = make_sink(args.results_format, args.results_file,
+                         args.flush_interval)
+    else:
+        sink = None
+    results = make_results(args.seen, args.expected_urls, args.error_rate,
+                           sink)
+
+    spider = Spider(args.root_url, n_threads=args.threads, http11=args.http11,
+                    use_soup=args.soup, order=args.order,
+                    max_depth=args.max_depth, store=store, resume=args.resume,
+                    results=results, cache=cache,
+                    progress=Progress(args.progress))
+    try:
+        spider.run()
+    finally:
+        if sink is not None:
+            sink.close()
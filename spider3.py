@@ -9,42 +9,108 @@
 # Note that the event loop is tangled up with the rest of the code.  In
 # spider4.py, we'll see how to separate the event loop.
 
+import argparse
 import errno
-import re
 import socket
-import sys
+import time
 import urlparse
 
-from bs4 import BeautifulSoup
+from cache import ResponseCache
+from frontier import HOST_ORDERS, make_frontier
+from httpparser import ResponseParser
+from links import LinkExtractor, soup_links
+from resolver import Resolver
+from scheduler import Scheduler
+from seen import SEEN_KINDS, make_results
+from sinks import SINK_FORMATS, Progress, make_sink
+from store import CrawlStore
+
+# The most data to read from a socket at once
+RECV_SIZE = 65536
 
 class Spider(object):
-    def __init__(self, root_url):
+    def __init__(self, root_url, use_soup=False, max_active=100,
+                 max_per_host=8, rate=None, order='bfs', max_depth=None,
+                 store=None, resume=False, results=None, cache=None,
+                 progress=None):
         self.root_url = root_url
         netloc, path = parse_url(root_url)
         self.netloc = netloc
 
-        # Maps urls to the status code returned when requesting that url
-        self.results = {}
+        # Whether to find links with BeautifulSoup, rather than LinkExtractor
+        self.use_soup = use_soup
+
+        # Looks up hostnames, remembering the answers
+        self.resolver = Resolver()
+
+        # Maps urls to the status code returned when requesting that url.
+        # (Or, if results is given, something that looks enough like a dict
+        # for our purposes, but takes less memory -- see seen.py.)
+        self.results = results if results is not None else {}
+
+        # Maps urls to how many links away from root_url they were found
+        self.depths = {}
+
+        # If given, the state of the crawl is kept in store, so that it can be
+        # resumed if we die (see store.py)
+        self.store = store
+        self.resuming = resume
+        if store is not None and not resume:
+            store.clear()
+
+        # If given, a ResponseCache, which lets us skip downloading pages that
+        # haven't changed since the last crawl (see cache.py).  While we're
+        # finding the links in a page, they're kept in page_links, which maps
+        # urls to a list of links.
+        self.cache = cache
+        self.page_links = {}
+
+        # Tells us how the crawl is going; by default, with a line for every
+        # request (see sinks.py)
+        self.progress = progress if progress is not None else Progress()
 
         # Maps sockets with outstanding requests to a tuple:
-        #   (url of request, data received on socket so far)
+        #   (url of request, parser that data received on socket is fed to)
         self.sockets = {}
 
+        # Urls that we've found wait here until we're allowed to request them:
+        # there can be no more than max_active requests in progress, and no
+        # more than max_per_host to any one host, and if rate is given, no
+        # more than that many requests per second to any one host.  Each
+        # host's urls are let out in the order given by a frontier (see
+        # frontier.py).
+        frontier = lambda: make_frontier(order, max_depth, store)
+        self.scheduler = Scheduler(max_active=max_active,
+                                   max_per_host=max_per_host, rate=rate,
+                                   frontier=frontier)
+
     def run(self):
-        # Make first request
-        self.maybe_make_request(self.root_url)
+        # Make first request, or pick up where we left off
+        if self.resuming:
+            self.resume()
+        else:
+            self.maybe_make_request(self.root_url)
+
+        while self.sockets or self.scheduler:
+            # Make any requests that the rate limit was holding back, and if
+            # that's all we're waiting for, wait for it
+            self.schedule()
+            when = self.scheduler.next_time()
+            if not self.sockets and when is not None:
+                time.sleep(max(when - time.time(), 0))
+                continue
 
-        while self.sockets:
             # List of sockets which have received all their data
             complete = []
 
             # Loop over sockets with outstanding requests, attempting to read
             # data from each in turn -- note this is inefficient: use the
-            # select module instead
-            for sock in self.sockets:
+            # select module instead.  (We loop over a copy of the list, since
+            # links found in data as it arrives lead to new requests.)
+            for sock in self.sockets.keys():
                 while True:
                     try:
-                        data = sock.recv(1024)
+                        data = sock.recv(RECV_SIZE)
                     except socket.error as e:
                         if e.args[0] == errno.EWOULDBLOCK:
                             # There's no data to be read
@@ -53,51 +119,107 @@ class Spider(object):
                             # Something else has gone wrong
                             raise
 
+                    url, parser = self.sockets[sock]
+
                     if not data:
                         # Zero bytes received
+                        parser.feed_eof()
+                        sock.close()
+                        complete.append(sock)
+                        break
+                    elif parser.feed(data):
+                        # The parser has all it needs
                         sock.close()
                         complete.append(sock)
                         break
-                    else:
-                        # Update record of data received on this socket
-                        url, response = self.sockets[sock]
-                        self.sockets[sock] = url, response + data
 
             for sock in complete:
                 # All data now received on this socket
                 self.handle_response(sock)
 
         # All requests are complete
+        if self.store is not None:
+            self.store.checkpoint()
+        if self.cache is not None:
+            self.cache.close()
+        self.progress.report()
         print self.results
 
-    def maybe_make_request(self, url):
+    def maybe_make_request(self, url, depth=0):
         url = self.normalise(url)
         if url is None or url in self.results:
             # Either the url was a fragment, or we've already requested it
             return
 
-        self.make_request(url)
+        netloc, _ = parse_url(url)
+        if not self.scheduler.add(netloc, url, depth):
+            # The url is too far from the root
+            return
+
+        # Record the url straight away, so that it's not scheduled twice
+        self.results[url] = None
+        self.depths[url] = depth
+        if self.store is not None:
+            self.store.claim(url, depth)
+        self.schedule()
+
+    def resume(self):
+        # Carry on with the crawl saved in the store.  If the crawl died before
+        # its first checkpoint, nothing was saved, so start it again.
+        results, pending = self.store.load()
+        if not results and not pending:
+            pending = [(self.root_url, 0)]
+        self.results.update(results)
+        for url, depth in pending:
+            self.maybe_make_request(url, depth)
+
+    def found_link(self, url, link):
+        # Called with each link in the page at url
+        if self.cache is not None:
+            self.page_links.setdefault(url, []).append(link)
+        self.maybe_make_request(link, self.depths[url] + 1)
+
+    def schedule(self):
+        # Make all the requests that the scheduler will let us
+        for url in self.scheduler.ready():
+            self.make_request(url)
+
+    def request_done(self, url):
+        # Called once we've finished with a url, one way or another, so that
+        # the scheduler can let another request go
+        netloc, _ = parse_url(url)
+        self.scheduler.done(netloc)
+        self.page_links.pop(url, None)
+        self.depths.pop(url, None)
+        self.schedule()
 
     def make_request(self, url):
-        print 'requesting', url
-        self.results[url] = None
+        self.progress.requesting(url)
 
         try:
             netloc, path = parse_url(url)
             sock = self.make_connection(netloc)
-            self.send_request(sock, netloc, path)
+            if self.cache is not None:
+                headers = self.cache.request_headers(url)
+            else:
+                headers = ''
+            self.send_request(sock, netloc, path, headers)
 
             # Rather than wait for a response, add to list (actually a dict) of
-            # sockets that are checked by run() for data
-            self.sockets[sock] = url, ''
+            # sockets that are checked by run() for data.  As soon as the
+            # headers are in, the parser checks with us whether we want the
+            # rest of the response.
+            on_headers = lambda parser: self.check_headers(url, parser)
+            self.sockets[sock] = url, ResponseParser(on_headers=on_headers)
 
         except socket.error as e:
-            print 'error:', e
+            self.progress.error(e)
+            self.request_done(url)
             return None
 
     def make_connection(self, netloc):
         hostname, port = parse_netloc(netloc)
-        host = socket.gethostbyname(hostname)
+        host = self.resolver.resolve(hostname)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((host, port))
 
@@ -105,23 +227,50 @@ class Spider(object):
         sock.setblocking(0)
         return sock
 
-    def send_request(self, sock, hostname, path):
+    def send_request(self, sock, hostname, path, headers=''):
+        # headers holds any extra header lines
         sock.send('GET %s HTTP/1.0\r\n' % path.encode('utf-8'))
         sock.send('Host: %s\r\n' % hostname)
+        sock.send(headers)
         sock.send('\r\n')
 
+    def check_headers(self, url, parser):
+        # If we're not going to look at the body of the response, there's no
+        # point downloading it
+        if not self.wants_body(url, parser):
+            parser.abort()
+        elif not self.use_soup:
+            # Find the links in the page as it arrives
+            on_link = lambda link: self.found_link(url, link)
+            parser.on_body = LinkExtractor(on_link).feed
+
+    def wants_body(self, url, parser):
+        # We only look at the body of web pages on the original host (see
+        # handle_200)
+        netloc, _ = parse_url(url)
+        return parser.status_code == '200' and netloc == self.netloc and \
+            parser.get_header('Content-Type') == 'text/html'
+
     def handle_response(self, sock):
-        # Retrieve the url and response corresponding to the socket
-        url, response = self.sockets[sock]
+        # Retrieve the url and parser corresponding to the socket
+        url, parser = self.sockets[sock]
 
         # Remove socket from list of sockets with outstanding responses
         del self.sockets[sock]
 
-        print 'got response for', url
+        self.progress.got_response(url)
 
         # Parse the response, and record the status code
-        response = self.parse_response(response)
+        try:
+            response = self.parse_response(parser)
+        except socket.error as e:
+            self.progress.error(e)
+            self.request_done(url)
+            return
         self.results[url] = response['status_code']
+        if self.store is not None:
+            self.store.record(url, response['status_code'])
+            self.store.maybe_checkpoint()
 
         # If we know how to handle a response with this status code, do so now
         try:
@@ -130,44 +279,60 @@ class Spider(object):
             pass
         else:
             method(url, response)
+        self.request_done(url)
 
-    def parse_response(self, response):
-        status_plus_headers, body = response.split('\r\n\r\n', 1)
-        lines = status_plus_headers.split('\r\n')
-
-        status_code = re.match('HTTP/1.[01] (\d{3})', lines[0]).groups()[0]
-
-        headers = {}
-
-        for line in lines[1:]:
-            key, val = line.split(':', 1)
-            headers[key.strip()] = val.strip()
+    def parse_response(self, parser):
+        # The parser has already done the hard work
+        if not parser.complete and not parser.aborted:
+            raise socket.error(parser.error or 'connection closed before '
+                                               'response was complete')
 
-        return {'status_code': status_code,
-                'headers': headers,
-                'body': body}
+        return {'status_code': parser.status_code,
+                'headers': parser.headers,
+                'body': parser.body}
 
     def handle_200(self, url, response):
         netloc, _ = parse_url(url)
         if netloc == self.netloc and \
                 response['headers']['Content-Type'] == 'text/html':
             # This is a response to a request for a url on the same host as the
-            # original request, and the response is a web page
-            soup = BeautifulSoup(response['body'])
-            for link in soup.find_all('a'):
-                # Make requests for all urls linked to in page body
-                self.maybe_make_request(link.get('href'))
+            # original request, and the response is a web page.  (Unless we're
+            # using BeautifulSoup, we'll have found the links in the page as it
+            # arrived -- see check_headers.)
+            if self.use_soup:
+                for link in soup_links(response['body']):
+                    # Make requests for all urls linked to in page body
+                    self.found_link(url, link)
+
+            if self.cache is not None:
+                self.cache.put(url, response['headers'],
+                               self.page_links.get(url, []))
+
+    def handle_304(self, url, response):
+        # The page hasn't changed since we last downloaded it, so follow the
+        # links that we found in it then
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None:
+            for link in entry[2]:
+                self.maybe_make_request(link, self.depths[url] + 1)
 
     def handle_301(self, url, response):
-        # Make request for location of permanently-moved resource
-        self.maybe_make_request(response['headers']['Location'])
+        # Make request for location of permanently-moved resource.  (This
+        # isn't a link to a new page, so it doesn't take us any deeper.)
+        self.maybe_make_request(response['headers']['Location'],
+                                self.depths[url])
 
     def handle_302(self, url, response):
         # Make request for location of temporarily-moved resource
-        self.maybe_make_request(response['headers']['Location'])
+        self.maybe_make_request(response['headers']['Location'],
+                                self.depths[url])
 
     def normalise(self, url):
-        netloc, path = parse_url(url)
+        try:
+            netloc, path = parse_url(url)
+        except ValueError:
+            # url is malformed (eg its port isn't a number)
+            return None
         if not netloc and not path:
             # url was a fragment
             return None
@@ -193,5 +358,81 @@ def parse_netloc(netloc):
         return netloc, 80
 
 if __name__ == '__main__':
-    spider = Spider(sys.argv[1])
-    spider.run()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('root_url')
+    arg_parser.add_argument('--soup', action='store_true',
+                            help='find links with BeautifulSoup')
+    arg_parser.add_argument('--max-active', type=int, default=100,
+                            help='the most requests to have in progress at '
+                                 'once')
+    arg_parser.add_argument('--max-per-host', type=int, default=8,
+                            help='the most requests to have in progress to '
+                                 'any one host at once')
+    arg_parser.add_argument('--rate', type=float,
+                            help='the most requests per second to make to '
+                                 'any one host')
+    arg_parser.add_argument('--order', choices=HOST_ORDERS, default='bfs',
+                            help='the order to request each host\'s urls in')
+    arg_parser.add_argument('--max-depth', type=int,
+                            help='the most links to follow away from the root '
+                                 'url')
+    arg_parser.add_argument('--seen', choices=SEEN_KINDS, default='dict',
+                            help='how to remember the urls we\'ve seen: a '
+                                 'dict of urls to status codes, or (to save '
+                                 'memory) a set of fingerprints or a Bloom '
+                                 'filter')
+    arg_parser.add_argument('--expected-urls', type=int, default=1000000,
+                            help='with --seen bloom, the number of urls to '
+                                 'size the filter for')
+    arg_parser.add_argument('--error-rate', type=float, default=0.001,
+                            help='with --seen bloom, the fraction of new urls '
+                                 'we can afford to wrongly skip')
+    arg_parser.add_argument('--results-file',
+                            help='write each url and its status code to this '
+                                 'file (or pipe) as they come in, rather than '
+                                 'printing them all at the end')
+    arg_parser.add_argument('--results-format', choices=sorted(SINK_FORMATS),
+                            default='text',
+                            help='the format to write the --results-file in')
+    arg_parser.add_argument('--flush-interval', type=float, default=1.0,
+                            help='the most seconds to hold results in memory '
+                                 'before writing them to the --results-file')
+    arg_parser.add_argument('--state',
+                            help='keep the state of the crawl in this file, '
+                                 'so that it can be resumed')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='carry on with the crawl saved in the '
+                                 '--state file')
+    arg_parser.add_argument('--cache',
+                            help='remember the links in each page in this '
+                                 'file, and on later runs, only download pages '
+                                 'that have changed')
+    arg_parser.add_argument('--progress', type=float, metavar='SECONDS',
+                            help='rather than a line for every request, print '
+                                 'how the crawl is going every this many '
+                                 'seconds')
+    args = arg_parser.parse_args()
+    if args.resume and not args.state:
+        arg_parser.error('--resume needs --state')
+
+    store = CrawlStore(args.state) if args.state else None
+    cache = ResponseCache(args.cache) if args.cache else None
+    if args.results_file:
+        sink = make_sink(args.results_format, args.results_file,
+                         args.flush_interval)
+    else:
+        sink = None
+    results = make_results(args.seen, args.expected_urls, args.error_rate,
+                           sink)
+
+    spider = Spider(args.root_url, use_soup=args.soup,
+                    max_active=args.max_active,
+                    max_per_host=args.max_per_host, rate=args.rate,
+                    order=args.order, max_depth=args.max_depth, store=store,
+                    resume=args.resume, results=results, cache=cache,
+                    progress=Progress(args.progress))
+    try:
+        spider.run()
+    finally:
+        if sink is not None:
+            sink.close()
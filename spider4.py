@@ -4,115 +4,1102 @@
 # slightly more sophisticated than that in spider3.py.  The basic idea is the
 # same, but we have separated out the event loop, and we are now using select()
 # rather than our own inefficient mechanism for polling when sockets are ready.
+# (In fact, we use epoll or poll where they're available, since they scale to
+# many more sockets than select() -- see the pollers below.)
 
+import argparse
+import collections
 import errno
-import re
+import fcntl
+import heapq
+import math
+import multiprocessing
+import os
 import select
 import socket
-import sys
+import time
 import urlparse
 
-from bs4 import BeautifulSoup
+from cache import ResponseCache
+from frontier import HOST_ORDERS, make_frontier
+from httpparser import ResponseParser
+from links import LinkExtractor, find_links, soup_links
+from pool import ConnectionPool, PoolFull
+from resolver import ThreadPoolResolver
+from scheduler import Scheduler
+from seen import SEEN_KINDS, make_results
+from sinks import SINK_FORMATS, Progress, make_sink
+from store import CrawlStore
+from timing import LoopStats, RequestTiming, TimingSummary
+
+# The most data to read from a socket at once
+RECV_SIZE = 65536
+
+# Interest flags, used when registering sockets with a poller
+READ = 1
+WRITE = 2
+
+# A poller watches a set of file descriptors and reports which of them are
+# ready.  All pollers share the same interface, so that Event doesn't need to
+# care which one it is using:
+#
+#   register(fd, events)   -- start watching fd for the given events
+#   modify(fd, events)     -- change the events that fd is being watched for
+#   unregister(fd)         -- stop watching fd
+#   poll(timeout)          -- block until at least one fd is ready, or until
+#                             timeout seconds have passed, and return a list of
+#                             (fd, events) tuples.  A timeout of None means
+#                             wait for as long as it takes.
+#
+# Registration is incremental: the poller keeps track of the fds it's watching,
+# rather than having them passed in on every call.
+
+class SelectPoller(object):
+    # select() is available everywhere, but it has to be handed the complete
+    # list of fds on every call, so each wakeup costs O(n) in the number of
+    # sockets.  It also can't handle fds greater than FD_SETSIZE (usually
+    # 1024), so it's only used as a last resort.
 
-class Event(object):
     def __init__(self):
-        # Maps sockets to a tuple: (callback, data received on socket so far)
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events):
+        if events & READ:
+            self.readers.add(fd)
+        if events & WRITE:
+            self.writers.add(fd)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout=None):
+        rlist, wlist, _ = select.select(self.readers, self.writers, [],
+                                        timeout)
+        ready = {}
+        for fd in rlist:
+            ready[fd] = READ
+        for fd in wlist:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return ready.items()
+
+class PollPoller(object):
+    # poll() keeps its set of fds in the kernel between calls, and has no limit
+    # on fd numbers.  The kernel still scans every registered fd on each call,
+    # but we no longer rebuild the list ourselves.
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def register(self, fd, events):
+        self.poller.register(fd, self.to_mask(events))
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, self.to_mask(events))
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        # poll's timeout is in milliseconds.  Round up, or a timer due in less
+        # than a millisecond would have us polling over and over until it's
+        # due.
+        if timeout is not None:
+            timeout = int(math.ceil(timeout * 1000))
+        return [(fd, self.from_mask(mask))
+                for fd, mask in self.poller.poll(timeout)]
+
+    def to_mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.POLLIN
+        if events & WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def from_mask(self, mask):
+        events = 0
+        if mask & (select.POLLIN | select.POLLHUP | select.POLLERR):
+            # A hung-up or errored socket is reported as readable, so that the
+            # owner of the socket finds out about it when it next calls recv()
+            events |= READ
+        if mask & (select.POLLOUT | select.POLLHUP | select.POLLERR):
+            events |= WRITE
+        return events
+
+class EpollPoller(PollPoller):
+    # epoll (Linux only) only returns the fds that are actually ready, so the
+    # cost of each wakeup depends on the number of events, not the number of
+    # sockets being watched.  This lets one loop hold tens of thousands of
+    # connections.
+
+    def __init__(self):
+        self.poller = select.epoll()
+
+    def poll(self, timeout=None):
+        # epoll's timeout is in seconds, with -1 meaning wait forever.  It's
+        # rounded down to whole milliseconds, so (as with poll) round up
+        # first.
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = (math.ceil(timeout * 1000) + 0.5) / 1000
+        return [(fd, self.from_mask(mask))
+                for fd, mask in self.poller.poll(timeout)]
+
+    def to_mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def from_mask(self, mask):
+        events = 0
+        if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            events |= READ
+        if mask & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+            events |= WRITE
+        return events
+
+class Timer(object):
+    # A callback that Event will call at a given time, unless it's cancelled
+    # first.  Returned by Event.call_at() and Event.call_later().
+
+    def __init__(self, loop, when, callback, args):
+        self.loop = loop
+        self.when = when
+        self.callback = callback
+        self.args = args
+
+        # Whether the timer is still waiting to go off
+        self.active = True
+
+    def cancel(self):
+        # It's fine to cancel a timer that has already gone off
+        if self.active:
+            self.active = False
+            self.loop.n_timers -= 1
+
+def best_poller():
+    # Pick the most efficient poller that this platform supports
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    elif hasattr(select, 'poll'):
+        return PollPoller()
+    else:
+        return SelectPoller()
+
+class Event(object):
+    def __init__(self, poller=None, clock=time.time, monitor=None):
+        self.poller = poller or best_poller()
+        self.clock = clock
+
+        # If given, told how busy the loop is kept (see LoopStats in
+        # timing.py)
+        self.monitor = monitor
+
+        # Maps sockets to a tuple:
+        #   (callback, list of data received on socket so far, parser)
+        # If there's a parser, data is fed to it instead of being accumulated
         self.sockets = {}
 
-    def add_socket_for_reading(self, sock, callback):
-        self.sockets[sock] = callback, ''
+        # Maps sockets that we're waiting to write to onto a callback, which is
+        # called (with no arguments) whenever the socket is writable
+        self.writers = {}
+
+        # Likewise for sockets that we're waiting to read from, where the
+        # callback does its own reading (see add_reader)
+        self.readers = {}
+
+        # The readers that don't keep the loop running by themselves
+        self.background_readers = set()
+
+        # Maps file descriptors to sockets, since pollers only deal in fds
+        self.fds = {}
+
+        # Callbacks handed to us by other threads, waiting to be called in
+        # this one, as tuples: (callback, args)
+        self.ready = collections.deque()
+
+        # Timers waiting for their time to come round, as a heap of tuples:
+        #   (time, sequence number, Timer)
+        # The sequence number keeps timers due at the same time in the order
+        # they were added.  A cancelled timer stays in the heap until its time
+        # comes round (or it reaches the top), so we count the active ones
+        # separately.
+        self.timers = []
+        self.timer_seq = 0
+        self.n_timers = 0
+
+        # The number of callbacks that other threads have promised to hand us
+        # via call_from_thread(), but haven't yet.  The loop keeps running
+        # until these have all arrived.
+        self.pending = 0
+
+        # Other threads wake the loop up by writing a byte to this pipe (the
+        # "self-pipe trick"), since the loop might be blocked in poll()
+        self.wake_fd, self.wake_write_fd = os.pipe()
+        fcntl.fcntl(self.wake_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        fcntl.fcntl(self.wake_write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.poller.register(self.wake_fd, READ)
+
+    def add_socket_for_reading(self, sock, callback, parser=None):
+        # Without a parser, callback is called with everything received on the
+        # socket once the other end closes it.  With a parser (see
+        # httpparser.py), callback is called with the parser as soon as it has
+        # seen a complete (or invalid) response, and the socket is left open,
+        # unless the other end closed it first.
+        self.sockets[sock] = callback, [], parser
+        self.update_interest(sock)
 
     def remove_socket_for_reading(self, sock):
+        # This must be called before the socket is closed, since a closed
+        # socket no longer has a file descriptor
         del self.sockets[sock]
+        self.update_interest(sock)
 
-    def run(self):
-        while self.sockets:
-            # Get list of sockets that are ready to have data read
-            rlist, _, _ = select.select(self.sockets.keys(), [], [])
+    def add_socket_for_writing(self, sock, callback):
+        self.writers[sock] = callback
+        self.update_interest(sock)
+
+    def remove_socket_for_writing(self, sock):
+        # As with remove_socket_for_reading, call this before closing sock
+        del self.writers[sock]
+        self.update_interest(sock)
+
+    def add_reader(self, sock, callback, background=False):
+        # Unlike add_socket_for_reading, we don't read anything from the
+        # socket; callback is just called (with no arguments) whenever there's
+        # something to read.  This is for code that wants to do its own
+        # reading, like the tasks in tasks.py.  If background is true, run()
+        # doesn't wait for the socket if it has nothing else to do (see the
+        # workers in shard.py, which listen to the coordinator while they
+        # crawl).
+        self.readers[sock] = callback
+        if background:
+            self.background_readers.add(sock)
+        self.update_interest(sock)
+
+    def remove_reader(self, sock):
+        del self.readers[sock]
+        self.background_readers.discard(sock)
+        self.update_interest(sock)
+
+    def expect_callback(self):
+        # Call this (from the loop's thread) before handing work to another
+        # thread that will report back with call_from_thread()
+        self.pending += 1
+
+    def call_from_thread(self, callback, *args):
+        # Call this from another thread to have callback(*args) called in the
+        # loop's thread.  Each call must be matched by an earlier call to
+        # expect_callback().
+        self.ready.append((callback, args))
+        try:
+            os.write(self.wake_write_fd, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            # The pipe is full, so the loop is going to wake up anyway
 
-            for sock in rlist:
-                data = sock.recv(1024)
+    def call_at(self, when, callback, *args):
+        # Have callback(*args) called at time when (as given by self.clock),
+        # and return a Timer, which can be used to cancel the call
+        timer = Timer(self, when, callback, args)
+        self.timer_seq += 1
+        self.n_timers += 1
+        heapq.heappush(self.timers, (when, self.timer_seq, timer))
+        return timer
 
-                callback, response = self.sockets[sock]
+    def call_later(self, delay, callback, *args):
+        # Have callback(*args) called after delay seconds
+        return self.call_at(self.clock() + delay, callback, *args)
 
-                if data:
-                    # Update record of data received on this socket
-                    self.sockets[sock] = callback, response + data
+    def run_timers(self):
+        # Call the callbacks whose time has come
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if timer.active:
+                timer.active = False
+                self.n_timers -= 1
+                if self.monitor is None:
+                    timer.callback(*timer.args)
                 else:
-                    # Zero bytes received; close socket, remove from list, and
-                    # call callback with accumulated response
-                    sock.close()
-                    self.remove_socket_for_reading(sock)
-                    callback(response)
-                    break
+                    self.monitor.timer_ran(now - timer.when)
+                    before = self.clock()
+                    timer.callback(*timer.args)
+                    self.monitor.ran(self.clock() - before)
+
+    def poll_timeout(self):
+        # How long poll() may block for before the next timer is due
+        while self.timers and not self.timers[0][2].active:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(self.timers[0][0] - self.clock(), 0)
+
+    def run_ready(self):
+        # Empty the wakeup pipe, and then call all the callbacks that have been
+        # handed to us
+        try:
+            while os.read(self.wake_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        while self.ready:
+            callback, args = self.ready.popleft()
+            self.pending -= 1
+            callback(*args)
+
+    def update_interest(self, sock):
+        # Tell the poller which events we now care about for this socket
+        fd = sock.fileno()
+        events = 0
+        if sock in self.sockets or sock in self.readers:
+            events |= READ
+        if sock in self.writers:
+            events |= WRITE
+
+        if fd not in self.fds:
+            self.fds[fd] = sock
+            self.poller.register(fd, events)
+        elif events:
+            self.poller.modify(fd, events)
+        else:
+            del self.fds[fd]
+            self.poller.unregister(fd)
+
+    def run(self):
+        monitor = self.monitor
+        while self.sockets or self.writers or self.pending or self.n_timers or \
+                len(self.readers) > len(self.background_readers):
+            # Get list of sockets that are ready to have data read or written,
+            # waking up in time for the next timer
+            timeout = self.poll_timeout()
+            if monitor is None:
+                for fd, events in self.poller.poll(timeout):
+                    self.dispatch(fd, events)
+            else:
+                before = self.clock()
+                ready = self.poller.poll(timeout)
+                after = self.clock()
+                # (The poller is also watching the wakeup pipe)
+                monitor.polled(len(self.fds) + 1, len(ready), after - before)
+                for fd, events in ready:
+                    self.dispatch(fd, events)
+                    now = self.clock()
+                    monitor.ran(now - after)
+                    after = now
+
+            self.run_timers()
+
+    def dispatch(self, fd, events):
+        # Call the callbacks for an fd that the poller says is ready
+        if fd == self.wake_fd:
+            self.run_ready()
+            return
+
+        sock = self.fds.get(fd)
+        if sock is None:
+            # Socket was removed by a callback earlier in this batch
+            return
+
+        if events & WRITE and sock in self.writers:
+            self.writers[sock]()
+
+        if events & READ and sock in self.readers:
+            self.readers[sock]()
+        elif events & READ and sock in self.sockets:
+            self.handle_read(sock)
+
+    def handle_read(self, sock):
+        callback, response, parser = self.sockets[sock]
+
+        try:
+            data = sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] == errno.EWOULDBLOCK:
+                # The fd was closed and reused by a callback earlier in this
+                # batch, and the new socket isn't ready yet
+                return
+
+            # The connection was reset (as a server might do to a keep-alive
+            # connection that it's finished with).  That's no reason to stop
+            # the loop: the callback gets the error, with the parser, or is
+            # told that the connection closed.
+            self.remove_socket_for_reading(sock)
+            self.close_socket(sock)
+            if parser is not None:
+                parser.error = e
+                callback(parser)
+            else:
+                callback(''.join(response))
+            return
+
+        if parser is not None:
+            if data:
+                if not parser.feed(data):
+                    # Parser needs more data
+                    return
+                self.remove_socket_for_reading(sock)
+            else:
+                # Connection closed; the parser will know whether the response
+                # was complete
+                parser.feed_eof()
+                self.remove_socket_for_reading(sock)
+                self.close_socket(sock)
+            callback(parser)
+        elif data:
+            # Update record of data received on this socket.  We collect the
+            # pieces in a list and join them at the end, rather than adding
+            # them together as they arrive, which would copy everything
+            # received so far each time.
+            response.append(data)
+        else:
+            # Zero bytes received; remove socket from list, close it, and call
+            # callback with accumulated response
+            self.remove_socket_for_reading(sock)
+            self.close_socket(sock)
+            callback(''.join(response))
+
+    def close_socket(self, sock):
+        # Close a socket that the other end has closed (or reset), unless we're
+        # still waiting to write to it, in which case whoever is writing will
+        # close it once they've removed it: a closed socket has no fd to
+        # remove.
+        if sock not in self.writers:
+            sock.close()
+
+# The largest unwanted response body that we'll read, rather than closing the
+# connection
+DRAIN_LIMIT = 16384
+
+# The number of times we'll send a request before giving up, if connections
+# keep being dropped before we get a response
+MAX_ATTEMPTS = 3
+
+class Connection(object):
+    # Keeps track of a connection to a host, and the requests that have been
+    # sent on it (or are waiting to be sent)
+
+    def __init__(self, netloc, sock):
+        self.netloc = netloc
+
+        # If sock is None, we're waiting for a new connection to be opened
+        self.sock = sock
+
+        # A connection from the pool has already been used, and is connected
+        self.reused = sock is not None
+        self.connected = sock is not None
+
+        # The urls of requests that we've not yet had a response for, in the
+        # order they were sent
+        self.requests = collections.deque()
+
+        # The number of responses that we've had on this connection
+        self.responses = 0
+
+        # Data waiting to be sent
+        self.out = ''
+
+        # Whether the event loop is watching the socket for writing and reading
+        self.writing = False
+        self.reading = False
+
+        # Timers for the deadlines we've set for connecting, and for the
+        # response that we're waiting for
+        self.connect_timer = None
+        self.response_timers = []
 
 class Spider(object):
-    def __init__(self, root_url):
+    def __init__(self, root_url, resolver=None, http11=False,
+                 pipeline_depth=1, use_soup=False, parse_workers=0,
+                 max_parse_jobs=None, max_active=100, max_per_host=8,
+                 rate=None, order='bfs', max_depth=None, store=None,
+                 resume=False, results=None, cache=None, connect_timeout=10,
+                 first_byte_timeout=30, total_timeout=300,
+                 on_request_done=None, progress=None):
         self.root_url = root_url
         netloc, path = parse_url(root_url)
         self.netloc = netloc
 
-        # Maps urls to the status code returned when requesting that url
-        self.results = {}
+        # Whether to find links with BeautifulSoup, rather than LinkExtractor
+        self.use_soup = use_soup
+
+        # Finding links in a big page can take long enough that we fall behind
+        # in reading from sockets.  If parse_workers is given, pages are handed
+        # to a pool of that many processes to find the links, and the loop
+        # gets on with other things in the meantime.  No more than
+        # max_parse_jobs pages are handed over at once; others wait in
+        # parse_jobs.
+        self.parse_workers = parse_workers
+        self.max_parse_jobs = max_parse_jobs or 2 * parse_workers
+        self.parse_pool = None
+        self.parse_jobs = collections.deque()
+        self.parsing = 0
+
+        # Used to look up hostnames; if not given, one is built when the spider
+        # is run, since it needs to know about the loop
+        self.resolver = resolver
+
+        # With HTTP/1.1, connections are kept open after each response, and
+        # reused for later requests to the same host.  With HTTP/1.0, the pool
+        # never holds on to a connection, and doesn't limit how many we open.
+        if http11:
+            self.http_version = 'HTTP/1.1'
+            self.pool = ConnectionPool(max_active=4, max_idle=4,
+                                       idle_timeout=30)
+        else:
+            self.http_version = 'HTTP/1.0'
+            self.pool = ConnectionPool(max_active=None, max_idle=0)
+
+        # With HTTP/1.1, we can send several requests down a connection without
+        # waiting for the responses (pipelining).  The server sends the
+        # responses back in the same order.
+        if http11:
+            self.pipeline_depth = pipeline_depth
+        else:
+            self.pipeline_depth = 1
+
+        # Maps netlocs to a list of Connections that we've got from the pool
+        self.connections = {}
+
+        # Maps netlocs to a deque of urls that are waiting for a connection
+        # with room for another request
+        self.waiting = {}
+
+        # Maps urls to the number of times we've tried to request them, so
+        # that we don't retry forever if connections keep being dropped
+        self.attempts = {}
+
+        # The number of seconds we'll wait for a connection to be established,
+        # for the first byte of a response, and for the whole of a response,
+        # before giving up.  Any of them may be None, meaning wait forever.
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.total_timeout = total_timeout
+
+        # Urls that we've found wait here until we're allowed to request them:
+        # there can be no more than max_active requests in progress, and no
+        # more than max_per_host to any one host, and if rate is given, no
+        # more than that many requests per second to any one host.  Each
+        # host's urls are let out in the order given by a frontier (see
+        # frontier.py).
+        frontier = lambda: make_frontier(order, max_depth, store)
+        self.scheduler = Scheduler(max_active=max_active,
+                                   max_per_host=max_per_host, rate=rate,
+                                   frontier=frontier)
+
+        # Whether we've asked the loop to call schedule() again once the rate
+        # limit allows another request
+        self.schedule_pending = False
+
+        # Maps urls to the status code returned when requesting that url.
+        # (Or, if results is given, something that looks enough like a dict
+        # for our purposes, but takes less memory -- see seen.py.)
+        self.results = results if results is not None else {}
+
+        # Maps urls to how many links away from root_url they were found
+        self.depths = {}
+
+        # If given, the state of the crawl is kept in store, so that it can be
+        # resumed if we die (see store.py)
+        self.store = store
+        self.resuming = resume
+        if store is not None and not resume:
+            store.clear()
+
+        # If given, a ResponseCache, which lets us skip downloading pages that
+        # haven't changed since the last crawl (see cache.py).  While we're
+        # finding the links in a page, they're kept in page_links, which maps
+        # urls to a list of links.
+        self.cache = cache
+        self.page_links = {}
+
+        # If given, called with a RequestTiming (see timing.py) for each url
+        # once we've finished with it.  timings maps the urls in progress to
+        # theirs.
+        self.on_request_done = on_request_done
+        self.timings = {}
+
+        # Tells us how the crawl is going; by default, with a line for every
+        # request (see sinks.py)
+        self.progress = progress if progress is not None else Progress()
 
     def run(self, loop):
-        self.loop = loop
+        self.start(loop)
 
-        # Make first request
-        self.make_request(self.root_url)
+        # Make first request, or pick up where we left off
+        if self.resuming:
+            self.resume()
+        else:
+            self.maybe_make_request(self.root_url)
 
         # Start loop running
         self.loop.run()
+        self.stop()
 
+        self.progress.report()
         print self.results
 
-    def maybe_make_request(self, url):
+    def start(self, loop):
+        # Get ready to make requests with the given loop
+        self.loop = loop
+
+        # Start the worker processes before any threads, since forking a
+        # process with threads running is asking for trouble
+        if self.parse_workers:
+            self.parse_pool = multiprocessing.Pool(self.parse_workers)
+
+        if self.resolver is None:
+            self.resolver = ThreadPoolResolver(loop)
+
+    def stop(self):
+        # Tidy up once the loop has finished
+        self.resolver.close()
+        self.pool.close()
+        if self.parse_pool is not None:
+            self.parse_pool.close()
+            self.parse_pool.join()
+        if self.store is not None:
+            self.store.checkpoint()
+        if self.cache is not None:
+            self.cache.close()
+
+    def maybe_make_request(self, url, depth=0):
         url = self.normalise(url)
         if url is None or url in self.results:
             # Either the url was a fragment, or we've already requested it
             return
 
-        self.make_request(url)
+        netloc, _ = parse_url(url)
+        if not self.scheduler.add(netloc, url, depth):
+            # The url is too far from the root
+            return
 
-    def make_request(self, url):
-        print 'requesting', url
+        # Record the url straight away, so that it's not scheduled twice
         self.results[url] = None
+        self.depths[url] = depth
+        if self.store is not None:
+            self.store.claim(url, depth)
+        self.schedule()
+
+    def resume(self):
+        # Carry on with the crawl saved in the store.  If the crawl died before
+        # its first checkpoint, nothing was saved, so start it again.
+        results, pending = self.store.load()
+        if not results and not pending:
+            pending = [(self.root_url, 0)]
+        self.results.update(results)
+        for url, depth in pending:
+            self.maybe_make_request(url, depth)
+
+    def found_link(self, url, link):
+        # Called with each link in the page at url
+        if self.cache is not None:
+            self.page_links.setdefault(url, []).append(link)
+        self.maybe_make_request(link, self.depths[url] + 1)
+
+    def schedule(self):
+        # Make all the requests that the scheduler will let us.  If some are
+        # being held back by the rate limit, come back when one can be made.
+        for url in self.scheduler.ready():
+            self.make_request(url)
+
+        when = self.scheduler.next_time()
+        if when is not None and not self.schedule_pending:
+            self.schedule_pending = True
+            self.loop.call_later(max(when - time.time(), 0),
+                                 self.schedule_later)
+
+    def schedule_later(self):
+        self.schedule_pending = False
+        self.schedule()
+
+    def request_done(self, url):
+        # Called once we've finished with a url, one way or another, so that
+        # the scheduler can let another request go
+        netloc, _ = parse_url(url)
+        self.scheduler.done(netloc)
+        self.page_links.pop(url, None)
+        self.depths.pop(url, None)
+        self.attempts.pop(url, None)
+        if self.on_request_done is not None:
+            timing = self.timings.pop(url, None)
+            if timing is not None:
+                timing.end = self.loop.clock()
+                self.on_request_done(timing)
+        self.schedule()
+
+    def make_request(self, url):
+        self.progress.requesting(url)
+        if self.on_request_done is not None:
+            self.timings[url] = RequestTiming(url, self.loop.clock())
+        self.queue_request(url)
+
+    def queue_request(self, url):
+        if not self.place_request(url):
+            # All the connections we're allowed to this host are busy, so wait
+            # until one has room
+            netloc, _ = parse_url(url)
+            self.waiting.setdefault(netloc, collections.deque()).append(url)
+
+    def place_request(self, url):
+        # Try to find a connection for the request, returning whether we did
+        netloc, _ = parse_url(url)
+        self.attempts[url] = self.attempts.get(url, 0) + 1
 
+        # If there's a connection with room in its pipeline, use it
+        for conn in self.connections.get(netloc, []):
+            if len(conn.requests) < self.pipeline_depth:
+                self.mark([url], 'placed')
+                self.send_request(conn, url)
+                return True
+
+        # Otherwise, ask the pool for a connection.  We'll either be given an
+        # idle connection, or be told (with None) to open a new one.
         try:
-            netloc, path = parse_url(url)
-            sock = self.make_connection(netloc)
-            self.send_request(sock, netloc, path)
+            sock = self.pool.checkout(netloc, block=False)
+        except PoolFull:
+            self.attempts[url] -= 1
+            return False
+
+        conn = Connection(netloc, sock)
+        self.connections.setdefault(netloc, []).append(conn)
+        self.mark([url], 'placed')
 
-            # Rather than wait for a response, pass socket to event loop, with
-            # callback for handling response
-            callback = lambda response: self.handle_response(url, response)
-            self.loop.add_socket_for_reading(sock, callback)
+        # Queue the request before connecting, since a cached address means
+        # that we connect straight away
+        self.send_request(conn, url)
 
+        if sock is None:
+            # Look up the host's address without blocking the loop.  Once it's
+            # known, we can connect.
+            hostname, port = parse_netloc(netloc)
+            callback = lambda host, error: \
+                self.connect(conn, (host, port), error)
+            self.resolver.resolve(hostname, callback)
+
+        return True
+
+    def service_waiting(self, netloc):
+        # Give as many waiting urls as we can a connection
+        waiting = self.waiting.get(netloc)
+        while waiting:
+            url = waiting.popleft()
+            if not self.place_request(url):
+                waiting.appendleft(url)
+                break
+
+    def connect(self, conn, address, error):
+        try:
+            if error is not None:
+                raise error
+            self.mark(conn.requests, 'resolved')
+            conn.sock = self.make_connection(address)
         except socket.error as e:
-            print 'error:', e
+            self.connection_failed(conn, e)
             return None
 
-    def make_connection(self, netloc):
-        hostname, port = parse_netloc(netloc)
-        host = socket.gethostbyname(hostname)
+        if self.connect_timeout is not None:
+            conn.connect_timer = self.loop.call_later(
+                self.connect_timeout, self.timed_out, conn, 'connecting')
+
+        # The connection won't have been established yet.  When it has, the
+        # socket will become writable, and we can send any requests that have
+        # been queued on it.
+        self.start_io(conn)
+
+    def make_connection(self, address):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
 
-        # Put the socket in non-blocking mode
+        # Put the socket in non-blocking mode before connecting, so that we
+        # don't wait for the TCP handshake to complete
         sock.setblocking(0)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(err, os.strerror(err))
         return sock
 
-    def send_request(self, sock, hostname, path):
-        sock.send('GET %s HTTP/1.0\r\n' % path.encode('utf-8'))
-        sock.send('Host: %s\r\n' % hostname)
-        sock.send('\r\n')
+    def build_request(self, hostname, path, headers=''):
+        # Build the whole request up front, so that it can be sent with as few
+        # calls to send() as possible.  headers holds any extra header lines.
+        return 'GET %s %s\r\nHost: %s\r\n%s\r\n' % (
+            path.encode('utf-8'), self.http_version, hostname, headers)
+
+    def send_request(self, conn, url):
+        # Add the request to the data waiting to be sent on the connection
+        netloc, path = parse_url(url)
+        conn.requests.append(url)
+        if self.cache is not None:
+            headers = self.cache.request_headers(url)
+            # If this is another attempt, forget any links we found last time
+            self.page_links.pop(url, None)
+        else:
+            headers = ''
+        conn.out += self.build_request(netloc, path, headers)
+        if conn.sock is not None:
+            self.start_io(conn)
+
+    def start_io(self, conn):
+        # Make sure that the event loop will tell us when we can send data on
+        # the connection, and when a response arrives
+        if not conn.writing:
+            conn.writing = True
+            callback = lambda: self.write(conn)
+            self.loop.add_socket_for_writing(conn.sock, callback)
+        if not conn.reading:
+            self.read_response(conn, '')
+
+    def write(self, conn):
+        # Called by the event loop when the connection's socket is writable.
+        # For a new connection, the first time this happens means that the
+        # connection attempt has finished, and we need to check whether it
+        # succeeded.
+        try:
+            if not conn.connected:
+                err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise socket.error(err, os.strerror(err))
+                conn.connected = True
+                if conn.connect_timer is not None:
+                    conn.connect_timer.cancel()
+                self.mark(conn.requests, 'connected')
+            sent = conn.sock.send(conn.out)
+        except socket.error as e:
+            if e.args[0] == errno.EWOULDBLOCK:
+                # The socket buffer filled up; try again when it's writable
+                return
+            self.connection_failed(conn, e)
+            return
+
+        # If only part of the data was sent, we'll be called again when we can
+        # send the rest
+        conn.out = conn.out[sent:]
+        if not conn.out:
+            conn.writing = False
+            self.loop.remove_socket_for_writing(conn.sock)
+            self.mark(conn.requests, 'sent')
+
+    def read_response(self, conn, data):
+        # Pass socket to event loop, with a parser that will tell it when the
+        # next response is complete, and a callback for handling the response.
+        # Any data that arrived after the previous response is the start of
+        # this one.
+        # (Mark the connection as reading first, since handling the data might
+        # lead to more requests being sent on this connection.)
+        conn.reading = True
+        on_headers = lambda parser: self.check_headers(conn, parser)
+        parser = ResponseParser(on_headers=on_headers)
+        if self.on_request_done is not None and conn.requests:
+            self.mark([conn.requests[0]], 'read_started')
+            parser.on_start = lambda parser: \
+                self.mark([conn.requests[0]], 'first_byte')
+
+        # Give up if the response is too slow to start, or to finish
+        if self.first_byte_timeout is not None:
+            conn.response_timers.append(self.loop.call_later(
+                self.first_byte_timeout, self.check_started, conn, parser))
+        if self.total_timeout is not None:
+            conn.response_timers.append(self.loop.call_later(
+                self.total_timeout, self.timed_out, conn, 'reading response'))
+
+        if data and parser.feed(data):
+            self.got_response(conn, parser)
+            return
+
+        callback = lambda parser: self.got_response(conn, parser)
+        self.loop.add_socket_for_reading(conn.sock, callback, parser)
+
+    def got_response(self, conn, parser):
+        conn.reading = False
+        self.cancel_timers(conn.response_timers)
+
+        if not parser.complete and not parser.aborted:
+            # Either the connection was closed before we got the whole
+            # response, or we got something that wasn't a valid response
+            error = parser.error or socket.error('connection closed before '
+                                                 'response was complete')
+            self.connection_failed(conn, error)
+            return
+
+        # Responses come back in the order that the requests were sent
+        url = conn.requests.popleft()
+        conn.responses += 1
+
+        # Work out what to do with the connection before handling the
+        # response, so that it's ready for any requests that are made while
+        # handling the response
+        if not parser.keep_alive:
+            # Either the server won't read any more requests from this
+            # connection, or we stopped reading the response part way through.
+            # Any other requests that we've sent on it will need to be sent
+            # again.
+            self.close_connection(conn)
+            self.requeue(conn.requests, None)
+        elif conn.requests:
+            self.read_response(conn, parser.unconsumed)
+        else:
+            self.release_connection(conn)
+
+        timing = self.timings.get(url)
+        if timing is None:
+            self.handle_response(url, parser)
+        else:
+            timing.done = self.loop.clock()
+            timing.bytes = parser.received - len(parser.unconsumed)
+            self.handle_response(url, parser)
+            timing.parse_time += self.loop.clock() - timing.done
+        self.request_done(url)
+        self.service_waiting(conn.netloc)
+
+    def check_headers(self, conn, parser):
+        # Called as soon as the headers of the response to the first
+        # outstanding request on conn have arrived.  If we're not going to look
+        # at the body of the response, there's no point keeping it.  And unless
+        # it's small enough that reading it is cheaper than opening a new
+        # connection, there's no point downloading it either.
+        url = conn.requests[0]
+        if self.wants_body(url, parser):
+            if not self.use_soup and not self.parse_workers:
+                # Find the links in the page as it arrives
+                on_link = lambda link: self.found_link(url, link)
+                parser.on_body = LinkExtractor(on_link).feed
+                timing = self.timings.get(url)
+                if timing is not None:
+                    parser.on_body = self.timed(timing, parser.on_body)
+            return
+
+        if parser.keep_alive and parser.content_length is not None and \
+                parser.content_length <= DRAIN_LIMIT:
+            parser.skip_body()
+        else:
+            parser.abort()
+
+    def wants_body(self, url, parser):
+        # We only look at the body of web pages on the original host (see
+        # handle_200)
+        netloc, _ = parse_url(url)
+        return parser.status_code == '200' and netloc == self.netloc and \
+            parser.get_header('Content-Type') == 'text/html'
+
+    def connection_failed(self, conn, error):
+        self.close_connection(conn)
+
+        # If the connection has worked before (either for us, or for whoever
+        # last used it before it went into the pool) then the server probably
+        # just closed it, and it's worth trying the requests again on another
+        # connection
+        if conn.reused or conn.responses:
+            self.requeue(conn.requests, error)
+        else:
+            for url in conn.requests:
+                self.fail(url, error)
+
+        self.service_waiting(conn.netloc)
+
+    def check_started(self, conn, parser):
+        # Called when the first byte of a response is overdue; unless some of
+        # it has arrived, give up
+        if not parser.started:
+            self.timed_out(conn, 'waiting for response')
+
+    def timed_out(self, conn, what):
+        # Give up on a connection that has taken too long.  If it never got
+        # connected, all the requests on it have failed; otherwise only the
+        # one whose response we were waiting for has, and we can try the
+        # others again.
+        error = 'timed out %s' % what
+        self.close_connection(conn)
+        if conn.connected:
+            failed = [conn.requests.popleft()]
+            self.requeue(conn.requests, error, 'timeout')
+        else:
+            failed = conn.requests
+
+        for url in failed:
+            self.fail(url, error, 'timeout')
+
+        self.service_waiting(conn.netloc)
 
-    def handle_response(self, url, response):
-        print 'got response for', url
+    def mark(self, urls, stage):
+        # Note that the requests for urls have reached stage (see
+        # RequestTiming), unless they already had
+        if self.on_request_done is None:
+            return
+        now = self.loop.clock()
+        for url in urls:
+            timing = self.timings.get(url)
+            if timing is not None and getattr(timing, stage) is None:
+                setattr(timing, stage, now)
+
+    def timed(self, timing, function):
+        # Wrap function so that the time spent in it counts towards timing's
+        # parse time
+        def wrapper(*args):
+            before = self.loop.clock()
+            function(*args)
+            timing.parse_time += self.loop.clock() - before
+        return wrapper
+
+    def cancel_timers(self, timers):
+        for timer in timers:
+            timer.cancel()
+        del timers[:]
+
+    def requeue(self, urls, error, status='error'):
+        # Send the requests for urls again, on another connection, unless
+        # they've been tried too many times already, in which case they've
+        # failed with the last error and status
+        for url in urls:
+            if self.attempts[url] < MAX_ATTEMPTS:
+                if url in self.timings:
+                    self.timings[url].retry()
+                self.queue_request(url)
+            else:
+                self.fail(url, error or 'too many attempts', status)
+
+    def fail(self, url, error, status='error'):
+        # Give up on url, recording status ('timeout' or 'error') as its
+        # result
+        self.progress.error(error)
+        self.record_result(url, status)
+        self.request_done(url)
+
+    def release_connection(self, conn):
+        # Give a connection with no outstanding requests back to the pool
+        self.connections[conn.netloc].remove(conn)
+        self.pool.checkin(conn.netloc, conn.sock)
+
+    def close_connection(self, conn):
+        # Give up on a connection
+        self.connections[conn.netloc].remove(conn)
+        if conn.connect_timer is not None:
+            conn.connect_timer.cancel()
+        self.cancel_timers(conn.response_timers)
+        if conn.writing:
+            self.loop.remove_socket_for_writing(conn.sock)
+        if conn.reading:
+            self.loop.remove_socket_for_reading(conn.sock)
+        self.pool.discard(conn.netloc, conn.sock)
 
-        # Parse the response, and record the status code
-        response = self.parse_response(response)
-        self.results[url] = response['status_code']
+    def handle_response(self, url, parser):
+        self.progress.got_response(url)
+
+        # Record the status code
+        response = self.parse_response(parser)
+        self.record_result(url, response['status_code'])
 
         # If we know how to handle a response with this status code, do so now
         try:
@@ -122,48 +1109,112 @@ class Spider(object):
         else:
             method(url, response)
 
-    def parse_response(self, response):
-        status_plus_headers, body = response.split('\r\n\r\n', 1)
-        lines = status_plus_headers.split('\r\n')
-
-        status_code = re.match('HTTP/1.[01] (\d{3})', lines[0]).groups()[0]
-
-        headers = {}
+    def record_result(self, url, status):
+        # status is either the status code of the response, 'timeout', or
+        # 'error' if the request failed some other way
+        self.results[url] = status
+        if url in self.timings:
+            self.timings[url].status = status
+        if self.store is not None:
+            self.store.record(url, status)
+            self.store.maybe_checkpoint()
 
-        for line in lines[1:]:
-            key, val = line.split(':', 1)
-            headers[key.strip()] = val.strip()
-
-        return {'status_code': status_code,
-                'headers': headers,
-                'body': body}
+    def parse_response(self, parser):
+        # The parser has already done the hard work
+        return {'status_code': parser.status_code,
+                'headers': parser.headers,
+                'body': parser.body}
 
     def handle_200(self, url, response):
         netloc, _ = parse_url(url)
         if netloc == self.netloc and \
                 response['headers']['Content-Type'] == 'text/html':
             # This is a response to a request for a url on the same host as the
-            # original request, and the response is a web page
-            soup = BeautifulSoup(response['body'])
-            for link in soup.find_all('a'):
-                # Make requests for all urls linked to in page body
-                self.maybe_make_request(link.get('href'))
+            # original request, and the response is a web page.  (Unless we're
+            # using BeautifulSoup or worker processes, we'll have found the
+            # links in the page as it arrived -- see check_headers.)
+            if self.parse_pool is not None:
+                # The url will be finished with before the links come back, so
+                # its depth goes along with the job
+                self.parse_jobs.append((url, self.depths[url],
+                                        response['headers'], response['body']))
+                self.start_parse_jobs()
+                return
+
+            if self.use_soup:
+                for link in soup_links(response['body']):
+                    # Make requests for all urls linked to in page body
+                    self.found_link(url, link)
+
+            if self.cache is not None:
+                self.cache.put(url, response['headers'],
+                               self.page_links.get(url, []))
+
+    def start_parse_jobs(self):
+        # Hand pages to the worker processes, until there are max_parse_jobs
+        # in progress.  When a worker has found the links in a page, the
+        # pool's result thread hands them back to the loop.
+        while self.parse_jobs and self.parsing < self.max_parse_jobs:
+            url, depth, headers, body = self.parse_jobs.popleft()
+            self.parsing += 1
+            self.loop.expect_callback()
+            callback = lambda result, url=url, depth=depth, headers=headers: \
+                self.loop.call_from_thread(self.handle_links, url, depth,
+                                           headers, *result)
+            self.parse_pool.apply_async(parse_links, (body, self.use_soup),
+                                        callback=callback)
+
+    def handle_links(self, url, depth, headers, links, error):
+        # Called in the loop with the links that a worker process found in the
+        # page at url, which was depth links from the root url
+        self.parsing -= 1
+        if error is not None:
+            self.progress.error(error)
+        for link in links:
+            # Make requests for all urls linked to in page body
+            self.maybe_make_request(link, depth + 1)
+        if self.cache is not None and error is None:
+            self.cache.put(url, headers, links)
+        self.start_parse_jobs()
+
+    def handle_304(self, url, response):
+        # The page hasn't changed since we last downloaded it, so follow the
+        # links that we found in it then
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None:
+            for link in entry[2]:
+                self.maybe_make_request(link, self.depths[url] + 1)
 
     def handle_301(self, url, response):
-        # Make request for location of permanently-moved resource
-        self.maybe_make_request(response['headers']['Location'])
+        # Make request for location of permanently-moved resource.  (This
+        # isn't a link to a new page, so it doesn't take us any deeper.)
+        self.maybe_make_request(response['headers']['Location'],
+                                self.depths[url])
 
     def handle_302(self, url, response):
         # Make request for location of temporarily-moved resource
-        self.maybe_make_request(response['headers']['Location'])
+        self.maybe_make_request(response['headers']['Location'],
+                                self.depths[url])
 
     def normalise(self, url):
-        netloc, path = parse_url(url)
+        try:
+            netloc, path = parse_url(url)
+        except ValueError:
+            # url is malformed (eg its port isn't a number)
+            return None
         if not netloc and not path:
             # url was a fragment
             return None
         return 'http://' + (netloc or self.netloc) + path
 
+def parse_links(html, use_soup):
+    # Runs in a worker process, and returns a tuple: (links, error).  We don't
+    # let exceptions escape, since then the pool would never call us back.
+    try:
+        return find_links(html, use_soup), None
+    except Exception as e:
+        return [], repr(e)
+
 def parse_url(url):
     parsed_url = urlparse.urlsplit(url)
     if parsed_url.port:
@@ -184,6 +1235,121 @@ def parse_netloc(netloc):
         return netloc, 80
 
 if __name__ == '__main__':
-    loop = Event()
-    spider = Spider(sys.argv[1])
-    spider.run(loop)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('root_url')
+    arg_parser.add_argument('--http11', action='store_true',
+                            help='use HTTP/1.1 with keep-alive connections')
+    arg_parser.add_argument('--pipeline', type=int, default=1,
+                            help='with --http11, the number of requests to '
+                                 'send down a connection at once')
+    arg_parser.add_argument('--soup', action='store_true',
+                            help='find links with BeautifulSoup')
+    arg_parser.add_argument('--parse-workers', type=int, default=0,
+                            help='the number of processes to find links in '
+                                 'pages with')
+    arg_parser.add_argument('--max-parse-jobs', type=int,
+                            help='the most pages to hand to the parse workers '
+                                 'at once (default: twice the number of '
+                                 'workers)')
+    arg_parser.add_argument('--max-active', type=int, default=100,
+                            help='the most requests to have in progress at '
+                                 'once')
+    arg_parser.add_argument('--max-per-host', type=int, default=8,
+                            help='the most requests to have in progress to '
+                                 'any one host at once')
+    arg_parser.add_argument('--rate', type=float,
+                            help='the most requests per second to make to '
+                                 'any one host')
+    arg_parser.add_argument('--order', choices=HOST_ORDERS, default='bfs',
+                            help='the order to request each host\'s urls in')
+    arg_parser.add_argument('--max-depth', type=int,
+                            help='the most links to follow away from the root '
+                                 'url')
+    arg_parser.add_argument('--seen', choices=SEEN_KINDS, default='dict',
+                            help='how to remember the urls we\'ve seen: a '
+                                 'dict of urls to status codes, or (to save '
+                                 'memory) a set of fingerprints or a Bloom '
+                                 'filter')
+    arg_parser.add_argument('--expected-urls', type=int, default=1000000,
+                            help='with --seen bloom, the number of urls to '
+                                 'size the filter for')
+    arg_parser.add_argument('--error-rate', type=float, default=0.001,
+                            help='with --seen bloom, the fraction of new urls '
+                                 'we can afford to wrongly skip')
+    arg_parser.add_argument('--results-file',
+                            help='write each url and its status code to this '
+                                 'file (or pipe) as they come in, rather than '
+                                 'printing them all at the end')
+    arg_parser.add_argument('--results-format', choices=sorted(SINK_FORMATS),
+                            default='text',
+                            help='the format to write the --results-file in')
+    arg_parser.add_argument('--flush-interval', type=float, default=1.0,
+                            help='the most seconds to hold results in memory '
+                                 'before writing them to the --results-file')
+    arg_parser.add_argument('--state',
+                            help='keep the state of the crawl in this file, '
+                                 'so that it can be resumed')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='carry on with the crawl saved in the '
+                                 '--state file')
+    arg_parser.add_argument('--cache',
+                            help='remember the links in each page in this '
+                                 'file, and on later runs, only download pages '
+                                 'that have changed')
+    arg_parser.add_argument('--connect-timeout', type=float, default=10,
+                            help='the number of seconds to wait for a '
+                                 'connection to be established')
+    arg_parser.add_argument('--first-byte-timeout', type=float, default=30,
+                            help='the number of seconds to wait for a response '
+                                 'to start arriving')
+    arg_parser.add_argument('--total-timeout', type=float, default=300,
+                            help='the number of seconds to wait for the whole '
+                                 'of a response')
+    arg_parser.add_argument('--progress', type=float, metavar='SECONDS',
+                            help='rather than a line for every request, print '
+                                 'how the crawl is going every this many '
+                                 'seconds')
+    arg_parser.add_argument('--timings', action='store_true',
+                            help='time each phase of each request, and the '
+                                 'event loop, and print a summary at the end')
+    args = arg_parser.parse_args()
+    if args.resume and not args.state:
+        arg_parser.error('--resume needs --state')
+
+    store = CrawlStore(args.state) if args.state else None
+    cache = ResponseCache(args.cache) if args.cache else None
+    if args.results_file:
+        sink = make_sink(args.results_format, args.results_file,
+                         args.flush_interval)
+    else:
+        sink = None
+    results = make_results(args.seen, args.expected_urls, args.error_rate,
+                           sink)
+
+    if args.timings:
+        loop = Event(monitor=LoopStats())
+        summary = TimingSummary()
+        on_request_done = summary.add
+    else:
+        loop = Event()
+        on_request_done = None
+    spider = Spider(args.root_url, http11=args.http11,
+                    pipeline_depth=args.pipeline, use_soup=args.soup,
+                    parse_workers=args.parse_workers,
+                    max_parse_jobs=args.max_parse_jobs,
+                    max_active=args.max_active,
+                    max_per_host=args.max_per_host, rate=args.rate,
+                    order=args.order, max_depth=args.max_depth, store=store,
+                    resume=args.resume, results=results, cache=cache,
+                    connect_timeout=args.connect_timeout,
+                    first_byte_timeout=args.first_byte_timeout,
+                    total_timeout=args.total_timeout,
+                    on_request_done=on_request_done,
+                    progress=Progress(args.progress))
+    try:
+        spider.run(loop)
+    finally:
+        if sink is not None:
+            sink.close()
+    if args.timings:
+        summary.report(loop.monitor)
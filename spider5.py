@@ -0,0 +1,268 @@
+# spider5.py
+
+# This web crawler does the same job as spider4.py, but rather than running on
+# an event loop of our own, it uses asyncio, the event loop in Python 3's
+# standard library.  (So, unlike the other spiders, it needs Python 3.)
+# asyncio gives us everything that we had to build for spider4.py -- polling
+# with epoll, timers, non-blocking connects -- and its streams take care of
+# buffering, and of backpressure when sending.
+#
+# Each request is a coroutine, written as a sequence of steps, like the
+# blocking code in spider1.py, with "await" wherever spider1.py would block.
+# There are no callbacks to thread state through (compare tasks.py, which does
+# the same on spider4.py's loop with generators).  A Semaphore bounds the
+# number of requests in progress at once, and hostnames are looked up with the
+# loop's getaddrinfo(), which runs them in a thread pool.
+#
+# httpparser.py and links.py are written for Python 2, so the response headers
+# are parsed here, with the help of the streams, and links are found with the
+# standard library's HTMLParser.
+
+import argparse
+import asyncio
+import html.parser
+import socket
+import urllib.parse
+
+class LinkParser(html.parser.HTMLParser):
+    # Calls callback with the href of each <a> tag in the page it's fed
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        for name, value in attrs:
+            if name == 'href' and value is not None:
+                self.callback(value)
+
+class Spider(object):
+    def __init__(self, root_url, max_active=100, max_depth=None,
+                 connect_timeout=10, total_timeout=300):
+        netloc, path = parse_url(root_url)
+        self.netloc = netloc
+        self.root_url = root_url
+
+        # Maps urls to the status code returned when requesting that url
+        self.results = {}
+
+        # Maps urls to how many links away from root_url they were found
+        self.depths = {}
+
+        # Urls found further than this from root_url are ignored
+        self.max_depth = max_depth
+
+        # The most requests to have in progress at once.  The Semaphore that
+        # enforces this is made in crawl(), once the loop is running.
+        self.max_active = max_active
+        self.semaphore = None
+
+        # The number of seconds we'll wait for a connection to be established,
+        # and for the whole of a response, before giving up
+        self.connect_timeout = connect_timeout
+        self.total_timeout = total_timeout
+
+        # Maps hostnames to a Task that looks up their address, so that all
+        # the requests to a host share one lookup
+        self.addresses = {}
+
+        # The Tasks for requests that haven't finished yet
+        self.tasks = set()
+
+    def run(self):
+        asyncio.run(self.crawl())
+        print(self.results)
+
+    async def crawl(self):
+        self.semaphore = asyncio.Semaphore(self.max_active)
+        self.maybe_make_request(self.root_url)
+
+        # Requests start more requests as they go, so keep waiting until
+        # there are none left
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+    def maybe_make_request(self, url, depth=0):
+        url = self.normalise(url)
+        if url is None or url in self.results:
+            # Either the url was a fragment, or we've already requested it
+            return
+        if self.max_depth is not None and depth > self.max_depth:
+            return
+
+        self.results[url] = None
+        self.depths[url] = depth
+        task = asyncio.ensure_future(self.make_request(url))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def make_request(self, url):
+        async with self.semaphore:
+            print('requesting', url)
+            try:
+                response = await asyncio.wait_for(self.fetch(url),
+                                                  self.total_timeout)
+            except asyncio.TimeoutError:
+                print('error: timed out', url)
+                self.results[url] = 'timeout'
+                return
+            except (OSError, EOFError, ValueError,
+                    asyncio.LimitOverrunError) as e:
+                print('error:', e)
+                return
+
+        self.handle_response(url, response)
+
+    async def fetch(self, url):
+        netloc, path = parse_url(url)
+        hostname, port = parse_netloc(netloc)
+        address = await self.resolve(hostname)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(address, port), self.connect_timeout)
+
+        try:
+            writer.write(b'GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (
+                path.encode('utf-8'), netloc.encode('utf-8')))
+            await writer.drain()
+
+            status_code, headers = await self.read_headers(reader)
+            if self.wants_body(url, status_code, headers):
+                body = await reader.read()
+            else:
+                # Close the connection without reading the rest
+                body = b''
+        finally:
+            writer.close()
+
+        return {'status_code': status_code,
+                'headers': headers,
+                'body': body}
+
+    async def read_headers(self, reader):
+        # Return a tuple: (status code, dict of headers).  Header names are
+        # title-cased, as in httpparser.py.
+        data = await reader.readuntil(b'\r\n\r\n')
+        lines = data.decode('latin-1').split('\r\n')
+
+        status_line = lines[0].split(None, 2)
+        if len(status_line) < 2 or not status_line[0].startswith('HTTP/'):
+            raise ValueError('invalid status line: %r' % lines[0])
+
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().title()] = value.strip()
+        return status_line[1], headers
+
+    def resolve(self, hostname):
+        # Return a Task for the address of hostname.  (A failed lookup is
+        # remembered too, for the rest of the crawl.)
+        if hostname not in self.addresses:
+            self.addresses[hostname] = asyncio.ensure_future(
+                self.lookup(hostname))
+        return self.addresses[hostname]
+
+    async def lookup(self, hostname):
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(hostname, None, family=socket.AF_INET,
+                                       type=socket.SOCK_STREAM)
+        return infos[0][4][0]
+
+    def wants_body(self, url, status_code, headers):
+        # We only look at the body of web pages on the original host (see
+        # handle_200)
+        netloc, _ = parse_url(url)
+        return status_code == '200' and netloc == self.netloc and \
+            headers.get('Content-Type') == 'text/html'
+
+    def handle_response(self, url, response):
+        print('got response for', url)
+
+        # Record the status code
+        self.results[url] = response['status_code']
+
+        # If we know how to handle a response with this status code, do so now
+        try:
+            method = getattr(self, 'handle_%s' % response['status_code'])
+        except AttributeError:
+            pass
+        else:
+            method(url, response)
+
+    def handle_200(self, url, response):
+        netloc, _ = parse_url(url)
+        if netloc == self.netloc and \
+                response['headers']['Content-Type'] == 'text/html':
+            # This is a response to a request for a url on the same host as the
+            # original request, and the response is a web page
+            on_link = lambda link: self.maybe_make_request(
+                link, self.depths[url] + 1)
+            parser = LinkParser(on_link)
+            parser.feed(response['body'].decode('utf-8', 'replace'))
+            parser.close()
+
+    def handle_301(self, url, response):
+        # Make request for location of permanently-moved resource.  (This
+        # isn't a link to a new page, so it doesn't take us any deeper.)
+        self.maybe_make_request(response['headers']['Location'],
+                                self.depths[url])
+
+    def handle_302(self, url, response):
+        # Make request for location of temporarily-moved resource
+        self.maybe_make_request(response['headers']['Location'],
+                                self.depths[url])
+
+    def normalise(self, url):
+        try:
+            netloc, path = parse_url(url)
+        except ValueError:
+            # url is malformed (eg its port isn't a number)
+            return None
+        if not netloc and not path:
+            # url was a fragment
+            return None
+        return 'http://' + (netloc or self.netloc) + path
+
+def parse_url(url):
+    parsed_url = urllib.parse.urlsplit(url)
+    if parsed_url.port:
+        netloc = '%s:%s' % (parsed_url.hostname, parsed_url.port)
+    else:
+        netloc = parsed_url.hostname
+    if parsed_url.path.startswith('/'):
+        path = parsed_url.path
+    else:
+        path = '/' + parsed_url.path
+    return netloc, path
+
+def parse_netloc(netloc):
+    if ':' in netloc:
+        hostname, port = netloc.split(':')
+        return hostname, int(port)
+    else:
+        return netloc, 80
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('root_url')
+    arg_parser.add_argument('--max-active', type=int, default=100,
+                            help='the most requests to have in progress at '
+                                 'once')
+    arg_parser.add_argument('--max-depth', type=int,
+                            help='the most links to follow away from the root '
+                                 'url')
+    arg_parser.add_argument('--connect-timeout', type=float, default=10,
+                            help='the number of seconds to wait for a '
+                                 'connection to be established')
+    arg_parser.add_argument('--total-timeout', type=float, default=300,
+                            help='the number of seconds to wait for the whole '
+                                 'of a response')
+    args = arg_parser.parse_args()
+
+    spider = Spider(args.root_url, max_active=args.max_active,
+                    max_depth=args.max_depth,
+                    connect_timeout=args.connect_timeout,
+                    total_timeout=args.total_timeout)
+    spider.run()
@@ -0,0 +1,142 @@
+# store.py
+
+# The spiders keep everything about a crawl in memory: the results, and the
+# frontier of urls still to request.  That's fine for a few thousand pages, but
+# a crawl of millions of urls can run out of memory, and if the spider crashes
+# (or is killed) part way through, everything it's done is lost.
+#
+# A CrawlStore keeps the state of a crawl in an SQLite database:
+#
+#   * every url that has been claimed for requesting, with its depth, and its
+#     status code once we have it
+#   * the part of the frontier that doesn't fit in memory (see
+#     SpillingFrontier in frontier.py)
+#   * at each checkpoint, the part of the frontier that is in memory
+#
+# Changes are made inside a transaction, which is committed at each checkpoint
+# (every interval seconds, when the spider calls maybe_checkpoint()).  If the
+# spider dies, the crawl can be resumed from the last checkpoint: load() returns
+# the status codes we already have, so those urls aren't requested again, and
+# the urls that were still to be requested (including any that were in
+# progress).
+#
+# A store may be shared between threads; each method holds a lock while it
+# uses the database.
+
+import sqlite3
+import threading
+import time
+import weakref
+
+class CrawlStore(object):
+    def __init__(self, path, interval=10, clock=time.time):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.interval = interval
+        self.clock = clock
+        self.last_checkpoint = clock()
+
+        # The SpillingFrontiers (see frontier.py) using this store, whose
+        # contents are saved at each checkpoint.  We don't keep them alive:
+        # once a frontier has been thrown away, its urls are gone.
+        self.frontiers = weakref.WeakSet()
+
+        # Used to give each SpillingFrontier its own part of the spill table
+        self.n_queues = 0
+
+        with self.lock:
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS results (
+                    url TEXT PRIMARY KEY, depth INTEGER, status TEXT);
+                CREATE TABLE IF NOT EXISTS spilled (
+                    id INTEGER PRIMARY KEY, queue INTEGER, url TEXT,
+                    depth INTEGER);
+                CREATE INDEX IF NOT EXISTS spilled_queue ON spilled (queue, id);
+                CREATE TABLE IF NOT EXISTS window (url TEXT, depth INTEGER);
+            ''')
+            self.db.commit()
+
+    def clear(self):
+        # Forget about any earlier crawl
+        with self.lock:
+            for table in ('results', 'spilled', 'window'):
+                self.db.execute('DELETE FROM %s' % table)
+            self.db.commit()
+
+    def load(self):
+        # Return the state of the crawl as of the last checkpoint, as a tuple:
+        #   (dict mapping urls to their status codes, list of (url, depth)
+        #    tuples of urls still to be requested)
+        # The urls still to be requested are forgotten, since the spider is
+        # about to claim them again.
+        with self.lock:
+            results = dict(self.db.execute(
+                'SELECT url, status FROM results WHERE status IS NOT NULL'))
+            pending = self.db.execute('''
+                SELECT url, depth FROM results WHERE status IS NULL
+                UNION ALL SELECT url, depth FROM spilled
+                UNION ALL SELECT url, depth FROM window
+            ''').fetchall()
+
+            self.db.execute('DELETE FROM results WHERE status IS NULL')
+            self.db.execute('DELETE FROM spilled')
+            self.db.execute('DELETE FROM window')
+            self.db.commit()
+        return results, pending
+
+    def claim(self, url, depth):
+        # Record that url is going to be requested
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO results VALUES (?, ?, NULL)',
+                            (url, depth))
+
+    def record(self, url, status):
+        # Record the status code returned for url
+        with self.lock:
+            self.db.execute('UPDATE results SET status = ? WHERE url = ?',
+                            (status, url))
+
+    def maybe_checkpoint(self):
+        if self.clock() - self.last_checkpoint >= self.interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Save the urls held in memory by the frontiers, and commit everything
+        # since the last checkpoint
+        with self.lock:
+            self.db.execute('DELETE FROM window')
+            for frontier in list(self.frontiers):
+                self.db.executemany('INSERT INTO window VALUES (?, ?)',
+                                    frontier)
+            self.db.commit()
+            self.last_checkpoint = self.clock()
+
+    def close(self):
+        with self.lock:
+            self.checkpoint()
+            self.db.close()
+
+    # These are used by SpillingFrontier (see frontier.py)
+
+    def new_queue(self):
+        with self.lock:
+            self.n_queues += 1
+            return self.n_queues
+
+    def spill(self, queue, url, depth):
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO spilled (queue, url, depth) VALUES (?, ?, ?)',
+                (queue, url, depth))
+
+    def unspill(self, queue, limit):
+        # Remove and return up to limit of the oldest urls spilled to queue
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT id, url, depth FROM spilled WHERE queue = ? '
+                'ORDER BY id LIMIT ?', (queue, limit)).fetchall()
+            if rows:
+                self.db.execute(
+                    'DELETE FROM spilled WHERE queue = ? AND id <= ?',
+                    (queue, rows[-1][0]))
+        return [(url, depth) for _, url, depth in rows]
@@ -0,0 +1,346 @@
+# tasks.py
+
+# spider4.py is fast, but its logic is spread across callbacks.  To follow a
+# redirect, or to wait for a connection, the code making a request has to hand
+# over a function to be called when the next step can happen, and whatever
+# that step needs has to be carried along in lambdas and attributes.  Anything
+# with more than a couple of steps gets hard to follow, which is why it's
+# tempting to fall back on the blocking style of spider1.py.
+#
+# This module lets code running on an Event loop be written as generators
+# ("tasks") that read like blocking code.  Where blocking code would wait, a
+# task yields a Future, and is resumed with the Future's result once there is
+# one (or has its exception raised inside it).  In the meantime the loop gets
+# on with other tasks, and with everything else that it's doing.
+#
+#   sleep(loop, delay)         -- a Future that's done after delay seconds
+#   readable(loop, sock)       -- a Future that's done once sock has something
+#                                 to read
+#   writable(loop, sock)       -- a Future that's done once sock can be written
+#                                 to
+#   spawn(loop, gen)           -- start running the generator gen as a Task.
+#                                 A Task is a Future for gen's result, so
+#                                 yielding one waits for it to finish.
+#   gather(loop, gens, limit)  -- run the generators gens as Tasks, with no more
+#                                 than limit of them running at once, and return
+#                                 a Future for the list of their results
+#
+# A task may also yield another generator, which is run as a Task and waited
+# for.  Generators can't return values in Python 2, so a task that has a result
+# finishes by raising Return(result).
+#
+# connect(), recv(), sendall() and fetch() are tasks for doing HTTP requests;
+# run this module to fetch some urls with them.
+
+import argparse
+import errno
+import os
+import socket
+import sys
+import types
+import urlparse
+
+from httpparser import ResponseParser
+from resolver import ThreadPoolResolver
+from spider4 import RECV_SIZE, Event, parse_netloc, parse_url
+
+# The most redirects that fetch() will follow
+MAX_REDIRECTS = 5
+
+class Return(Exception):
+    # Raised by a task to finish with a result
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Future(object):
+    # The result of something that hasn't finished yet.  Callbacks added with
+    # add_done_callback() are called with the Future once it has a result (or
+    # has failed).
+
+    def __init__(self):
+        self.done = False
+        self.value = None
+
+        # If it failed, a tuple: (exception type, exception, traceback)
+        self.exc_info = None
+
+        self.callbacks = []
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_exception(self, error, traceback=None):
+        self.exc_info = type(error), error, traceback
+        self.finish()
+
+    def finish(self):
+        if self.done:
+            raise RuntimeError('future is already done')
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def result(self):
+        # Return the result, or raise the exception that it failed with
+        if not self.done:
+            raise RuntimeError('future is not done yet')
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class Task(Future):
+    # Runs a generator on loop, resuming it each time the Future that it
+    # yielded is done.  The generator first runs on the loop's next time round,
+    # rather than straight away, so spawning a task never runs any of it.
+
+    def __init__(self, loop, gen):
+        Future.__init__(self)
+        self.loop = loop
+        self.gen = gen
+        loop.call_later(0, self.step, None, None)
+
+    def step(self, value, exc_info):
+        # Resume the generator with value, or with exc_info raised inside it.
+        # If what it yields is already done, carry straight on, rather than
+        # going through a callback, so that a task that only ever waits on
+        # finished Futures doesn't use up the stack.
+        while True:
+            try:
+                if exc_info is not None:
+                    future = self.gen.throw(*exc_info)
+                else:
+                    future = self.gen.send(value)
+            except StopIteration:
+                self.set_result(None)
+                return
+            except Return as e:
+                self.set_result(e.value)
+                return
+            except Exception as e:
+                self.set_exception(e, sys.exc_info()[2])
+                return
+
+            if isinstance(future, types.GeneratorType):
+                future = Task(self.loop, future)
+            elif not isinstance(future, Future):
+                error = TypeError('tasks must yield Futures or generators, '
+                                  'not %r' % (future,))
+                value, exc_info = None, (TypeError, error, None)
+                continue
+
+            if not future.done:
+                future.add_done_callback(self.wakeup)
+                return
+            value, exc_info = future.value, future.exc_info
+
+    def wakeup(self, future):
+        self.step(future.value, future.exc_info)
+
+class Gather(Future):
+    # Runs tasks for the generators that come out of gens, no more than limit
+    # at once, and is done with a list of their results (in the same order as
+    # gens) once they have all finished.  If any of them fails, the Gather
+    # fails with the first exception, once the rest have finished.  gens is
+    # only read from as tasks are started, so it can be a generator itself.
+
+    def __init__(self, loop, gens, limit=None):
+        Future.__init__(self)
+        self.loop = loop
+        self.gens = iter(gens)
+        self.limit = limit
+
+        self.results = []
+        self.running = 0
+        self.exhausted = False
+        self.first_error = None
+
+        self.start_tasks()
+
+    def start_tasks(self):
+        while not self.exhausted and \
+                (self.limit is None or self.running < self.limit):
+            try:
+                gen = next(self.gens)
+            except StopIteration:
+                self.exhausted = True
+                break
+
+            index = len(self.results)
+            self.results.append(None)
+            self.running += 1
+            callback = lambda task, index=index: self.task_done(index, task)
+            Task(self.loop, gen).add_done_callback(callback)
+
+        if self.exhausted and not self.running:
+            if self.first_error is not None:
+                self.set_exception(*self.first_error[1:])
+            else:
+                self.set_result(self.results)
+
+    def task_done(self, index, task):
+        self.running -= 1
+        if task.exc_info is None:
+            self.results[index] = task.value
+        elif self.first_error is None:
+            self.first_error = task.exc_info
+        self.start_tasks()
+
+def spawn(loop, gen):
+    return Task(loop, gen)
+
+def gather(loop, gens, limit=None):
+    return Gather(loop, gens, limit)
+
+def sleep(loop, delay):
+    future = Future()
+    loop.call_later(delay, future.set_result, None)
+    return future
+
+def readable(loop, sock):
+    future = Future()
+    def ready():
+        loop.remove_reader(sock)
+        future.set_result(None)
+    loop.add_reader(sock, ready)
+    return future
+
+def writable(loop, sock):
+    future = Future()
+    def ready():
+        loop.remove_socket_for_writing(sock)
+        future.set_result(None)
+    loop.add_socket_for_writing(sock, ready)
+    return future
+
+def resolve(resolver, hostname):
+    # Look up hostname with a ThreadPoolResolver, returning a Future for its
+    # address.  This is how to turn any callback-based API into a Future.
+    future = Future()
+    def done(address, error):
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(address)
+    resolver.resolve(hostname, done)
+    return future
+
+def run(loop, future):
+    # Run the loop until it has nothing left to do, and return the result of
+    # future, which may be a generator, to be run as a task
+    if isinstance(future, types.GeneratorType):
+        future = spawn(loop, future)
+    loop.run()
+    return future.result()
+
+# Tasks for doing I/O on non-blocking sockets
+
+def connect(loop, address):
+    # Return a socket connected to address
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    err = sock.connect_ex(address)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        sock.close()
+        raise socket.error(err, os.strerror(err))
+
+    # Once the socket is writable, the connection attempt has finished, one
+    # way or the other
+    yield writable(loop, sock)
+    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        sock.close()
+        raise socket.error(err, os.strerror(err))
+    raise Return(sock)
+
+def recv(loop, sock, size=RECV_SIZE):
+    # Return the next data to arrive on sock; an empty string means that the
+    # other end has closed the connection
+    while True:
+        yield readable(loop, sock)
+        try:
+            raise Return(sock.recv(size))
+        except socket.error as e:
+            if e.args[0] != errno.EWOULDBLOCK:
+                raise
+
+def sendall(loop, sock, data):
+    while data:
+        yield writable(loop, sock)
+        try:
+            sent = sock.send(data)
+        except socket.error as e:
+            if e.args[0] != errno.EWOULDBLOCK:
+                raise
+            continue
+        data = data[sent:]
+
+def fetch(loop, resolver, url, max_redirects=MAX_REDIRECTS):
+    # Request url, following any redirects, and return a tuple:
+    #   (the url we ended up at, ResponseParser holding the response)
+    # Raises socket.error if the request fails, or ValueError (a ParseError,
+    # say) if the url or the response is malformed.
+    # Compare this with the callbacks that spider4.py needs to do the same.
+    for _ in range(max_redirects + 1):
+        netloc, path = parse_url(url)
+        hostname, port = parse_netloc(netloc)
+        address = yield resolve(resolver, hostname)
+        sock = yield connect(loop, (address, port))
+        try:
+            request = 'GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (
+                path.encode('utf-8'), netloc)
+            yield sendall(loop, sock, request)
+
+            parser = ResponseParser()
+            while True:
+                data = yield recv(loop, sock)
+                if not data:
+                    parser.feed_eof()
+                    break
+                if parser.feed(data):
+                    break
+        finally:
+            sock.close()
+
+        if parser.error is not None:
+            raise parser.error
+        if not parser.complete:
+            raise socket.error('connection closed before response was '
+                               'complete')
+        location = parser.get_header('Location')
+        if parser.status_code not in ('301', '302') or location is None:
+            raise Return((url, parser))
+        url = urlparse.urljoin(url, location)
+
+    raise socket.error('too many redirects')
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Fetch some urls at once, using tasks')
+    arg_parser.add_argument('urls', nargs='+')
+    arg_parser.add_argument('--limit', type=int, default=10,
+                            help='the most urls to fetch at once')
+    args = arg_parser.parse_args()
+
+    loop = Event()
+    resolver = ThreadPoolResolver(loop)
+
+    def fetch_and_report(url):
+        try:
+            final_url, parser = yield fetch(loop, resolver, url)
+        except (socket.error, ValueError) as e:
+            print 'error:', url, e
+            return
+        print parser.status_code, final_url, len(parser.body)
+
+    urls = (fetch_and_report(url) for url in args.urls)
+    run(loop, gather(loop, urls, args.limit))
+    resolver.close()
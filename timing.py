@@ -0,0 +1,326 @@
+# timing.py
+
+# Where does a crawl's time go?  spider4.py can tell us two things:
+#
+#   * For each url, a RequestTiming: when the request reached each stage on its
+#     way through the spider, from being scheduled to being finished with, and
+#     how many bytes came back with what status.  From these we get how long it
+#     spent in each phase:
+#
+#       wait      -- waiting for a connection with room for it
+#       dns       -- waiting for the host's address to be looked up
+#       connect   -- waiting for the TCP handshake
+#       ttfb      -- from the request being sent (or, if it was pipelined
+#                    behind others, from the previous response finishing) to
+#                    the first byte of the response arriving
+#       transfer  -- from the first byte of the response to the last (which,
+#                    if links are found as the page arrives, includes finding
+#                    them)
+#       parse     -- finding the links in the page, and handling the response
+#       total     -- from being scheduled to being finished with
+#
+#     A phase is None if the request never went through it: there's no dns
+#     phase for a request sent on a connection that had already been looked
+#     up, and no connect phase either if it had already been established.
+#
+#   * From the Event loop, a LoopStats: how many times the loop went round, how
+#     many sockets it asked the poller about each time and how many were ready,
+#     how long each callback took, and how late timers ran (the "loop lag": if
+#     a callback hogs the loop, everything else waits).
+#
+# Neither is collected unless it's asked for.  Spider takes an on_request_done
+# hook, which is called with each url's RequestTiming; Event takes a monitor,
+# which is anything with LoopStats' methods.  A TimingSummary's add() can be
+# used as the hook; it keeps histograms rather than every timing, so it uses
+# the same memory however long the crawl.
+
+import math
+
+class Histogram(object):
+    # Counts of values, in buckets whose width grows with the size of the
+    # values, so that the relative error is about the same everywhere
+    # (BUCKETS_PER_DOUBLING buckets between each power of two).  Memory use
+    # doesn't grow with the number of values.
+
+    BUCKETS_PER_DOUBLING = 8
+
+    # Values are recorded in microseconds, and everything under 1us goes in
+    # the first bucket
+    SCALE = 1e6
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+
+    def bucket(self, value):
+        scaled = value * self.SCALE
+        if scaled <= 1:
+            return 0
+        return int(math.ceil(math.log(scaled, 2) * self.BUCKETS_PER_DOUBLING))
+
+    def upper_bound(self, bucket):
+        # The largest value that goes in bucket
+        return 2 ** (float(bucket) / self.BUCKETS_PER_DOUBLING) / self.SCALE
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def percentile(self, p):
+        # An upper bound on the pth percentile
+        if not self.count:
+            return None
+        target = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def rows(self, n_rows=20):
+        # Return a list of (upper bound, count) tuples, merging neighbouring
+        # buckets so that there are no more than about n_rows of them
+        if not self.counts:
+            return []
+        low, high = min(self.counts), max(self.counts)
+        step = max(1, int(math.ceil(float(high - low + 1) / n_rows)))
+        rows = []
+        for start in range(low, high + 1, step):
+            count = sum(self.counts.get(bucket, 0)
+                        for bucket in range(start, start + step))
+            rows.append((self.upper_bound(start + step - 1), count))
+        return rows
+
+    def summary(self):
+        # A dict of the usual statistics, for reports
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else None,
+        }
+
+# The phases of a request, in the order they happen
+PHASES = ('wait', 'dns', 'connect', 'ttfb', 'transfer', 'parse', 'total')
+
+class RequestTiming(object):
+    # The life of one request.  Each stage is the time (by the loop's clock)
+    # at which the request reached it, or None if it hasn't (or never will):
+    #
+    #   start         -- the spider decided to request the url
+    #   placed        -- the request was given a connection
+    #   resolved      -- the connection's host was looked up
+    #   connected     -- the connection was established
+    #   sent          -- the last of the request was sent
+    #   read_started  -- we started waiting for the response (which, with
+    #                    pipelining, is when the previous response finished)
+    #   first_byte    -- the first of the response arrived
+    #   done          -- the last of the response arrived
+    #   end           -- we'd finished with the url, one way or another
+
+    STAGES = ('placed', 'resolved', 'connected', 'sent', 'read_started',
+              'first_byte', 'done')
+
+    def __init__(self, url, start):
+        self.url = url
+        self.start = start
+        for stage in self.STAGES:
+            setattr(self, stage, None)
+        self.end = None
+
+        # The seconds spent finding links in the page and handling the
+        # response
+        self.parse_time = 0.0
+
+        # The status code of the response, or 'timeout' or 'error' if the
+        # request failed (see Spider.record_result)
+        self.status = None
+
+        # The bytes of the response that we read, headers and all
+        self.bytes = 0
+
+        # The number of times the request had to be sent again, because the
+        # connection it was on was dropped
+        self.retries = 0
+
+    def retry(self):
+        # The request is going to be sent again, on another connection, so
+        # forget how it got on with this one
+        for stage in self.STAGES:
+            setattr(self, stage, None)
+        self.parse_time = 0.0
+        self.bytes = 0
+        self.retries += 1
+
+    def phases(self):
+        # Return a dict mapping each phase to the seconds spent in it, or None
+        def between(first, last):
+            if first is None or last is None:
+                return None
+            return last - first
+
+        if self.sent is not None and self.read_started is not None:
+            asked = max(self.sent, self.read_started)
+        else:
+            asked = self.sent
+        return {
+            'wait': between(self.start, self.placed),
+            'dns': between(self.placed, self.resolved),
+            'connect': between(self.resolved or self.placed, self.connected),
+            'ttfb': between(asked, self.first_byte),
+            'transfer': between(self.first_byte, self.done),
+            'parse': self.parse_time if self.done is not None else None,
+            'total': between(self.start, self.end),
+        }
+
+    def as_dict(self):
+        timing = {'url': self.url, 'status': self.status,
+                  'bytes': self.bytes, 'retries': self.retries}
+        timing.update(self.phases())
+        return timing
+
+class LoopStats(object):
+    # Counts what an Event loop does, as its monitor.  The loop calls:
+    #
+    #   polled(watched, ready, blocked)  -- after each call to poll(), with the
+    #                                       number of fds being watched, the
+    #                                       number that were ready, and the
+    #                                       seconds spent blocked in poll()
+    #   ran(seconds)                     -- after each callback (or the
+    #                                       callbacks for one ready fd)
+    #   timer_ran(lag)                   -- before each timer's callback, with
+    #                                       how late it is
+
+    def __init__(self):
+        self.iterations = 0
+        self.watched = 0
+        self.ready = 0
+        self.blocked = Histogram()
+        self.callbacks = Histogram()
+        self.lag = Histogram()
+
+        # How many fds were watched by the largest poll() call
+        self.max_watched = 0
+
+    def polled(self, watched, ready, blocked):
+        self.iterations += 1
+        self.watched += watched
+        self.ready += ready
+        self.max_watched = max(self.max_watched, watched)
+        self.blocked.add(blocked)
+
+    def ran(self, seconds):
+        self.callbacks.add(seconds)
+
+    def timer_ran(self, lag):
+        self.lag.add(lag)
+
+    def as_dict(self):
+        return {
+            'iterations': self.iterations,
+            'watched_per_poll': (float(self.watched) / self.iterations
+                                 if self.iterations else None),
+            'max_watched': self.max_watched,
+            'ready_per_poll': (float(self.ready) / self.iterations
+                               if self.iterations else None),
+            'ready_ratio': (float(self.ready) / self.watched
+                            if self.watched else None),
+            'blocked': self.blocked.summary(),
+            'callbacks': self.callbacks.summary(),
+            'lag': self.lag.summary(),
+        }
+
+class TimingSummary(object):
+    # Adds up RequestTimings, without keeping them
+
+    def __init__(self):
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+        self.statuses = {}
+        self.bytes = 0
+        self.retries = 0
+
+    def add(self, timing):
+        for phase, seconds in timing.phases().items():
+            if seconds is not None:
+                self.phases[phase].add(seconds)
+        status = timing.status or 'error'
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += timing.bytes
+        self.retries += timing.retries
+
+    def as_dict(self):
+        return {
+            'requests': self.phases['total'].count,
+            'statuses': self.statuses,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'phases': dict((phase, histogram.summary())
+                           for phase, histogram in self.phases.items()),
+        }
+
+    def report(self, loop_stats=None):
+        total = self.phases['total']
+        print '%d requests, %d bytes, %d retries; statuses: %s' % (
+            total.count, self.bytes, self.retries,
+            ', '.join('%s %d' % item for item in sorted(self.statuses.items())))
+
+        # The share of all the requests' time spent in each phase.  (Requests
+        # overlap, so this is not a share of the wall time.)
+        print '%-9s %7s %9s %9s %9s %9s %9s %6s' % (
+            'phase', 'count', 'mean', 'p50', 'p90', 'p99', 'max', 'share')
+        for phase in PHASES:
+            histogram = self.phases[phase]
+            summary = histogram.summary()
+            if total.total and phase != 'total':
+                share = '%5.1f%%' % (100 * histogram.total / total.total)
+            else:
+                share = ''
+            print '%-9s %7d %9s %9s %9s %9s %9s %6s' % (
+                (phase, histogram.count) +
+                tuple(format_time(summary[key])
+                      for key in ('mean', 'p50', 'p90', 'p99', 'max')) +
+                (share,))
+
+        if loop_stats is not None:
+            stats = loop_stats.as_dict()
+            if not stats['iterations']:
+                return
+            print 'loop: %d iterations, %.1f fds watched and %.2f ready per ' \
+                'poll (ratio %.3f, most watched %d)' % (
+                    stats['iterations'], stats['watched_per_poll'],
+                    stats['ready_per_poll'], stats['ready_ratio'] or 0,
+                    stats['max_watched'])
+            for name in ('blocked', 'callbacks', 'lag'):
+                summary = stats[name]
+                print 'loop %-9s %7d %9s %9s %9s %9s %9s' % (
+                    (name, summary['count']) +
+                    tuple(format_time(summary[key])
+                          for key in ('mean', 'p50', 'p90', 'p99', 'max')))
+
+def format_time(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 1e-3:
+        return '%.0fus' % (seconds * 1e6)
+    if seconds < 1:
+        return '%.2fms' % (seconds * 1e3)
+    return '%.2fs' % seconds
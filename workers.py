@@ -0,0 +1,102 @@
+# workers.py
+
+# A Twisted server runs in a single process, so it can only use one core.  When
+# we point thousands of connections from the spiders (or loadgen.py) at
+# slowserver.py or echoserver.py, the server runs out of CPU before the client
+# does, and we end up measuring the server.
+#
+# With --workers N, a server starts N copies of itself, which all accept
+# connections on the same port.  Where the platform has SO_REUSEPORT, each
+# worker has its own listening socket, bound with SO_REUSEPORT, and the kernel
+# spreads new connections across them.  Otherwise the parent opens the
+# listening socket, and the workers inherit it and share it.
+#
+# The workers are started as new processes (rather than forked), since
+# importing Twisted's reactor has already created things, like an epoll
+# descriptor, that mustn't be shared between processes.
+
+import argparse
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# The length of the queue of connections waiting to be accepted.  (Twisted's
+# default of 50 is far too small for a crowd of spiders; the kernel caps this
+# at net.core.somaxconn.)
+BACKLOG = 1024
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='the number of processes to accept '
+                                 'connections in')
+
+    # These are only used by the parent, to tell the workers how to listen
+    arg_parser.add_argument('--reuse-port', action='store_true',
+                            help=argparse.SUPPRESS)
+    arg_parser.add_argument('--listen-fd', type=int, help=argparse.SUPPRESS)
+
+def listen(reactor, port, factory, args):
+    # Start accepting connections on port for factory, as set up by args
+    if args.listen_fd is not None:
+        sock = socket.fromfd(args.listen_fd, socket.AF_INET,
+                             socket.SOCK_STREAM)
+        sock.setblocking(0)
+    else:
+        sock = listening_socket(port, args.reuse_port)
+
+    # Twisted makes its own copy of the descriptor
+    listening_port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET,
+                                             factory)
+    sock.close()
+    return listening_port
+
+def listening_socket(port, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(BACKLOG)
+    sock.setblocking(0)
+    return sock
+
+def run_workers(n_workers, port):
+    # Run n_workers copies of this program, with the same arguments, all
+    # accepting connections on port.  Returns once any of them exits (having
+    # stopped the rest), with its exit status.
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock = None
+        extra_args = ['--reuse-port']
+    else:
+        sock = listening_socket(port)
+        extra_args = ['--listen-fd', str(sock.fileno())]
+
+    # Later options override earlier ones, so this turns off --workers
+    command = [sys.executable] + sys.argv + ['--workers', '1'] + extra_args
+    workers = [subprocess.Popen(command, close_fds=False)
+               for _ in range(n_workers)]
+    if sock is not None:
+        sock.close()
+
+    def stop(signum, frame):
+        raise SystemExit(1)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        # There's no way to wait for whichever of several processes exits
+        # first, short of os.wait(), which could reap processes that aren't
+        # ours, so check every so often
+        while True:
+            for worker in workers:
+                status = worker.poll()
+                if status is not None:
+                    return status
+            time.sleep(0.5)
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()